@@ -1,7 +1,6 @@
 from flask import Flask, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
-from flask_migrate import Migrate
 from flask_cors import CORS
 try:
     from flask_mail import Mail
@@ -10,15 +9,35 @@ except Exception:
 from config import config
 import os
 from datetime import datetime
+from app.utils.replica import RoutingSession
 
 # Initialize extensions
-db = SQLAlchemy()
+# RoutingSession sends reads in @use_replica views to the optional read replica
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
-migrate = Migrate()
+# Flask-Migrate is created lazily in create_app(), see _init_migrate()
+migrate = None
 cors = CORS()
 mail = Mail() if Mail else None
 
 
+def _init_migrate(app):
+    """Wire up Flask-Migrate only when the app is loaded by a command line tool.
+
+    Flask-Migrate imports alembic, which is the largest single import at
+    startup; web workers and ``scheduled_tasks.py`` never use the ``flask db``
+    commands, so they skip it.
+    """
+    global migrate
+    import click
+    if click.get_current_context(silent=True) is None:
+        return
+    from flask_migrate import Migrate
+    if migrate is None:
+        migrate = Migrate()
+    migrate.init_app(app, db)
+
+
 def create_app(config_name='default'):
     """Application factory pattern."""
     # Auto-select testing config when running under pytest unless explicitly overridden
@@ -37,11 +56,16 @@ def create_app(config_name='default'):
     app.config.from_object(config[config_name])
     
     # Initialize extensions with app
+    from app.utils.db_pool import configure_engine_options, init_db_pool
+    from app.utils.replica import configure_replica_bind
+    configure_engine_options(app)
+    configure_replica_bind(app)
     db.init_app(app)
+    init_db_pool(app)
     login_manager.init_app(app)
     # Ensure remember cookie uses configured duration
     login_manager.remember_cookie_duration = app.config.get('REMEMBER_COOKIE_DURATION')
-    migrate.init_app(app, db)
+    _init_migrate(app)
     cors.init_app(app)
     if mail:
         mail.init_app(app)
@@ -77,6 +101,18 @@ def create_app(config_name='default'):
     from app.routes.webhooks import webhooks_bp
     app.register_blueprint(webhooks_bp)
     
+    # Register Prometheus metrics endpoint
+    from app.routes.metrics import metrics_bp
+    app.register_blueprint(metrics_bp)
+    
+    # Request latency, pool and job metrics shared across workers
+    from app.utils.metrics import init_metrics
+    init_metrics(app)
+    
+    # On-demand request profiling for managers
+    from app.utils.profiler import init_profiler
+    init_profiler(app)
+    
     # Add route to serve uploaded files
     @app.route('/uploads/<path:filename>')
     def uploaded_file(filename):
@@ -106,100 +142,37 @@ def create_app(config_name='default'):
             'Driver': Driver
         }
     
-    # Create database tables
-    with app.app_context():
-        db.create_all()
-        # Sync PostgreSQL enums to include all Python Enum values
-        try:
-            if db.engine.dialect.name == 'postgresql':
-                from sqlalchemy import text
-                # Sync CarCategory enum
-                try:
-                    from app.models.car import CarCategory
-                    with db.engine.begin() as conn:
-                        existing_values = set(
-                            row[0]
-                            for row in conn.execute(
-                                text(
-                                    """
-                                    SELECT e.enumlabel
-                                    FROM pg_type t
-                                    JOIN pg_enum e ON t.oid = e.enumtypid
-                                    WHERE t.typname = :type_name
-                                    """
-                                ),
-                                {"type_name": "carcategory"},
-                            )
-                        )
-                        for member in CarCategory:
-                            if member.value not in existing_values:
-                                conn.execute(
-                                    text("ALTER TYPE carcategory ADD VALUE IF NOT EXISTS :val"),
-                                    {"val": member.value},
-                                )
-                except Exception as e:
-                    # Log and continue; app should still start
-                    app.logger.warning(f"Enum sync warning (CarCategory): {e}")
-
-                # Ensure idempotency unique index exists for PayAdvantage payments
-                try:
-                    with db.engine.begin() as conn:
-                        conn.execute(
-                            text(
-                                """
-                                CREATE UNIQUE INDEX IF NOT EXISTS uq_payments_gateway_txn_payadvantage
-                                ON payments (booking_id, gateway, gateway_transaction_id)
-                                WHERE gateway = 'payadvantage' AND gateway_transaction_id IS NOT NULL
-                                """
-                            )
-                        )
-                except Exception as e:
-                    app.logger.warning(f"Idempotency index creation skipped: {e}")
-                
-                # Ensure VIN and license plate are unique only for active cars (partial unique indexes)
-                try:
-                    with db.engine.begin() as conn:
-                        # Best-effort drop of pre-existing full unique constraints/indexes
-                        try:
-                            conn.execute(text("ALTER TABLE cars DROP CONSTRAINT IF EXISTS cars_vin_key"))
-                        except Exception as e:
-                            app.logger.debug(f"Drop cars_vin_key constraint skipped: {e}")
-                        try:
-                            conn.execute(text("ALTER TABLE cars DROP CONSTRAINT IF EXISTS cars_license_plate_key"))
-                        except Exception as e:
-                            app.logger.debug(f"Drop cars_license_plate_key constraint skipped: {e}")
-                        # Also try dropping as indexes in case they were created as such
-                        try:
-                            conn.execute(text("DROP INDEX IF EXISTS cars_vin_key"))
-                        except Exception as e:
-                            app.logger.debug(f"Drop cars_vin_key index skipped: {e}")
-                        try:
-                            conn.execute(text("DROP INDEX IF EXISTS cars_license_plate_key"))
-                        except Exception as e:
-                            app.logger.debug(f"Drop cars_license_plate_key index skipped: {e}")
-
-                        # Create partial unique indexes enforcing uniqueness only when is_active = true
-                        conn.execute(
-                            text(
-                                """
-                                CREATE UNIQUE INDEX IF NOT EXISTS uq_cars_vin_active
-                                ON cars (vin)
-                                WHERE is_active = true
-                                """
-                            )
-                        )
-                        conn.execute(
-                            text(
-                                """
-                                CREATE UNIQUE INDEX IF NOT EXISTS uq_cars_license_plate_active
-                                ON cars (license_plate)
-                                WHERE is_active = true
-                                """
-                            )
-                        )
-                except Exception as e:
-                    app.logger.warning(f"Partial unique index setup for cars skipped: {e}")
-        except Exception as e:
-            app.logger.warning(f"Enum sync skipped: {e}")
+    # Two-tier application cache (per-worker LRU + shared backend)
+    from app.cache import cache
+    cache.init_app(app)
+    
+    # Publish cache tag invalidations for committed model changes
+    from app.utils.invalidation import init_invalidation_bus
+    init_invalidation_bus()
+    
+    # {% cache %} template fragments, invalidated by fleet/booking version tokens
+    from app.utils.fragment_cache import init_fragment_cache
+    init_fragment_cache(app)
+    
+    # Readiness tracking for the post-fork warm-up (see gunicorn.conf.py)
+    from app.utils.warmup import init_warmup
+    init_warmup(app)
+    
+    # Schema changes run via `flask db-sync`; startup only syncs when SCHEMA_AUTO_SYNC is set
+    from app.utils.schema import init_schema
+    init_schema(app)
+    
+    # Xero calls queued by requests are sent by `flask xero-outbox`
+    from app.services.xero_outbox import init_xero_outbox
+    init_xero_outbox(app)
+    from app.services.xero_contacts import init_xero_contacts
+    init_xero_contacts(app)
+    # Verified webhook events are stored on receipt and processed by `flask webhook-events`
+    from app.services.webhook_inbox import init_webhook_inbox
+    init_webhook_inbox(app)
+    from app.services.pay_advantage_reconcile import init_pay_advantage_reconcile
+    init_pay_advantage_reconcile(app)
+    from app.services.cash_flow import init_cash_flow
+    init_cash_flow(app)
     
     return app
\ No newline at end of file
@@ -0,0 +1,621 @@
+"""Two-tier application cache.
+
+Lookups go to a per-worker LRU first (bounded by ``CACHE_LOCAL_MAX_ENTRIES``
+and ``CACHE_LOCAL_TTL``), then to a shared backend selected by ``CACHE_TYPE``:
+
+* ``filesystem`` - pickled files in ``CACHE_DIR`` (single node, default)
+* ``sqlite`` - one table in ``CACHE_SQLITE_PATH`` (single node)
+* ``redis`` - ``CACHE_REDIS_URL``; needs the optional ``redis`` package
+* ``null`` - no shared tier, local LRU only
+
+Usage::
+
+    from app.cache import cache
+
+    @cache.cached(ttl=600)
+    def fleet_summary():
+        ...
+
+    fleet_summary.invalidate()
+    value = cache.get_or_set('quote:42', lambda: build_quote(42), ttl=60)
+
+Entries can carry tags (``cache.set(key, value, tags=['car:12', 'fleet'])``).
+Each tag has a version in the shared backend; ``cache.invalidate_tags()``
+(driven by :mod:`app.utils.invalidation` on model commits) bumps it and every
+entry stored under an older version becomes a miss. Workers re-read tag
+versions at most every ``CACHE_TAG_VERSION_TTL`` seconds.
+
+Concurrent misses for the same key are collapsed: within a worker only one
+thread computes the value (single-flight), and across workers a short-lived
+lock in the shared backend makes the others wait for that result instead of
+all hitting the database at once.
+
+``cache.update(key, fn)`` is a read-modify-write under the same kind of lock,
+for small pieces of state that every worker must see, such as rate-limit
+counters.
+"""
+
+import functools
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from flask import current_app, has_app_context
+
+from app.utils.metrics import record_cache_access
+
+
+# Lifetime of the lock taken by Cache.update()
+UPDATE_LOCK_TTL = 2
+
+
+# --------------- Local tier ---------------
+class LocalLRU:
+    """Thread-safe LRU with per-entry expiry."""
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return False, None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def set(self, key: str, value: Any, ttl: Optional[float]):
+        if self.max_entries <= 0:
+            return
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# --------------- Shared backends ---------------
+class NullBackend:
+    shared = False
+
+    def get(self, key):
+        return False, None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def add(self, key, value, ttl=None):
+        return True
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class FileSystemBackend:
+    shared = True
+
+    def __init__(self, directory: str, max_entries: int = 10000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return False, None
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return False, None
+        return True, value
+
+    def set(self, key, value, ttl=None):
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((time.time() + ttl if ttl else None, value), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError:
+            _remove(tmp_path)
+            return
+        self._writes += 1
+        if self._writes % 200 == 0:
+            self._prune()
+
+    def add(self, key, value, ttl=None):
+        """Store only if ``key`` is absent (or expired); returns True if stored."""
+        path = self._path(key)
+        found, _ = self.get(key)
+        if found:
+            return False
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # Another process won the race, or an unreadable leftover; let get() decide next time
+            return False
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((time.time() + ttl if ttl else None, value), f, pickle.HIGHEST_PROTOCOL)
+        return True
+
+    def delete(self, key):
+        _remove(self._path(key))
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            _remove(os.path.join(self.directory, name))
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _prune(self):
+        try:
+            paths = [os.path.join(self.directory, n) for n in os.listdir(self.directory)]
+            if len(paths) <= self.max_entries:
+                return
+            paths.sort(key=os.path.getmtime)
+        except OSError:
+            return
+        for path in paths[:len(paths) - self.max_entries]:
+            _remove(path)
+
+
+class SQLiteBackend:
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn().execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)'
+        )
+
+    def get(self, key):
+        row = self._conn().execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return False, None
+        if row[1] is not None and row[1] < time.time():
+            self.delete(key)
+            return False, None
+        return True, pickle.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        self._conn().execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.time() + ttl if ttl else None),
+        )
+
+    def add(self, key, value, ttl=None):
+        conn = self._conn()
+        conn.execute('DELETE FROM cache WHERE key = ? AND expires IS NOT NULL AND expires < ?', (key, time.time()))
+        cur = conn.execute(
+            'INSERT OR IGNORE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.time() + ttl if ttl else None),
+        )
+        return cur.rowcount == 1
+
+    def delete(self, key):
+        self._conn().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        self._conn().execute('DELETE FROM cache')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit; WAL lets readers in other workers proceed during writes
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+
+class RedisBackend:
+    shared = True
+
+    def __init__(self, url: str):
+        import redis
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        raw = self._client.get(key)
+        if raw is None:
+            return False, None
+        return True, pickle.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self._client.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ex=int(ttl) if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        return bool(self._client.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                                     ex=int(ttl) if ttl else None, nx=True))
+
+    def delete(self, key):
+        self._client.delete(key)
+
+    def clear(self):
+        # Only our namespace; never FLUSHDB a possibly shared Redis
+        prefix = current_app.config.get('CACHE_KEY_PREFIX', '') if has_app_context() else ''
+        for key in self._client.scan_iter(match=f'{prefix}*'):
+            self._client.delete(key)
+
+
+# --------------- Extension ---------------
+class _Flight:
+    __slots__ = ('event', 'value', 'ok')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.ok = False
+
+
+class _Tagged:
+    """Stored value plus the tag versions it was computed under."""
+    __slots__ = ('value', 'tags')
+
+    def __init__(self, value, tags):
+        self.value = value
+        self.tags = tags
+
+    def __getstate__(self):
+        return (self.value, self.tags)
+
+    def __setstate__(self, state):
+        self.value, self.tags = state
+
+
+class _CacheState:
+    def __init__(self, app):
+        cfg = app.config
+        self.prefix = cfg.get('CACHE_KEY_PREFIX', 'aurora:')
+        self.default_ttl = cfg.get('CACHE_DEFAULT_TTL', 300)
+        self.local_ttl = cfg.get('CACHE_LOCAL_TTL', 30)
+        self.lock_ttl = cfg.get('CACHE_LOCK_TTL', 30)
+        self.local = LocalLRU(cfg.get('CACHE_LOCAL_MAX_ENTRIES', 1000))
+        self.backend = _make_backend(app)
+        self.tag_versions = LocalLRU(cfg.get('CACHE_LOCAL_MAX_ENTRIES', 1000))
+        # Without a shared tier the local copy is the only copy, so it must not expire
+        self.tag_version_ttl = cfg.get('CACHE_TAG_VERSION_TTL', 1.0) if self.backend.shared else None
+        self.stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'sets': 0}
+        self.flights = {}
+        self.flights_lock = threading.Lock()
+        self.update_lock = threading.Lock()
+
+
+class Cache:
+    """Flask extension exposing the two-tier cache of the current app."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['cache'] = _CacheState(app)
+
+    # --------------- Basic operations ---------------
+    def get(self, key: str, default=None):
+        found, value = self._lookup(key)
+        return value if found else default
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None, tags: Optional[Iterable[str]] = None):
+        state = self._state()
+        if state is None:
+            return
+        ttl = state.default_ttl if ttl is None else ttl
+        full_key = state.prefix + key
+        if tags:
+            value = _Tagged(value, self.tag_versions(tags))
+        state.backend.set(full_key, value, ttl)
+        state.local.set(full_key, value, self._local_ttl(state, ttl))
+        state.stats['sets'] += 1
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """Set ``key`` only if it is not already in the shared tier; True if stored."""
+        state = self._state()
+        if state is None:
+            return False
+        return state.backend.add(state.prefix + key, value, state.default_ttl if ttl is None else ttl)
+
+    def delete(self, key: str):
+        state = self._state()
+        if state is None:
+            return
+        full_key = state.prefix + key
+        state.local.delete(full_key)
+        state.backend.delete(full_key)
+
+    def clear(self):
+        state = self._state()
+        if state is None:
+            return
+        state.local.clear()
+        state.backend.clear()
+
+    def update(self, key: str, fn: Callable[[Any], Tuple[Any, Any]], ttl: Optional[float] = None):
+        """Atomically replace ``key`` with a value computed from the current one.
+
+        ``fn`` gets the stored value (``None`` if absent) and returns
+        ``(new_value, result)``; ``update`` stores ``new_value`` and returns
+        ``result``. The value is read and written in the shared tier under a
+        short lock, so all workers see one sequence of updates. Keys written
+        this way should only be read through ``update``, since ``get`` may
+        serve a local copy. Raises ``TimeoutError`` if the lock cannot be
+        taken within ``2 * UPDATE_LOCK_TTL`` seconds.
+        """
+        state = self._state()
+        if state is None:
+            return fn(None)[1]
+        ttl = state.default_ttl if ttl is None else ttl
+        full_key = state.prefix + key
+        with state.update_lock:
+            if not state.backend.shared:
+                found, current = state.local.get(full_key)
+                value, result = fn(current if found else None)
+                state.local.set(full_key, value, ttl)
+                return result
+
+            lock_key = f'{state.prefix}lock:{key}'
+            owner = uuid.uuid4().hex
+            # Held for one read and one write; a crashed holder's lock expires after UPDATE_LOCK_TTL
+            deadline = time.monotonic() + 2 * UPDATE_LOCK_TTL
+            while not state.backend.add(lock_key, owner, UPDATE_LOCK_TTL):
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'Could not lock cache key {key!r}')
+                time.sleep(0.005)
+            try:
+                found, current = state.backend.get(full_key)
+                value, result = fn(current if found else None)
+                state.backend.set(full_key, value, ttl)
+                return result
+            finally:
+                # Our lock may have expired and been taken by another worker; leave theirs alone
+                found, holder = state.backend.get(lock_key)
+                if found and holder == owner:
+                    state.backend.delete(lock_key)
+
+    # --------------- Tags ---------------
+    def tag_versions(self, tags: Iterable[str]) -> Dict[str, str]:
+        """Current version token of each tag (created on first use)."""
+        state = self._state()
+        if state is None:
+            return {}
+        versions = {}
+        for tag in tags:
+            tag_key = f'{state.prefix}tag:{tag}'
+            found, version = state.tag_versions.get(tag_key)
+            if not found:
+                found, version = state.backend.get(tag_key)
+                if not found:
+                    version = uuid.uuid4().hex[:12]
+                    if not state.backend.add(tag_key, version, 0):
+                        # Another worker created it first
+                        found, existing = state.backend.get(tag_key)
+                        version = existing if found else version
+                state.tag_versions.set(tag_key, version, state.tag_version_ttl)
+            versions[tag] = version
+        return versions
+
+    def invalidate_tags(self, *tags: str):
+        """Expire every entry stored with any of ``tags``, in all workers."""
+        state = self._state()
+        if state is None:
+            return
+        for tag in tags:
+            tag_key = f'{state.prefix}tag:{tag}'
+            version = uuid.uuid4().hex[:12]
+            state.backend.set(tag_key, version, 0)
+            state.tag_versions.set(tag_key, version, state.tag_version_ttl)
+
+    def stats(self) -> dict:
+        state = self._state()
+        if state is None:
+            return {}
+        stats = dict(state.stats)
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_ratio'] = round((lookups - stats['misses']) / lookups, 3) if lookups else None
+        stats['local_entries'] = len(state.local)
+        stats['backend'] = type(state.backend).__name__
+        return stats
+
+    # --------------- Stampede-protected fill ---------------
+    def get_or_set(self, key: str, factory: Callable[[], Any], ttl: Optional[float] = None,
+                   tags: Optional[Iterable[str]] = None, metric: str = 'app'):
+        """Return the cached value or compute it once, even under concurrent misses.
+
+        Hits and misses are counted in ``cache_requests_total`` under ``cache=metric``.
+        """
+        state = self._state()
+        if state is None:
+            return factory()
+        found, value = self._lookup(key, metric)
+        if found:
+            return value
+
+        with state.flights_lock:
+            flight = state.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = state.flights[key] = _Flight()
+        if not leader:
+            flight.event.wait(state.lock_ttl)
+            return flight.value if flight.ok else factory()
+
+        try:
+            value = self._fill_shared(state, key, factory, ttl, tags)
+            flight.value, flight.ok = value, True
+            return value
+        finally:
+            with state.flights_lock:
+                state.flights.pop(key, None)
+            flight.event.set()
+
+    def cached(self, ttl: Optional[float] = None, key: Optional[str] = None, tags=None):
+        """Decorator caching a function's result per positional/keyword arguments.
+
+        ``tags`` is a list, or a callable taking the function's arguments and
+        returning one. The wrapper gains ``invalidate(*args, **kwargs)`` to
+        drop one entry.
+        """
+        def decorator(fn):
+            base = key or f'{fn.__module__}.{fn.__qualname__}'
+
+            def make_key(*args, **kwargs):
+                if not args and not kwargs:
+                    return base
+                return f'{base}:{_args_key(args, kwargs)}'
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                entry_tags = tags(*args, **kwargs) if callable(tags) else tags
+                return self.get_or_set(make_key(*args, **kwargs), lambda: fn(*args, **kwargs), ttl, entry_tags)
+
+            wrapper.invalidate = lambda *args, **kwargs: self.delete(make_key(*args, **kwargs))
+            wrapper.cache_key = make_key
+            return wrapper
+        return decorator
+
+    # --------------- Internals ---------------
+    def _state(self) -> Optional[_CacheState]:
+        if not has_app_context():
+            return None
+        return current_app.extensions.get('cache')
+
+    def _lookup(self, key: str, metric: str = 'app'):
+        state = self._state()
+        if state is None:
+            return False, None
+        full_key = state.prefix + key
+        found, value = state.local.get(full_key)
+        if found:
+            found, value = self._check_tags(value)
+            if found:
+                state.stats['local_hits'] += 1
+                record_cache_access(metric, True)
+                return True, value
+            state.local.delete(full_key)
+        found, value = self._shared_get(state, full_key)
+        if found:
+            state.stats['shared_hits'] += 1
+            record_cache_access(metric, True)
+            return True, value
+        state.stats['misses'] += 1
+        record_cache_access(metric, False)
+        return False, None
+
+    def _shared_get(self, state, full_key):
+        """Read from the shared tier, dropping stale tagged entries and filling the local tier."""
+        found, raw = state.backend.get(full_key)
+        if not found:
+            return False, None
+        found, value = self._check_tags(raw)
+        if found:
+            state.local.set(full_key, raw, state.local_ttl)
+        return found, value
+
+    def _check_tags(self, raw):
+        if not isinstance(raw, _Tagged):
+            return True, raw
+        if self.tag_versions(raw.tags) != raw.tags:
+            return False, None
+        return True, raw.value
+
+    def _fill_shared(self, state, key, factory, ttl, tags=None):
+        if not state.backend.shared:
+            value = factory()
+            self.set(key, value, ttl, tags)
+            return value
+
+        lock_key = f'{state.prefix}lock:{key}'
+        acquired = state.backend.add(lock_key, os.getpid(), state.lock_ttl)
+        if not acquired:
+            # Another worker is computing it; wait for its result
+            deadline = time.monotonic() + state.lock_ttl
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                found, value = self._shared_get(state, state.prefix + key)
+                if found:
+                    return value
+        try:
+            if acquired:
+                # The previous lock holder may have stored it just before releasing
+                found, value = self._shared_get(state, state.prefix + key)
+                if found:
+                    return value
+            value = factory()
+            self.set(key, value, ttl, tags)
+            return value
+        finally:
+            if acquired:
+                state.backend.delete(lock_key)
+
+    @staticmethod
+    def _local_ttl(state, ttl):
+        # The local copy never outlives the shared one and is refreshed at least every CACHE_LOCAL_TTL
+        if not ttl:
+            return state.local_ttl
+        return min(ttl, state.local_ttl) if state.backend.shared else ttl
+
+
+def _make_backend(app):
+    cfg = app.config
+    kind = (cfg.get('CACHE_TYPE') or 'filesystem').lower()
+    try:
+        if kind == 'redis':
+            return RedisBackend(cfg['CACHE_REDIS_URL'])
+        if kind == 'sqlite':
+            return SQLiteBackend(cfg.get('CACHE_SQLITE_PATH') or os.path.join(app.instance_path, 'cache.sqlite3'))
+        if kind == 'filesystem':
+            return FileSystemBackend(cfg.get('CACHE_DIR') or os.path.join(app.instance_path, 'cache'))
+    except Exception as e:
+        app.logger.warning(f"Cache backend '{kind}' unavailable, using local cache only: {e}")
+    return NullBackend()
+
+
+def _args_key(args, kwargs) -> str:
+    raw = repr((args, sorted(kwargs.items())))
+    if len(raw) <= 100:
+        return raw
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+cache = Cache()
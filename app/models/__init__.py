@@ -5,10 +5,14 @@ from .driver import Driver, DriverStatus
 from .payment import Payment, PaymentStatus, PaymentMethod
 from .maintenance import Maintenance, MaintenanceType, MaintenanceStatus
 from .xero_token import XeroToken
+from .xero_outbox import XeroOutbox
+from .xero_contact import XeroContact
+from .sync_checkpoint import SyncCheckpoint
+from .webhook_event import WebhookEvent
 from .vehicle_return import VehicleReturn
 from .vehicle_photo import VehiclePhoto, PhotoType
 from .booking_photo import BookingPhoto
-from .pay_advantage import PayAdvantageCustomer, DirectDebitSchedule, DirectDebitInstallment
+from .pay_advantage import PayAdvantageCustomer, DirectDebitSchedule, DirectDebitInstallment, ProjectedInstallment
 
 __all__ = [
     'User', 'Role',
@@ -17,11 +21,12 @@ __all__ = [
     'Driver', 'DriverStatus',
     'Payment', 'PaymentStatus', 'PaymentMethod',
     'Maintenance', 'MaintenanceType', 'MaintenanceStatus',
-    'XeroToken',
+    'XeroToken', 'XeroOutbox', 'XeroContact', 'SyncCheckpoint',
+    'WebhookEvent',
     'VehicleReturn',
     'VehiclePhoto', 'PhotoType',
     'BookingPhoto',
-    'PayAdvantageCustomer', 'DirectDebitSchedule', 'DirectDebitInstallment'
+    'PayAdvantageCustomer', 'DirectDebitSchedule', 'DirectDebitInstallment', 'ProjectedInstallment'
 ]
 
 
@@ -1,4 +1,5 @@
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from typing import Optional
 from app import db
 
 
@@ -33,6 +34,13 @@ class DirectDebitSchedule(db.Model):
     """Model for storing direct debit schedules."""
     
     __tablename__ = 'direct_debit_schedules'
+    __table_args__ = (
+        # The daily invoice job: active schedules with a payment due by tomorrow
+        db.Index('ix_dd_schedules_status_next_due', 'status', 'next_due_date'),
+    )
+    
+    # Days between recurring payments; monthly payments fall on the start date's day of the month
+    PERIOD_DAYS = {'weekly': 7, 'fortnightly': 14}
     
     id = db.Column(db.Integer, primary_key=True)
     booking_id = db.Column(db.Integer, db.ForeignKey('bookings.id'), nullable=False)
@@ -46,6 +54,8 @@ class DirectDebitSchedule(db.Model):
     frequency = db.Column(db.String(50))  # weekly, fortnightly, monthly
     end_condition_amount = db.Column(db.Float)
     status = db.Column(db.String(50))
+    # Next recurring payment not invoiced yet; advanced as payments are invoiced or paid
+    next_due_date = db.Column(db.Date)
     authorization_url = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -56,6 +66,33 @@ class DirectDebitSchedule(db.Model):
     def __repr__(self):
         return f'<DirectDebitSchedule {self.schedule_id}>'
     
+    def due_date_on_or_after(self, day: date) -> Optional[date]:
+        """First recurring payment date on or after ``day``; None without recurring payments."""
+        start = self.recurring_start_date
+        if not start or not self.recurring_amount:
+            return None
+        day = max(day, start)
+        period = self.PERIOD_DAYS.get(self.frequency)
+        if period:
+            return day + timedelta(days=-(day - start).days % period)
+        if self.frequency == 'monthly':
+            # Months without the start day (e.g. the 31st) have no payment
+            year, month = day.year, day.month
+            for _ in range(13):
+                try:
+                    candidate = date(year, month, start.day)
+                except ValueError:
+                    candidate = None
+                if candidate and candidate >= day:
+                    return candidate
+                year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return None
+    
+    def advance_past(self, day: date) -> None:
+        """Move ``next_due_date`` beyond ``day`` once the payment due that day is invoiced or paid."""
+        if self.next_due_date is not None and self.next_due_date <= day:
+            self.next_due_date = self.due_date_on_or_after(day + timedelta(days=1))
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -70,12 +107,51 @@ class DirectDebitSchedule(db.Model):
             'frequency': self.frequency,
             'end_condition_amount': self.end_condition_amount,
             'status': self.status,
+            'next_due_date': self.next_due_date.isoformat() if self.next_due_date else None,
             'authorization_url': self.authorization_url,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
 
 
+@db.event.listens_for(DirectDebitSchedule, 'before_insert')
+def _set_first_due_date(mapper, connection, schedule):
+    if schedule.next_due_date is None and schedule.recurring_start_date:
+        schedule.next_due_date = schedule.due_date_on_or_after(schedule.recurring_start_date)
+
+
+class ProjectedInstallment(db.Model):
+    """A payment a direct debit schedule is expected to collect, for the cash-flow forecast."""
+    __tablename__ = 'projected_installments'
+    __table_args__ = (
+        # The forecast report: installments due within a date range
+        db.Index('ix_projected_installments_due_date', 'due_date'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    schedule_id = db.Column(db.String(100), db.ForeignKey('direct_debit_schedules.schedule_id'),
+                            nullable=False, index=True)
+    booking_id = db.Column(db.Integer, db.ForeignKey('bookings.id'), nullable=False)
+    due_date = db.Column(db.Date, nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # upfront, recurring
+    projected_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"<ProjectedInstallment {self.schedule_id} {self.due_date} {self.amount}>"
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'schedule_id': self.schedule_id,
+            'booking_id': self.booking_id,
+            'due_date': self.due_date.isoformat() if self.due_date else None,
+            'amount': self.amount,
+            'kind': self.kind,
+            'projected_at': self.projected_at.isoformat() if self.projected_at else None
+        }
+
+
 class DirectDebitInstallment(db.Model):
     """Installments generated by a direct debit schedule (scheduled vs paid)."""
     __tablename__ = 'direct_debit_installments'
@@ -0,0 +1,25 @@
+from datetime import datetime
+from app import db
+
+
+class SyncCheckpoint(db.Model):
+    """Where an incremental sync job got to, e.g. the last Xero invoice modification seen."""
+
+    __tablename__ = 'sync_checkpoints'
+
+    name = db.Column(db.String(100), primary_key=True)
+    watermark = db.Column(db.DateTime)
+    cursor = db.Column(db.JSON)  # job-specific position within a run
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<SyncCheckpoint {self.name} {self.watermark}>'
+
+    @classmethod
+    def load(cls, name):
+        """The checkpoint called ``name``, added to the session if it didn't exist."""
+        checkpoint = db.session.get(cls, name)
+        if checkpoint is None:
+            checkpoint = cls(name=name)
+            db.session.add(checkpoint)
+        return checkpoint
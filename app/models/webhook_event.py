@@ -0,0 +1,41 @@
+from datetime import datetime
+from app import db
+
+
+class WebhookEvent(db.Model):
+    """Verified webhook event stored on receipt and processed by the inbox worker."""
+
+    __tablename__ = 'webhook_events'
+    __table_args__ = (
+        # A redelivered event is stored once
+        db.UniqueConstraint('source', 'dedupe_key', name='uq_webhook_events_source_dedupe'),
+        # The worker's claim query: the oldest unfinished event of each schedule
+        db.Index('ix_webhook_events_status_ordering', 'status', 'ordering_key', 'id'),
+    )
+
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    PROCESSED = 'processed'
+    FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.String(50), nullable=False)  # 'payadvantage'
+    event_type = db.Column(db.String(100))
+    # Events sharing an ordering key (the PayAdvantage schedule) are processed in arrival order
+    ordering_key = db.Column(db.String(150), nullable=False)
+    dedupe_key = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+
+    # Processing state
+    status = db.Column(db.String(20), default=PENDING, nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    # Timestamps
+    received_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    processed_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<WebhookEvent {self.id} {self.source} {self.status}>'
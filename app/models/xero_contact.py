@@ -0,0 +1,24 @@
+from datetime import datetime
+from app import db
+
+
+class XeroContact(db.Model):
+    """Xero ContactID of a customer, so invoices can reference the contact instead of embedding it."""
+
+    __tablename__ = 'xero_contacts'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=True, nullable=False)
+    contact_id = db.Column(db.String(64), unique=True, nullable=False)
+    # Fingerprint of the contact fields last sent to (or read from) Xero
+    contact_hash = db.Column(db.String(64))
+
+    # Timestamps
+    synced_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    user = db.relationship('User')
+
+    def __repr__(self):
+        return f'<XeroContact user={self.user_id} {self.contact_id}>'
@@ -0,0 +1,62 @@
+from datetime import datetime
+from app import db
+
+
+class XeroOutbox(db.Model):
+    """Xero operation queued by a request and performed by the outbox worker."""
+
+    __tablename__ = 'xero_outbox'
+    __table_args__ = (
+        # The worker's claim query: due pending entries, oldest first
+        db.Index('ix_xero_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    operation = db.Column(db.String(50), nullable=False)  # 'send_invoice'
+    booking_id = db.Column(db.Integer, db.ForeignKey('bookings.id'))
+    requested_by_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    payload = db.Column(db.JSON, nullable=False)
+
+    # Delivery state
+    status = db.Column(db.String(20), default=PENDING, nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    result = db.Column(db.JSON)  # {'invoice_id': ..., 'invoice_number': ...}
+
+    # Timestamps
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    completed_at = db.Column(db.DateTime)
+
+    booking = db.relationship('Booking')
+
+    def __repr__(self):
+        return f'<XeroOutbox {self.id} {self.operation} {self.status}>'
+
+    @property
+    def is_finished(self):
+        return self.status in (self.SENT, self.FAILED)
+
+    def to_dict(self):
+        """Status as polled by the UI."""
+        result = self.result or {}
+        return {
+            'id': self.id,
+            'operation': self.operation,
+            'booking_id': self.booking_id,
+            'status': self.status,
+            'attempts': self.attempts,
+            'last_error': self.last_error,
+            'invoice_id': result.get('invoice_id'),
+            'invoice_number': result.get('invoice_number'),
+            'next_attempt_at': self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'completed_at': self.completed_at.isoformat() if self.completed_at else None
+        }
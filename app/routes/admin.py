@@ -1169,7 +1169,7 @@ def show_send_invoice(booking_id):
 def send_invoice(booking_id):
     """Send invoice for a booking through Xero."""
     from app.models import XeroToken
-    from app.utils.xero import XeroClient
+    from app.services.xero_outbox import enqueue_invoice
     import logging
     
     logger = logging.getLogger(__name__)
@@ -1229,51 +1229,18 @@ def send_invoice(booking_id):
         else:
             due_date = datetime.utcnow() + timedelta(days=7)
         
-        # Initialize Xero client and send invoice
-        client = XeroClient()
+        # Use custom invoice amount if provided, otherwise use booking total
+        invoice_amount = float(custom_invoice_amount) if custom_invoice_amount else float(booking.total_amount)
         
-        try:
-            # Use custom invoice amount if provided, otherwise use booking total
-            invoice_amount = float(custom_invoice_amount) if custom_invoice_amount else float(booking.total_amount)
-            
-            # This will automatically refresh the token if needed
-            result = client.create_and_send_invoice(
-                booking_data=booking_data,
-                invoice_amount=invoice_amount,
-                due_date=due_date
-            )
-            
-            # Store invoice reference in booking
-            if result.get('invoice'):
-                invoice_info = result['invoice']
-                booking.admin_notes = (booking.admin_notes or '') + f"\nXero Invoice: {invoice_info.get('InvoiceNumber')} (ID: {invoice_info.get('InvoiceID')})"
-                db.session.commit()
-            
-            return jsonify({
-                'success': True,
-                'message': 'Invoice sent successfully',
-                'invoice_number': result.get('invoice', {}).get('InvoiceNumber'),
-                'invoice_id': result.get('invoice', {}).get('InvoiceID')
-            })
-            
-        except Exception as xero_error:
-            # Check if the error is due to invalid/expired refresh token
-            error_msg = str(xero_error).lower()
-            if 'invalid_grant' in error_msg or 'refresh' in error_msg or 'expired' in error_msg:
-                # Token is invalid - need to re-authorize
-                return jsonify({
-                    'success': False,
-                    'needs_auth': True,
-                    'auth_url': url_for('xero.authorize', _external=True),
-                    'message': 'Xero authorization expired. Please re-authorize the application.'
-                }), 401
-            else:
-                # Other Xero error
-                logger.error(f"Xero error sending invoice: {str(xero_error)}")
-                return jsonify({
-                    'success': False,
-                    'message': f'Failed to send invoice: {str(xero_error)}'
-                }), 500
+        # Xero is called by the outbox worker; the page polls status_url for the result
+        entry = enqueue_invoice(booking, booking_data, invoice_amount, due_date, requested_by_id=current_user.id)
+        return jsonify({
+            'success': True,
+            'queued': True,
+            'outbox_id': entry.id,
+            'status_url': url_for('xero.outbox_status', entry_id=entry.id),
+            'message': 'Invoice queued for sending'
+        }), 202
                 
     except Exception as e:
         logger.error(f"Error processing invoice request: {str(e)}")
@@ -1376,10 +1343,11 @@ def get_handover_details(booking_id):
 def complete_handover(booking_id):
     """Complete the vehicle handover process."""
     from app.services.pay_advantage import PayAdvantageService
-    from app.models import BookingPhoto, DirectDebitSchedule
+    from app.services.storage import get_storage
+    from app.models import BookingPhoto, DirectDebitSchedule, PayAdvantageCustomer
+    from app.utils.flow import Flow
     import base64
-    from io import BytesIO
-    from PIL import Image
+    import functools
     
     booking = Booking.query.get_or_404(booking_id)
     
@@ -1387,6 +1355,9 @@ def complete_handover(booking_id):
         return jsonify({'success': False, 'message': 'Booking must be confirmed to process handover'})
     
     data = request.get_json()
+    # Step timings are logged and exported as flow_step_duration_seconds{flow="handover"}
+    flow = Flow('handover')
+    outcome = 'failed'
     
     try:
         # 1. Update license verification (view-only; license must already be on file from booking stage)
@@ -1398,49 +1369,57 @@ def complete_handover(booking_id):
         if data.get('odometer_reading'):
             booking.pickup_odometer = data['odometer_reading']
         
-        # 3. Save photos
+        direct_debit = data.get('direct_debit')
+        wants_direct_debit = bool(direct_debit and (direct_debit.get('upfront_amount') or direct_debit.get('recurring_amount')))
+        # Require customer mobile number for electronic authorisation
+        if wants_direct_debit and not (booking.customer and booking.customer.phone):
+            return jsonify({'success': False, 'message': 'Customer must have a mobile number to set up electronic direct debit authorisation.'})
+        
+        # 3. Upload photos and check the PayAdvantage customer side by side
+        steps = {}
+        uploads = []
         photos = data.get('photos', [])
         for photo_data in photos:
             # Process base64 image data
             if 'data' in photo_data and photo_data['data'].startswith('data:image'):
                 # Extract base64 data
                 header, encoded = photo_data['data'].split(',', 1)
-                
-                # Upload to storage
                 filename = f"pickup_{booking_id}_{uuid.uuid4().hex[:8]}.jpg"
-                from app.services.storage import get_storage
-                storage = get_storage()
-                import base64 as _b64
-                image_data = _b64.b64decode(encoded)
-                key = f"booking_photos/{filename}"
-                url = storage.upload_bytes(image_data, key, content_type='image/jpeg')
-                
-                # Save photo record to database
-                photo = BookingPhoto(
-                    booking_id=booking_id,
-                    photo_type='pickup',
-                    photo_url=url,
-                    description=photo_data.get('name', ''),
-                    uploaded_by=current_user.id
-                )
-                db.session.add(photo)
+                step = f"photo_upload:{len(uploads)}"
+                steps[step] = functools.partial(get_storage().upload_bytes, base64.b64decode(encoded),
+                                                f"booking_photos/{filename}", content_type='image/jpeg')
+                uploads.append((step, photo_data.get('name', '')))
+        
+        pa_service = PayAdvantageService() if wants_direct_debit else None
+        known_customer = PayAdvantageCustomer.query.filter_by(user_id=booking.customer_id).first() if wants_direct_debit else None
+        if known_customer:
+            steps['payadvantage_verify_customer'] = functools.partial(
+                pa_service.verify_customer, known_customer.customer_code, booking.customer.phone)
+        
+        results = flow.concurrently(steps, timeout=float(current_app.config.get('HANDOVER_STEP_TIMEOUT', 30)))
+        
+        for step, name in uploads:
+            # Save photo record to database
+            photo = BookingPhoto(
+                booking_id=booking_id,
+                photo_type='pickup',
+                photo_url=results[step],
+                description=name,
+                uploaded_by=current_user.id
+            )
+            db.session.add(photo)
         
         # 4. Set up direct debit if provided
-        direct_debit = data.get('direct_debit')
         authorization_url = None
         direct_debit_failed = False
         direct_debit_error = None
         
-        if direct_debit and (direct_debit.get('upfront_amount') or direct_debit.get('recurring_amount')):
-            # Require customer mobile number for electronic authorisation
-            if not (booking.customer and booking.customer.phone):
-                return jsonify({'success': False, 'message': 'Customer must have a mobile number to set up electronic direct debit authorisation.'})
+        if wants_direct_debit:
             try:
-                # Initialize PayAdvantage service
-                pa_service = PayAdvantageService()
-                
-                # Get or create customer (also syncs mobile)
-                pa_customer = pa_service.get_or_create_customer(booking.customer)
+                # Get or create customer (mobile already synced by the verification step)
+                with flow.step('payadvantage_customer'):
+                    pa_customer = pa_service.get_or_create_customer(
+                        booking.customer, verified=results.get('payadvantage_verify_customer'))
                 
                 # Create direct debit schedule
                 upfront_date = None
@@ -1451,18 +1430,19 @@ def complete_handover(booking_id):
                 if direct_debit.get('recurring_start_date'):
                     recurring_start = datetime.strptime(direct_debit['recurring_start_date'], '%Y-%m-%d').date()
                 
-                result = pa_service.create_direct_debit_schedule(
-                    booking_id=booking_id,
-                    customer_code=pa_customer.customer_code,
-                    description=direct_debit.get('description', f'Booking {booking.booking_number}'),
-                    upfront_amount=direct_debit.get('upfront_amount'),
-                    upfront_date=upfront_date,
-                    recurring_amount=direct_debit.get('recurring_amount'),
-                    recurring_start_date=recurring_start,
-                    frequency=direct_debit.get('frequency'),
-                    end_condition_amount=direct_debit.get('end_condition_amount'),
-                    reminder_days=2
-                )
+                with flow.step('payadvantage_schedule'):
+                    result = pa_service.create_direct_debit_schedule(
+                        booking_id=booking_id,
+                        customer_code=pa_customer.customer_code,
+                        description=direct_debit.get('description', f'Booking {booking.booking_number}'),
+                        upfront_amount=direct_debit.get('upfront_amount'),
+                        upfront_date=upfront_date,
+                        recurring_amount=direct_debit.get('recurring_amount'),
+                        recurring_start_date=recurring_start,
+                        frequency=direct_debit.get('frequency'),
+                        end_condition_amount=direct_debit.get('end_condition_amount'),
+                        reminder_days=2
+                    )
                 
                 booking.direct_debit_schedule_id = result['schedule_id']
                 authorization_url = result['authorization_url']
@@ -1488,13 +1468,15 @@ def complete_handover(booking_id):
         else:
             booking.admin_notes = handover_note
         
-        db.session.commit()
+        with flow.step('commit'):
+            db.session.commit()
         
         # 6. Schedule Xero invoice if direct debit is set up
         if direct_debit and direct_debit.get('recurring_amount'):
             from app.services.xero_scheduler import XeroInvoiceScheduler
-            scheduler = XeroInvoiceScheduler()
-            scheduler.schedule_recurring_invoices(booking_id)
+            with flow.step('xero_schedule'):
+                scheduler = XeroInvoiceScheduler()
+                scheduler.schedule_recurring_invoices(booking_id)
         
         response = {
             'success': True,
@@ -1505,12 +1487,15 @@ def complete_handover(booking_id):
             response['authorization_url'] = authorization_url
             response['message'] += '. Direct debit authorization required.'
         
+        outcome = 'completed'
         return jsonify(response)
         
     except Exception as e:
         db.session.rollback()
         print(f"Error in handover: {e}")
         return jsonify({'success': False, 'message': str(e)})
+    finally:
+        flow.finish(f'of booking {booking_id} {outcome}')
 
 @admin_bp.route('/maintenance/add-record', methods=['POST'])
 @admin_required
@@ -1692,6 +1677,63 @@ def settings():
                          xero_token=xero_token)
 
 
+@admin_bp.route('/settings/profiles')
+@admin_required
+def profiles():
+    """Index of stored request profiles (captured with ?_profile=1)."""
+    from app.utils.profiler import list_profiles, generate_profile_token, PROFILE_HEADER
+    
+    return render_template('admin/profiles.html',
+                         profiles=list_profiles(),
+                         profiler_enabled=current_app.config.get('PROFILER_ENABLED'),
+                         profile_header=PROFILE_HEADER,
+                         profile_token=generate_profile_token(current_user.id))
+
+
+@admin_bp.route('/settings/profiles/<profile_id>')
+@admin_required
+def view_profile(profile_id):
+    """Show a stored request profile."""
+    from flask import send_file, abort
+    from app.utils.profiler import get_profile, profile_file_path, render_profile_text
+    
+    summary = get_profile(profile_id)
+    if not summary:
+        abort(404)
+    if summary['engine'] == 'pyinstrument':
+        # pyinstrument output is a self-contained HTML flame view
+        return send_file(profile_file_path(summary), mimetype='text/html')
+    return render_template('admin/profile_detail.html',
+                         profile=summary,
+                         report=render_profile_text(summary))
+
+
+@admin_bp.route('/settings/profiles/<profile_id>/download')
+@admin_required
+def download_profile(profile_id):
+    """Download the raw profile output (.prof for snakeviz/flameprof, .html for pyinstrument)."""
+    from flask import send_file, abort
+    from app.utils.profiler import get_profile, profile_file_path
+    
+    summary = get_profile(profile_id)
+    if not summary:
+        abort(404)
+    return send_file(profile_file_path(summary), as_attachment=True, download_name=summary['filename'])
+
+
+@admin_bp.route('/settings/profiles/<profile_id>/delete', methods=['POST'])
+@admin_required
+def delete_profile(profile_id):
+    """Delete a stored request profile."""
+    from app.utils.profiler import delete_profile as _delete_profile
+    
+    if _delete_profile(profile_id):
+        flash('Profile deleted.', 'success')
+    else:
+        flash('Profile not found.', 'danger')
+    return redirect(url_for('admin.profiles'))
+
+
 @admin_bp.route('/xero-settings')
 @admin_required
 def xero_settings():
@@ -1,5 +1,6 @@
 from flask import Blueprint, jsonify, request
 from app import db
+from app.cache import cache
 from app.models import User, Car, Booking, Payment, Driver, BookingStatus
 from sqlalchemy import func
 from app.routes.auth import verify_token
@@ -45,6 +46,19 @@ def health():
     })
 
 
+@api_bp.route('/ready')
+def ready():
+    """Readiness probe; reports 503 until this worker has finished its warm-up."""
+    from app.utils.warmup import is_ready, warmup_state
+    state = warmup_state()
+    body = {
+        'status': 'ready' if is_ready() else 'warming_up',
+        'warmup_ms': state.get('duration_ms'),
+        'steps': {name: step.get('ok') for name, step in state.get('steps', {}).items()},
+    }
+    return jsonify(body), 200 if is_ready() else 503
+
+
 # User endpoints
 @api_bp.route('/users', methods=['GET'])
 @token_required
@@ -96,7 +110,11 @@ def get_cars():
     """Get all available cars."""
     category = request.args.get('category')
     available_only = request.args.get('available', 'true').lower() == 'true'
-    
+    return jsonify(_car_catalog(category, available_only))
+
+
+@cache.cached(ttl=600, tags=['fleet'])
+def _car_catalog(category, available_only):
     query = Car.query
     
     if category:
@@ -110,14 +128,15 @@ def get_cars():
         query = query.filter_by(status=CarStatus.AVAILABLE, is_active=True)
     
     cars = query.all()
-    return jsonify([car.to_dict() for car in cars])
+    return [car.to_dict() for car in cars]
 
 
 @api_bp.route('/cars/<int:id>', methods=['GET'])
 def get_car(id):
     """Get car by ID."""
-    car = Car.query.get_or_404(id)
-    return jsonify(car.to_dict())
+    data = cache.get_or_set(f'api:car:{id}', lambda: Car.query.get_or_404(id).to_dict(),
+                            ttl=600, tags=[f'car:{id}'])
+    return jsonify(data)
 
 
 @api_bp.route('/cars/<int:id>/availability', methods=['GET'])
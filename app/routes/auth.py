@@ -4,7 +4,6 @@ from werkzeug.security import generate_password_hash
 from app import db
 from app.models import User, Role, BookingStatus
 from app.utils.decorators import anonymous_required
-import jwt
 from datetime import datetime, timedelta
 from config import Config
 
@@ -209,6 +208,7 @@ def edit_profile():
 
 def generate_token(user):
     """Generate JWT token for API authentication."""
+    import jwt
     payload = {
         'user_id': user.id,
         'email': user.email,
@@ -220,6 +220,7 @@ def generate_token(user):
 
 def verify_token(token):
     """Verify JWT token."""
+    import jwt
     try:
         payload = jwt.decode(token, Config.JWT_SECRET_KEY, algorithms=['HS256'])
         return payload
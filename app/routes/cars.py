@@ -49,29 +49,33 @@ def index():
             )
         )
     
-    cars = query.order_by(Car.created_at.desc()).paginate(
-        page=page, per_page=12, error_out=False)
+    def load_fleet():
+        # Called from inside the template's cached listing fragment, so a
+        # cache hit skips these queries entirely
+        cars = query.order_by(Car.created_at.desc()).paginate(
+            page=page, per_page=12, error_out=False)
 
-    # Compute next availability date for booked cars on this page
-    car_ids = [car.id for car in cars.items]
-    next_available_map = {}
-    if car_ids:
-        # Treat pending as blocking availability for display purposes
-        active_statuses = [BookingStatus.PENDING, BookingStatus.CONFIRMED, BookingStatus.IN_PROGRESS]
-        active_bookings = (
-            Booking.query
-            .filter(
-                Booking.car_id.in_(car_ids),
-                Booking.status.in_(active_statuses),
-                Booking.return_date >= datetime.utcnow()
+        # Compute next availability date for booked cars on this page
+        car_ids = [car.id for car in cars.items]
+        next_available_map = {}
+        if car_ids:
+            # Treat pending as blocking availability for display purposes
+            active_statuses = [BookingStatus.PENDING, BookingStatus.CONFIRMED, BookingStatus.IN_PROGRESS]
+            active_bookings = (
+                Booking.query
+                .filter(
+                    Booking.car_id.in_(car_ids),
+                    Booking.status.in_(active_statuses),
+                    Booking.return_date >= datetime.utcnow()
+                )
+                .order_by(Booking.return_date.asc())
+                .all()
             )
-            .order_by(Booking.return_date.asc())
-            .all()
-        )
-        for booking in active_bookings:
-            # Keep the earliest return_date per car
-            if booking.car_id not in next_available_map:
-                next_available_map[booking.car_id] = booking.return_date
+            for booking in active_bookings:
+                # Keep the earliest return_date per car
+                if booking.car_id not in next_available_map:
+                    next_available_map[booking.car_id] = booking.return_date
+        return cars, next_available_map
     
     # Check if user has complete profile (for booking eligibility)
     has_complete_profile = False
@@ -82,12 +86,11 @@ def index():
             missing_details = current_user.get_missing_details()
     
     return render_template('pages/cars/index.html', 
-                         cars=cars,
+                         load_fleet=load_fleet,
                          categories=CarCategory,
                          statuses=CarStatus,
                          has_complete_profile=has_complete_profile,
-                         missing_details=missing_details,
-                         next_available_map=next_available_map)
+                         missing_details=missing_details)
 
 
 @bp.route('/<int:id>')
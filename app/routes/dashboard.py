@@ -3,6 +3,7 @@ from flask_login import login_required, current_user
 from app import db
 from app.models import User, Car, Booking, Payment, Driver, BookingStatus, PaymentStatus, CarStatus
 from app.utils.decorators import admin_required, manager_required
+from app.utils.replica import use_replica
 from sqlalchemy import func
 from datetime import datetime, timedelta
 
@@ -33,9 +34,12 @@ def index():
     revenue_data = []
     for i in range(7):
         date = datetime.utcnow() - timedelta(days=i)
+        day_start = datetime.combine(date.date(), datetime.min.time())
+        # Range filters (not func.date()) so ix_payments_status_created applies
         daily_revenue = db.session.query(func.sum(Payment.amount)).filter(
-            func.date(Payment.created_at) == date.date(),
-            Payment.status == PaymentStatus.COMPLETED
+            Payment.status == PaymentStatus.COMPLETED,
+            Payment.created_at >= day_start,
+            Payment.created_at < day_start + timedelta(days=1)
         ).scalar() or 0
         revenue_data.append({
             'date': date.strftime('%Y-%m-%d'),
@@ -47,8 +51,10 @@ def index():
     booking_data = []
     for i in range(7):
         date = datetime.utcnow() - timedelta(days=i)
+        day_start = datetime.combine(date.date(), datetime.min.time())
         daily_bookings = Booking.query.filter(
-            func.date(Booking.created_at) == date.date()
+            Booking.created_at >= day_start,
+            Booking.created_at < day_start + timedelta(days=1)
         ).count()
         booking_data.append({
             'date': date.strftime('%Y-%m-%d'),
@@ -76,6 +82,7 @@ def payments_history():
 @bp.route('/analytics')
 @login_required
 @manager_required
+@use_replica
 def analytics():
     """Analytics and reports page."""
     from app.models import CarCategory, BookingStatus
@@ -117,10 +124,12 @@ def analytics():
     monthly_revenue = []
     for i in range(12):
         date = datetime.utcnow() - timedelta(days=30*i)
+        month_start = datetime(date.year, date.month, 1)
+        next_month = datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
         month_revenue = db.session.query(func.sum(Payment.amount)).filter(
-            func.extract('year', Payment.created_at) == date.year,
-            func.extract('month', Payment.created_at) == date.month,
-            Payment.status == PaymentStatus.COMPLETED
+            Payment.status == PaymentStatus.COMPLETED,
+            Payment.created_at >= month_start,
+            Payment.created_at < next_month
         ).scalar() or 0
         monthly_revenue.append({
             'month': date.strftime('%B %Y'),
@@ -1,5 +1,5 @@
 from flask import Blueprint, render_template, jsonify, current_app
-from app.models import Car, Booking, User, Role
+from app.models import Car
 from sqlalchemy import func
 from app import db
 
@@ -10,31 +10,17 @@ bp = Blueprint('main', __name__)
 def index():
     """Home page."""
     try:
-        # Get featured cars
-        featured_cars = Car.query.filter_by(is_active=True).limit(6).all()
-        
-        # Get statistics with proper enum usage
-        stats = {
-            'total_cars': Car.query.filter_by(is_active=True).count(),
-            'total_bookings': Booking.query.count(),
-            'happy_customers': User.query.filter_by(role=Role.CUSTOMER).count(),
-            'years_experience': 10
-        }
+        # Left as an unexecuted query: it only runs when the cached
+        # featured-cars fragment in the template is rebuilt
+        featured_cars = Car.query.filter_by(is_active=True).limit(6)
         
         return render_template('pages/home.html', 
-                             featured_cars=featured_cars,
-                             stats=stats)
+                             featured_cars=featured_cars)
     except Exception as e:
         current_app.logger.error(f"Error loading home page: {str(e)}")
         # Return with default values if there's an error
         return render_template('pages/home.html', 
-                             featured_cars=[],
-                             stats={
-                                 'total_cars': 0,
-                                 'total_bookings': 0,
-                                 'happy_customers': 0,
-                                 'years_experience': 10
-                             })
+                             featured_cars=[])
 
 
 @bp.route('/about')
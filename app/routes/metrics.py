@@ -0,0 +1,21 @@
+import hmac
+
+from flask import Blueprint, Response, current_app, request
+
+from app.utils.metrics import metrics
+
+metrics_bp = Blueprint('metrics', __name__)
+
+
+@metrics_bp.route('/metrics')
+def prometheus_metrics():
+    """Prometheus text exposition of metrics aggregated across all workers.
+
+    When METRICS_TOKEN is configured the scraper must send it as a bearer token.
+    """
+    expected = current_app.config.get('METRICS_TOKEN')
+    if expected:
+        provided = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(provided, f'Bearer {expected}'):
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
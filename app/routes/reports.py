@@ -2,7 +2,9 @@ from flask import Blueprint, render_template, request, send_file, jsonify, curre
 from flask_login import login_required
 from app import db
 from app.models import Booking, Payment, Car, User, Driver, Role, BookingStatus, PaymentStatus
+from app.services.cash_flow import PERIODS, cash_flow_forecast
 from app.utils.decorators import manager_required
+from app.utils.replica import use_replica
 from datetime import datetime, timedelta
 from sqlalchemy import func
 import io
@@ -22,6 +24,7 @@ def index():
 @bp.route('/revenue')
 @login_required
 @manager_required
+@use_replica
 def revenue():
     """Revenue report."""
     # Get date range from query params
@@ -78,6 +81,7 @@ def revenue():
 @bp.route('/bookings')
 @login_required
 @manager_required
+@use_replica
 def bookings():
     """Bookings report."""
     # Get filters
@@ -127,6 +131,7 @@ def bookings():
 @bp.route('/fleet-utilization')
 @login_required
 @manager_required
+@use_replica
 def fleet_utilization():
     """Fleet utilization report."""
     # Get all cars with their booking statistics
@@ -174,6 +179,7 @@ def fleet_utilization():
 @bp.route('/customers')
 @login_required
 @manager_required
+@use_replica
 def customers():
     """Customer analytics report."""
     try:
@@ -236,9 +242,45 @@ def customers():
                              retention_rate=0)
 
 
+def _forecast_args():
+    """Date range and period of a cash-flow forecast request (the next 13 weeks by week by default)."""
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    start_date = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else datetime.utcnow().date()
+    end_date = datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else start_date + timedelta(weeks=13)
+    return start_date, end_date, request.args.get('period', 'week')
+
+
+@bp.route('/cash-flow')
+@login_required
+@manager_required
+@use_replica
+def cash_flow():
+    """Cash-flow forecast of projected direct debit collections."""
+    try:
+        start_date, end_date, period = _forecast_args()
+    except ValueError:
+        return jsonify({'error': 'Dates must be YYYY-MM-DD'}), 400
+    if period not in PERIODS:
+        return jsonify({'error': f"period must be one of {', '.join(PERIODS)}"}), 400
+    
+    forecast = cash_flow_forecast(start_date, end_date, period)
+    return jsonify({
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'period': period,
+        'total_amount': round(sum(row['amount'] for row in forecast), 2),
+        'periods': [
+            {**row, 'period_start': row['period_start'].isoformat(), 'period_end': row['period_end'].isoformat()}
+            for row in forecast
+        ],
+    })
+
+
 @bp.route('/export/<report_type>')
 @login_required
 @manager_required
+@use_replica
 def export(report_type):
     """Export report data to CSV."""
     output = io.StringIO()
@@ -294,6 +336,24 @@ def export(report_type):
                 car.daily_rate
             ])
     
+    elif report_type == 'cash-flow':
+        # Export the cash-flow forecast
+        try:
+            start_date, end_date, period = _forecast_args()
+        except ValueError:
+            return "Dates must be YYYY-MM-DD", 400
+        if period not in PERIODS:
+            return "Invalid period", 400
+        writer.writerow(['Period Start', 'Period End', 'Installments', 'Projected Amount'])
+        
+        for row in cash_flow_forecast(start_date, end_date, period):
+            writer.writerow([
+                row['period_start'].isoformat(),
+                row['period_end'].isoformat(),
+                row['installments'],
+                row['amount']
+            ])
+    
     else:
         return "Invalid report type", 404
     
@@ -2,8 +2,9 @@ from flask import Blueprint, request, jsonify, session, redirect, url_for, flash
 from flask_login import login_required, current_user
 from datetime import datetime
 from app import db
-from app.models import XeroToken, Booking, User, Role
-from app.utils.xero import XeroClient
+from app.models import XeroToken, XeroOutbox, Booking, User, Role
+from app.services.xero_outbox import enqueue_invoice
+from app.utils.xero import XeroClient, invalidate_xero_token_cache
 import logging
 
 logger = logging.getLogger(__name__)
@@ -90,6 +91,7 @@ def callback():
             db.session.add(new_token)
         
         db.session.commit()
+        invalidate_xero_token_cache()
         
         # Clean up session
         session.pop('xero_oauth_state', None)
@@ -223,25 +225,16 @@ def send_invoice():
         if isinstance(due_date, str):
             due_date = datetime.strptime(due_date, '%Y-%m-%d')
         
-        # Create and send invoice
-        client = XeroClient()
-        result = client.create_and_send_invoice(
-            booking_data=booking_data,
-            invoice_amount=float(invoice_amount),
-            due_date=due_date
-        )
-        
-        # Store invoice reference in booking (you might want to add an invoice_id field to Booking model)
-        if result.get('invoice'):
-            booking.admin_notes = (booking.admin_notes or '') + f"\nXero Invoice: {result['invoice'].get('InvoiceNumber')} (ID: {result['invoice'].get('InvoiceID')})"
-            db.session.commit()
-        
+        # Xero is called by the outbox worker; the page polls status_url for the result
+        entry = enqueue_invoice(booking, booking_data, float(invoice_amount), due_date,
+                                requested_by_id=current_user.id)
         return jsonify({
             'success': True,
-            'message': 'Invoice sent successfully',
-            'invoice_number': result.get('invoice', {}).get('InvoiceNumber'),
-            'invoice_id': result.get('invoice', {}).get('InvoiceID')
-        })
+            'queued': True,
+            'outbox_id': entry.id,
+            'status_url': url_for('xero.outbox_status', entry_id=entry.id),
+            'message': 'Invoice queued for sending'
+        }), 202
         
     except Exception as e:
         logger.error(f"Failed to send invoice: {str(e)}")
@@ -251,6 +244,19 @@ def send_invoice():
         }), 500
 
 
+@xero_bp.route('/outbox/<int:entry_id>', methods=['GET'])
+@login_required
+def outbox_status(entry_id):
+    """Status of a queued Xero operation, polled by the send-invoice pages."""
+    if current_user.role != Role.ADMIN:
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    entry = db.session.get(XeroOutbox, entry_id)
+    if entry is None:
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify(entry.to_dict())
+
+
 @xero_bp.route('/test-connection', methods=['GET'])
 @login_required
 def test_connection():
@@ -277,8 +283,9 @@ def test_connection():
             'Accept': 'application/json'
         }
         
-        import requests
-        response = requests.get(
+        from app.utils.xero import xero_request
+        response = xero_request(
+            'GET',
             f"{client.XERO_API_URL}/Organisation",
             headers=headers
         )
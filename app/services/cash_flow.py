@@ -0,0 +1,199 @@
+"""Projected direct debit installments and the cash-flow forecast built on them.
+
+Every active schedule is expanded into the payments it is expected to collect:
+the upfront payment, then the recurring payments by frequency until their total
+reaches ``end_condition_amount`` (the last one covering what is left), or up to
+``CASH_FLOW_HORIZON_DAYS`` ahead for schedules without an end amount. Recurring
+dates are generated as whole NumPy ``datetime64`` arrays (NumPy is pinned in
+``requirements.txt``). Should it fail to import, they are generated one at a
+time with :meth:`~app.models.DirectDebitSchedule.due_date_on_or_after`
+instead; ``test_cash_flow.py`` checks both give the same dates.
+
+The projections live in ``projected_installments``. ``flask cashflow-project``
+(run hourly by ``scheduled_tasks.py``) only re-projects schedules updated since
+the ``cash_flow_projection`` checkpoint, plus the open-ended ones once a day as
+the horizon moves; ``--full`` rebuilds the table. The forecast report
+(``/reports/cash-flow``) sums the table by week or month.
+"""
+
+import math
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, func, insert, or_, select
+
+from app import db
+from app.models import DirectDebitSchedule, ProjectedInstallment, SyncCheckpoint
+
+PROJECTION_CHECKPOINT = 'cash_flow_projection'
+PERIODS = ('week', 'month')
+
+# Schedule ids per DELETE ... IN, to stay clear of bound parameter limits
+_DELETE_CHUNK = 500
+
+
+def _numpy():
+    """NumPy, or None if it can't be imported; imported on first use so app startup doesn't pay for it."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def project_schedule(schedule: DirectDebitSchedule, horizon_end: date) -> List[Tuple[date, float, str]]:
+    """``(due_date, amount, kind)`` of every payment ``schedule`` is expected to collect."""
+    rows = []
+    if schedule.upfront_amount and schedule.upfront_date:
+        rows.append((schedule.upfront_date, schedule.upfront_amount, 'upfront'))
+    if schedule.recurring_amount and schedule.recurring_amount > 0 and schedule.recurring_start_date and (
+            schedule.frequency in DirectDebitSchedule.PERIOD_DAYS or schedule.frequency == 'monthly'):
+        count = None
+        if schedule.end_condition_amount:
+            count = max(math.ceil(schedule.end_condition_amount / schedule.recurring_amount - 1e-9), 0)
+        numpy = _numpy()
+        if numpy is not None:
+            dates, amounts = _recurring_numpy(numpy, schedule, count, horizon_end)
+        else:
+            dates, amounts = _recurring(schedule, count, horizon_end)
+        rows.extend((due_date, amount, 'recurring') for due_date, amount in zip(dates, amounts))
+    return rows
+
+
+def _recurring_numpy(np, schedule: DirectDebitSchedule, count: Optional[int],
+                     horizon_end: date) -> Tuple[List[date], List[float]]:
+    start = schedule.recurring_start_date
+    period = DirectDebitSchedule.PERIOD_DAYS.get(schedule.frequency)
+    if period:
+        n = count if count is not None else max((horizon_end - start).days // period + 1, 0)
+        dates = np.datetime64(start, 'D') + np.arange(n) * np.timedelta64(period, 'D')
+    else:
+        # Months without the start day (e.g. the 31st) have no payment; at most 5 in 12 are skipped
+        if count is not None:
+            months = count * 12 // 7 + 2
+        else:
+            months = max((horizon_end.year - start.year) * 12 + horizon_end.month - start.month + 1, 0)
+        month_starts = np.datetime64(start, 'M') + np.arange(months)
+        dates = month_starts.astype('datetime64[D]') + (start.day - 1)
+        dates = dates[dates.astype('datetime64[M]') == month_starts]
+        if count is not None:
+            dates = dates[:count]
+    if count is None:
+        dates = dates[dates <= np.datetime64(horizon_end, 'D')]
+        amounts = np.full(len(dates), schedule.recurring_amount)
+    else:
+        amounts = np.minimum(schedule.recurring_amount,
+                             schedule.end_condition_amount - schedule.recurring_amount * np.arange(len(dates)))
+    return dates.astype(object).tolist(), amounts.tolist()
+
+
+def _recurring(schedule: DirectDebitSchedule, count: Optional[int],
+               horizon_end: date) -> Tuple[List[date], List[float]]:
+    dates = []
+    day = schedule.due_date_on_or_after(schedule.recurring_start_date)
+    while day is not None and (len(dates) < count if count is not None else day <= horizon_end):
+        dates.append(day)
+        day = schedule.due_date_on_or_after(day + timedelta(days=1))
+    if count is None:
+        return dates, [schedule.recurring_amount] * len(dates)
+    return dates, [min(schedule.recurring_amount,
+                       schedule.end_condition_amount - schedule.recurring_amount * i) for i in range(len(dates))]
+
+
+def refresh_projections(full: bool = False) -> Dict[str, int]:
+    """Re-project the schedules changed since the last refresh, or every schedule with ``full``."""
+    started = datetime.utcnow()
+    horizon_end = date.today() + timedelta(days=int(current_app.config.get('CASH_FLOW_HORIZON_DAYS', 365)))
+    checkpoint = SyncCheckpoint.load(PROJECTION_CHECKPOINT)
+    full = full or checkpoint.watermark is None
+
+    query = DirectDebitSchedule.query
+    if not full:
+        changed = DirectDebitSchedule.updated_at > checkpoint.watermark
+        if (checkpoint.cursor or {}).get('horizon') != horizon_end.isoformat():
+            # The horizon moved: extend the schedules without an end amount
+            changed = or_(changed, and_(
+                DirectDebitSchedule.status == 'active',
+                or_(DirectDebitSchedule.end_condition_amount.is_(None),
+                    DirectDebitSchedule.end_condition_amount == 0),
+            ))
+        query = query.filter(changed)
+    schedules = query.all()
+
+    if full:
+        removed = ProjectedInstallment.query.delete(synchronize_session=False)
+    else:
+        schedule_ids = [schedule.schedule_id for schedule in schedules]
+        removed = 0
+        for start in range(0, len(schedule_ids), _DELETE_CHUNK):
+            removed += ProjectedInstallment.query.filter(
+                ProjectedInstallment.schedule_id.in_(schedule_ids[start:start + _DELETE_CHUNK])
+            ).delete(synchronize_session=False)
+
+    rows = [
+        {'schedule_id': schedule.schedule_id, 'booking_id': schedule.booking_id, 'due_date': due_date,
+         'amount': amount, 'kind': kind, 'projected_at': started}
+        for schedule in schedules if schedule.status == 'active'
+        for due_date, amount, kind in project_schedule(schedule, horizon_end)
+    ]
+    if rows:
+        db.session.execute(insert(ProjectedInstallment), rows)
+
+    # Updates made while this ran are newer than ``started`` and picked up next time
+    checkpoint.watermark = started
+    checkpoint.cursor = {'horizon': horizon_end.isoformat()}
+    db.session.commit()
+    return {'schedules': len(schedules), 'installments': len(rows), 'removed': removed, 'full': full}
+
+
+def _period_start(day: date, period: str) -> date:
+    if period == 'month':
+        return day.replace(day=1)
+    return day - timedelta(days=day.weekday())
+
+
+def _period_end(start: date, period: str) -> date:
+    if period == 'month':
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    return start + timedelta(days=6)
+
+
+def cash_flow_forecast(date_from: date, date_to: date, period: str = 'week') -> List[Dict[str, Any]]:
+    """Projected direct debit collections due ``date_from``..``date_to``, per week (from Monday) or month."""
+    if period not in PERIODS:
+        raise ValueError(f"Unknown forecast period: {period}")
+    by_day = db.session.execute(
+        select(ProjectedInstallment.due_date, func.sum(ProjectedInstallment.amount), func.count(ProjectedInstallment.id))
+        .where(ProjectedInstallment.due_date >= date_from, ProjectedInstallment.due_date <= date_to)
+        .group_by(ProjectedInstallment.due_date)
+        .order_by(ProjectedInstallment.due_date)
+    ).all()
+
+    periods = {}
+    for due_date, amount, installments in by_day:
+        start = _period_start(due_date, period)
+        row = periods.setdefault(start, {'period_start': start, 'period_end': _period_end(start, period),
+                                         'amount': 0.0, 'installments': 0})
+        row['amount'] += amount
+        row['installments'] += installments
+    for row in periods.values():
+        row['amount'] = round(row['amount'], 2)
+    return list(periods.values())
+
+
+@click.command('cashflow-project')
+@click.option('--full', is_flag=True, help='Re-project every schedule instead of only the changed ones.')
+@with_appcontext
+def cashflow_project_command(full):
+    """Refresh the projected direct debit installments behind the cash-flow forecast."""
+    summary = refresh_projections(full=full)
+    click.echo(f"Projected {summary['installments']} installments for {summary['schedules']} schedules "
+               f"({'full rebuild' if summary['full'] else 'changed schedules'}, {summary['removed']} replaced)")
+
+
+def init_cash_flow(app):
+    """Register ``flask cashflow-project``."""
+    app.cli.add_command(cashflow_project_command)
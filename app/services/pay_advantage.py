@@ -1,36 +1,192 @@
+import base64
+import hashlib
+import json
 import os
 import re
-import requests
+import threading
+import time
 from datetime import datetime, date
-from typing import Dict, Optional, Any
+from typing import Dict, List, Optional, Any
+from flask import current_app
+from sqlalchemy import insert, or_, update
 from app import db
+from app.cache import cache
 from app.models import PayAdvantageCustomer, DirectDebitSchedule, DirectDebitInstallment, User
+from app.utils.metrics import observe_outbound
+
+# Keep-alive session shared by every PayAdvantage call in this process (see get_pay_advantage_session)
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+# Auth endpoint that last worked per API base URL, so re-authentication skips the failing one
+_auth_urls = {}
+
+# A cached token is replaced this many seconds (at most half its lifetime) before it expires
+_TOKEN_EXPIRY_MARGIN = 60
+
+
+def get_pay_advantage_session():
+    """Pooled ``requests.Session`` for PayAdvantage, created once per process (after fork)."""
+    global _session, _session_pid
+    if _session is not None and _session_pid == os.getpid():
+        return _session
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            # Imported on first call; requests is slow to import and most processes never call out
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            pool_size = int(current_app.config.get('PAY_ADVANTAGE_HTTP_POOL_SIZE', 10))
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session, _session_pid = session, os.getpid()
+    return _session
+
+
+def _request(method: str, url: str, **kwargs):
+    """Issue an HTTP request to PayAdvantage with timeouts and record its latency."""
+    config = current_app.config
+    kwargs.setdefault('timeout', (float(config.get('PAY_ADVANTAGE_CONNECT_TIMEOUT', 3.05)),
+                                  float(config.get('PAY_ADVANTAGE_READ_TIMEOUT', 20))))
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        response = get_pay_advantage_session().request(method, url, **kwargs)
+        status = response.status_code
+        return response
+    finally:
+        observe_outbound('payadvantage', method, status, time.perf_counter() - start)
+
+
+def _token_expiry(data: Dict[str, Any], token: str) -> float:
+    """Epoch seconds at which ``token`` expires, from the auth response or the JWT itself."""
+    expires_in = data.get('expires_in') or data.get('expiresIn')
+    if expires_in:
+        try:
+            return time.time() + float(expires_in)
+        except (TypeError, ValueError):
+            pass
+    expires_at = data.get('expires_at') or data.get('expiresAt') or data.get('expiry')
+    if expires_at:
+        try:
+            return datetime.fromisoformat(str(expires_at).replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            pass
+    parts = token.split('.')
+    if len(parts) == 3:
+        try:
+            claims = json.loads(base64.urlsafe_b64decode(parts[1] + '=' * (-len(parts[1]) % 4)))
+            if claims.get('exp'):
+                return float(claims['exp'])
+        except (ValueError, TypeError):
+            pass
+    return time.time() + int(current_app.config.get('PAY_ADVANTAGE_TOKEN_TTL', 3600))
+
+
+# Installment columns written from webhook events
+_INSTALLMENT_COLUMNS = ('schedule_id', 'booking_id', 'external_payment_id', 'due_date', 'due_amount',
+                        'paid_date', 'paid_amount', 'status', 'raw_payload')
+
+
+def installment_fields(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Installment fields of a webhook event, read from whichever key variant it uses."""
+    def _parse_date(value: Optional[str]):
+        try:
+            if not value:
+                return None
+            return date.fromisoformat(value[:10])
+        except Exception:
+            return None
+
+    def _parse_amount(v: Any):
+        try:
+            return float(v) if v is not None else None
+        except Exception:
+            return None
+
+    due_date = _parse_date(payload.get('dueDate') or payload.get('DueDate') or payload.get('date'))
+    paid_date = _parse_date(payload.get('paidDate') or payload.get('PaidDate'))
+    # Fallback: if due_date missing but paid_date present, use paid_date to satisfy NOT NULL
+    if not due_date and paid_date:
+        due_date = paid_date
+    paid_amount = _parse_amount(payload.get('paidAmount') or payload.get('PaidAmount'))
+
+    status = (payload.get('status') or payload.get('Status') or '').lower() or 'pending'
+    if paid_date and (paid_amount or 0) > 0:
+        status = 'completed'
+
+    return {
+        'schedule_id': payload.get('scheduleId') or payload.get('ScheduleId') or payload.get('schedule_id'),
+        'external_payment_id': payload.get('paymentId') or payload.get('id') or payload.get('PaymentId'),
+        # We attempt to carry booking_id either explicitly or by schedule lookup
+        'booking_id': payload.get('bookingId') or payload.get('booking_id'),
+        'due_date': due_date,
+        'due_amount': _parse_amount(payload.get('dueAmount') or payload.get('amount') or payload.get('DueAmount')),
+        'paid_date': paid_date,
+        'paid_amount': paid_amount,
+        'status': status,
+    }
+
+
+def _dialect_insert(dialect: str):
+    """``insert()`` with ``on_conflict_do_update`` for ``dialect`` (postgresql or sqlite)."""
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert
 
 
 class PayAdvantageService:
     """Service for interacting with PayAdvantage API."""
     
+    PAYMENTS_PAGE_SIZE = 100
+    
     def __init__(self):
         self.base_url = os.getenv('PAY_ADVANTAGE_API_URL', 'https://api.payadvantage.com.au')
         self.username = os.getenv('PAY_ADVANTAGE_USERNAME')
         self.password = os.getenv('PAY_ADVANTAGE_PASSWORD')
-        self.token = None
-        self.token_expiry = None
     
     def _get_token(self) -> str:
-        """Get or refresh authentication token."""
-        if self.token and self.token_expiry and datetime.utcnow() < self.token_expiry:
-            return self.token
+        """Access token shared by every worker until shortly before it expires.
         
-        # Exchange username/password for token
+        Only one thread (and, with a shared cache backend, one worker)
+        authenticates when the token is missing; the rest wait for its result.
+        """
+        key = self._token_cache_key()
+        ttl = int(current_app.config.get('PAY_ADVANTAGE_TOKEN_TTL', 3600))
+        entry = cache.get_or_set(key, self._authenticate, ttl=ttl)
+        if entry['refresh_at'] <= time.time():
+            # The API issued a shorter-lived token than the cache entry
+            cache.delete(key)
+            entry = cache.get_or_set(key, self._authenticate, ttl=ttl)
+        return entry['token']
+    
+    def _invalidate_token(self):
+        cache.delete(self._token_cache_key())
+    
+    def _token_cache_key(self) -> str:
+        account = hashlib.sha256(f'{self.base_url}|{self.username}'.encode()).hexdigest()[:16]
+        return f'payadvantage:token:{account}'
+    
+    def _authenticate(self) -> Dict[str, Any]:
+        """Exchange username/password for a token; returns ``{'token', 'expires_at', 'refresh_at'}``."""
         # Try /v3/authenticate then fall back to /v3/token, accept 'token' or 'access_token'
         endpoints_to_try = [
             f"{self.base_url}/v3/authenticate",
             f"{self.base_url}/v3/token"
         ]
+        known = _auth_urls.get(self.base_url)
+        if known in endpoints_to_try:
+            endpoints_to_try.remove(known)
+            endpoints_to_try.insert(0, known)
         last_error_text = None
         for auth_url in endpoints_to_try:
-            response = requests.post(
+            response = _request(
+                'POST',
                 auth_url,
                 json={
                     "username": self.username,
@@ -41,11 +197,11 @@ class PayAdvantageService:
                 data = response.json() or {}
                 token_value = data.get('token') or data.get('access_token') or data.get('accessToken')
                 if token_value:
-                    self.token = token_value
-                    # Assume token expires in 1 hour (adjust based on actual API)
-                    from datetime import timedelta
-                    self.token_expiry = datetime.utcnow() + timedelta(hours=1)
-                    return self.token
+                    _auth_urls[self.base_url] = auth_url
+                    now = time.time()
+                    expires_at = _token_expiry(data, token_value)
+                    margin = min(_TOKEN_EXPIRY_MARGIN, max(expires_at - now, 0) / 2)
+                    return {'token': token_value, 'expires_at': expires_at, 'refresh_at': expires_at - margin}
                 else:
                     last_error_text = f"Auth OK but token missing in response keys: {list(data.keys())}"
             else:
@@ -88,58 +244,90 @@ class PayAdvantageService:
     
     def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None) -> Dict:
         """Make authenticated request to PayAdvantage API."""
-        token = self._get_token()
-        headers = {
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json'
-        }
-        
         url = f"{self.base_url}{endpoint}"
         
-        if method == 'GET':
-            response = requests.get(url, headers=headers, params=data)
-        elif method == 'POST':
-            response = requests.post(url, headers=headers, json=data)
-        elif method == 'PUT':
-            response = requests.put(url, headers=headers, json=data)
-        else:
-            raise ValueError(f"Unsupported method: {method}")
+        for attempt in range(2):
+            token = self._get_token()
+            headers = {
+                'Authorization': f'Bearer {token}',
+                'Content-Type': 'application/json'
+            }
+            
+            if method == 'GET':
+                response = _request('GET', url, headers=headers, params=data)
+            elif method == 'POST':
+                response = _request('POST', url, headers=headers, json=data)
+            elif method == 'PUT':
+                response = _request('PUT', url, headers=headers, json=data)
+            else:
+                raise ValueError(f"Unsupported method: {method}")
+            
+            # Revoked or expired early: drop the shared token and authenticate once more
+            if response.status_code != 401 or attempt:
+                break
+            self._invalidate_token()
         
         if response.status_code in [200, 201]:
             return response.json()
         else:
             raise Exception(f"PayAdvantage API error: {response.status_code} - {response.text}")
     
-    def get_or_create_customer(self, user: User) -> PayAdvantageCustomer:
-        """Get existing or create new PayAdvantage customer."""
+    def get_payments(self, date_from: date, date_to: date, page: int = 1) -> List[Dict[str, Any]]:
+        """One page of up to ``PAYMENTS_PAGE_SIZE`` payments dated ``date_from``..``date_to``, oldest first."""
+        response = self._make_request('GET', '/v3/payments', {
+            'dateFrom': date_from.isoformat(),
+            'dateTo': date_to.isoformat(),
+            'page': page,
+            'pageSize': self.PAYMENTS_PAGE_SIZE,
+            'orderBy': 'date'
+        })
+        if isinstance(response, list):
+            return response
+        return response.get('records') or response.get('Records') or response.get('items') or []
+    
+    def verify_customer(self, customer_code: str, phone: Optional[str]) -> bool:
+        """Check the customer still exists in PayAdvantage and sync its mobile if missing/outdated.
+        
+        Makes API calls only (no database access), so it can run off the request thread.
+        """
+        try:
+            remote = self._make_request('GET', f'/v3/customers/{customer_code}')
+        except Exception:
+            return False
+        # Ensure mobile exists remotely if we have one locally
+        normalized_mobile = self._normalize_mobile(phone)
+        remote_mobile = (
+            remote.get('Mobile')
+            or remote.get('mobile')
+            or remote.get('mobileNumber')
+            or remote.get('MobileNumber')
+        )
+        if normalized_mobile and (not remote_mobile or self._normalize_mobile(remote_mobile) != normalized_mobile):
+            try:
+                self._make_request('PUT', f"/v3/customers/{customer_code}", {
+                    "Mobile": normalized_mobile
+                })
+            except Exception as update_err:
+                # Non-fatal: log and continue
+                print(f"PayAdvantage: failed to update customer mobile: {update_err}")
+        return True
+    
+    def get_or_create_customer(self, user: User, verified: Optional[bool] = None) -> PayAdvantageCustomer:
+        """Get existing or create new PayAdvantage customer.
+        
+        Pass ``verified`` when :meth:`verify_customer` already ran for the stored customer.
+        """
         # Check if customer already exists in our database
         pa_customer = PayAdvantageCustomer.query.filter_by(user_id=user.id).first()
         
         if pa_customer:
-            # Verify customer still exists in PayAdvantage and update mobile if missing/outdated
-            try:
-                remote = self._make_request('GET', f'/v3/customers/{pa_customer.customer_code}')
-                # Ensure mobile exists remotely if we have one locally
-                normalized_mobile = self._normalize_mobile(user.phone)
-                remote_mobile = (
-                    remote.get('Mobile')
-                    or remote.get('mobile')
-                    or remote.get('mobileNumber')
-                    or remote.get('MobileNumber')
-                )
-                if normalized_mobile and (not remote_mobile or self._normalize_mobile(remote_mobile) != normalized_mobile):
-                    try:
-                        self._make_request('PUT', f"/v3/customers/{pa_customer.customer_code}", {
-                            "Mobile": normalized_mobile
-                        })
-                    except Exception as update_err:
-                        # Non-fatal: log and continue
-                        print(f"PayAdvantage: failed to update customer mobile: {update_err}")
+            if verified is None:
+                verified = self.verify_customer(pa_customer.customer_code, user.phone)
+            if verified:
                 return pa_customer
-            except:
-                # Customer doesn't exist in PayAdvantage, remove from our DB
-                db.session.delete(pa_customer)
-                db.session.commit()
+            # Customer doesn't exist in PayAdvantage, remove from our DB
+            db.session.delete(pa_customer)
+            db.session.commit()
         
         # Create new customer in PayAdvantage (prefer API-conformant payload)
         normalized_mobile = self._normalize_mobile(user.phone)
@@ -304,14 +492,11 @@ class PayAdvantageService:
         - paidAmount / PaidAmount
         - status
         """
-        schedule_id = (
-            payload.get('scheduleId') or payload.get('ScheduleId') or payload.get('schedule_id')
-        )
-        external_payment_id = (
-            payload.get('paymentId') or payload.get('id') or payload.get('PaymentId')
-        )
-        # We attempt to carry booking_id either explicitly or by schedule lookup
-        booking_id = payload.get('bookingId') or payload.get('booking_id')
+        fields = installment_fields(payload)
+        schedule_id = fields['schedule_id']
+        external_payment_id = fields['external_payment_id']
+        booking_id = fields['booking_id']
+        due_date = fields['due_date']
 
         # Resolve schedule and booking if needed
         schedule = None
@@ -320,35 +505,6 @@ class PayAdvantageService:
             if schedule and not booking_id:
                 booking_id = schedule.booking_id
 
-        # Parse dates and amounts
-        def _parse_date(value: Optional[str]):
-            try:
-                from datetime import date
-                if not value:
-                    return None
-                return date.fromisoformat(value[:10])
-            except Exception:
-                return None
-
-        due_date = _parse_date(payload.get('dueDate') or payload.get('DueDate') or payload.get('date'))
-        paid_date = _parse_date(payload.get('paidDate') or payload.get('PaidDate'))
-        # Fallback: if due_date missing but paid_date present, use paid_date to satisfy NOT NULL
-        if not due_date and paid_date:
-            due_date = paid_date
-
-        def _parse_amount(v: Any):
-            try:
-                return float(v) if v is not None else None
-            except Exception:
-                return None
-
-        due_amount = _parse_amount(payload.get('dueAmount') or payload.get('amount') or payload.get('DueAmount'))
-        paid_amount = _parse_amount(payload.get('paidAmount') or payload.get('PaidAmount'))
-
-        status = (payload.get('status') or payload.get('Status') or '').lower() or 'pending'
-        if paid_date and (paid_amount or 0) > 0:
-            status = 'completed'
-
         # Upsert installment by external_payment_id when available, otherwise schedule+due_date
         installment: Optional[DirectDebitInstallment] = None
         if external_payment_id:
@@ -365,14 +521,121 @@ class PayAdvantageService:
 
         installment.external_payment_id = external_payment_id or installment.external_payment_id
         installment.due_date = due_date or installment.due_date
-        installment.due_amount = due_amount if due_amount is not None else (installment.due_amount or 0)
-        installment.paid_date = paid_date
-        installment.paid_amount = paid_amount
-        installment.status = status
+        installment.due_amount = fields['due_amount'] if fields['due_amount'] is not None else (installment.due_amount or 0)
+        installment.paid_date = fields['paid_date']
+        installment.paid_amount = fields['paid_amount']
+        installment.status = fields['status']
         installment.raw_payload = payload
+        # A payment made before it was invoiced needs no invoice
+        if schedule and installment.status == 'completed':
+            schedule.advance_past(installment.due_date)
 
         db.session.commit()
         return installment
+
+    def upsert_installments_from_webhook(self, payloads: List[Dict[str, Any]]) -> List[DirectDebitInstallment]:
+        """Batch version of :meth:`upsert_installment_from_webhook` for many events at once.
+
+        Applies ``payloads`` in order with the same matching rules, but reads
+        the schedules and the candidate installments in two ``IN`` queries and
+        writes with one bulk ``UPDATE`` plus one ``INSERT ... ON CONFLICT
+        (external_payment_id) DO UPDATE`` (PostgreSQL and SQLite). Returns the
+        installment of each payload, in order. Raises ``ValueError`` without
+        writing anything if a payload can't be resolved to a schedule,
+        booking and due date.
+        """
+        events = [installment_fields(payload) for payload in payloads]
+        schedule_ids = {event['schedule_id'] for event in events if event['schedule_id']}
+        external_ids = {event['external_payment_id'] for event in events if event['external_payment_id']}
+        schedules = {}
+        if schedule_ids:
+            schedules = {schedule.schedule_id: schedule for schedule in
+                         DirectDebitSchedule.query.filter(DirectDebitSchedule.schedule_id.in_(schedule_ids))}
+        conditions = []
+        if external_ids:
+            conditions.append(DirectDebitInstallment.external_payment_id.in_(external_ids))
+        if schedule_ids:
+            conditions.append(DirectDebitInstallment.schedule_id.in_(schedule_ids))
+        existing = DirectDebitInstallment.query.filter(or_(*conditions)).all() if conditions else []
+
+        # Each installment's columns after applying every event, keyed like the single-event lookups
+        rows = [{column: getattr(installment, column) for column in _INSTALLMENT_COLUMNS} | {'id': installment.id}
+                for installment in existing]
+        by_external = {row['external_payment_id']: row for row in rows if row['external_payment_id']}
+        by_due = {}
+        for row in rows:
+            by_due.setdefault((row['schedule_id'], row['booking_id'], row['due_date']), row)
+        targets = []
+        for payload, event in zip(payloads, events):
+            schedule = schedules.get(event['schedule_id'])
+            booking_id = event['booking_id'] or (schedule.booking_id if schedule else None)
+            row = by_external.get(event['external_payment_id']) if event['external_payment_id'] else None
+            if row is None and event['schedule_id'] and event['due_date']:
+                row = by_due.get((event['schedule_id'], booking_id, event['due_date']))
+            if row is None:
+                row = {'id': None, 'schedule_id': event['schedule_id'], 'booking_id': booking_id,
+                       'external_payment_id': None, 'due_date': None, 'due_amount': None}
+                rows.append(row)
+            row['external_payment_id'] = event['external_payment_id'] or row['external_payment_id']
+            row['due_date'] = event['due_date'] or row['due_date']
+            row['due_amount'] = event['due_amount'] if event['due_amount'] is not None else (row['due_amount'] or 0)
+            row.update(paid_date=event['paid_date'], paid_amount=event['paid_amount'], status=event['status'],
+                       raw_payload=payload)
+            if not (row['schedule_id'] and row['booking_id'] and row['due_date']):
+                raise ValueError(f"PayAdvantage event {payload.get('Code') or event['external_payment_id']} "
+                                 f"has no schedule, booking or due date")
+            if row['external_payment_id']:
+                by_external[row['external_payment_id']] = row
+            by_due.setdefault((row['schedule_id'], row['booking_id'], row['due_date']), row)
+            targets.append(row)
+            # A payment made before it was invoiced needs no invoice
+            if schedule and row['status'] == 'completed':
+                schedule.advance_past(row['due_date'])
+
+        now = datetime.utcnow()
+        touched = {id(row): row for row in targets}.values()
+        updates = [{**row, 'updated_at': now} for row in touched if row['id'] is not None]
+        inserts = [{key: value for key, value in row.items() if key != 'id'} | {'created_at': now, 'updated_at': now}
+                   for row in touched if row['id'] is None]
+        if updates:
+            db.session.execute(update(DirectDebitInstallment), updates)
+        if inserts:
+            statement = insert(DirectDebitInstallment)
+            dialect = db.engine.dialect.name
+            keyed = [row for row in inserts if row['external_payment_id']]
+            if keyed and dialect in ('postgresql', 'sqlite'):
+                # Another worker may have stored the same payment since the lookup
+                upsert = _dialect_insert(dialect)(DirectDebitInstallment)
+                upsert = upsert.on_conflict_do_update(
+                    index_elements=['external_payment_id'],
+                    set_={column: getattr(upsert.excluded, column) for column in _INSTALLMENT_COLUMNS + ('updated_at',)
+                          if column not in ('schedule_id', 'booking_id')},
+                )
+                db.session.execute(upsert, keyed)
+                inserts = [row for row in inserts if not row['external_payment_id']]
+            if inserts:
+                db.session.execute(statement, inserts)
+        db.session.commit()
+
+        # One read gives back the stored rows (including ids of new ones)
+        ids = [row['id'] for row in touched if row['id'] is not None]
+        new_external = [row['external_payment_id'] for row in touched if row['id'] is None and row['external_payment_id']]
+        new_due = [row['schedule_id'] for row in touched if row['id'] is None and not row['external_payment_id']]
+        stored = DirectDebitInstallment.query.filter(or_(
+            DirectDebitInstallment.id.in_(ids),
+            DirectDebitInstallment.external_payment_id.in_(new_external),
+            DirectDebitInstallment.schedule_id.in_(new_due),
+        )).all()
+        stored_by_id = {installment.id: installment for installment in stored}
+        stored_by_external = {installment.external_payment_id: installment for installment in stored
+                              if installment.external_payment_id}
+        stored_by_due = {(installment.schedule_id, installment.booking_id, installment.due_date): installment
+                         for installment in stored}
+        return [
+            stored_by_id.get(row['id']) or stored_by_external.get(row['external_payment_id'])
+            or stored_by_due.get((row['schedule_id'], row['booking_id'], row['due_date']))
+            for row in targets
+        ]
     
     def cancel_schedule(self, schedule_id: str) -> bool:
         """Cancel a direct debit schedule."""
@@ -0,0 +1,204 @@
+"""Nightly reconciliation of direct debit installments with PayAdvantage.
+
+Installments were only ever updated by webhooks, so a missed webhook left a
+receivable wrong for good. ``flask payadvantage-reconcile`` pages through the
+payments PayAdvantage reports for a date range (the last
+``PAY_ADVANTAGE_RECONCILE_DAYS`` days by default) and compares each page
+with ``direct_debit_installments`` and ``payments`` in memory, joined on
+dicts keyed like the webhook lookups. Only payments that differ are written,
+one bulk batch per page, through the webhook path
+(:func:`~app.services.webhook_inbox.handle_payadvantage_events`).
+
+The page reached is saved in the ``payadvantage_payments`` checkpoint after
+every page, so an interrupted run resumes there, one page early: payments
+that moved to an earlier page in the meantime are read again instead of
+skipped. A range interrupted ``RECONCILE_MAX_ATTEMPTS`` times or begun more
+than ``RECONCILE_MAX_AGE_DAYS`` days ago is abandoned for the current one.
+Payments missed by page-number paging while the range changes under it fall
+inside the next nights' overlapping windows.
+
+The nightly ``scheduled_tasks.py`` run calls :func:`reconcile_recent`. Its
+window reaches back to the end of the last completed range (the checkpoint
+watermark) when that is older than ``PAY_ADVANTAGE_RECONCILE_DAYS``, up to
+``RECONCILE_MAX_CATCH_UP_DAYS``, so nights without a run leave no gap.
+"""
+
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import or_, select
+
+from app import db
+from app.models import DirectDebitInstallment, DirectDebitSchedule, Payment, SyncCheckpoint
+from app.services.pay_advantage import PayAdvantageService, installment_fields
+from app.services.webhook_inbox import handle_payadvantage_events
+
+RECONCILE_CHECKPOINT = 'payadvantage_payments'
+
+# An interrupted range is resumed at most this many times, or for this many days
+RECONCILE_MAX_ATTEMPTS = 3
+RECONCILE_MAX_AGE_DAYS = 3
+
+# How far back a window reaches to cover nights the job didn't complete
+RECONCILE_MAX_CATCH_UP_DAYS = 90
+
+
+def reconcile_payments(service: PayAdvantageService, date_from: date, date_to: date,
+                       restart: bool = False) -> Dict[str, Any]:
+    """Bring installments and payments in line with PayAdvantage's payments dated ``date_from``..``date_to``.
+
+    Resumes an interrupted run over the same range, from the page before the
+    one it stopped at, unless ``restart``.
+    """
+    checkpoint = SyncCheckpoint.load(RECONCILE_CHECKPOINT)
+    run = {'from': date_from.isoformat(), 'to': date_to.isoformat(),
+           'started': datetime.utcnow().isoformat(), 'attempts': 1}
+    cursor = checkpoint.cursor or {}
+    page = 1
+    if not restart and cursor.get('page') and cursor.get('from') == run['from'] and cursor.get('to') == run['to']:
+        page = max(cursor['page'] - 1, 1)
+        run.update(started=cursor.get('started', run['started']), attempts=cursor.get('attempts', 1) + 1)
+        # Counted before the first request, so a page that always fails still runs out of attempts
+        checkpoint.cursor = {**cursor, **run}
+        db.session.commit()
+
+    summary = {'first_page': page, 'pages': 0, 'seen': 0, 'changed': 0, 'unmatched': 0, 'abandoned': None}
+    while True:
+        records = service.get_payments(date_from, date_to, page)
+        summary['pages'] += 1
+        summary['seen'] += len(records)
+        changed, unmatched = _diff(records)
+        if changed:
+            handle_payadvantage_events(changed)
+        summary['changed'] += len(changed)
+        summary['unmatched'] += unmatched
+        page += 1
+        if len(records) < service.PAYMENTS_PAGE_SIZE:
+            checkpoint.watermark = datetime.combine(date_to, time.min)
+            checkpoint.cursor = None
+            db.session.commit()
+            return summary
+        # Saved per page, so an interrupted run picks up here
+        checkpoint.cursor = {**run, 'page': page}
+        db.session.commit()
+
+
+def reconcile_recent(service: Optional[PayAdvantageService] = None) -> Dict[str, Any]:
+    """Resume an interrupted run, or reconcile the last ``PAY_ADVANTAGE_RECONCILE_DAYS`` days.
+
+    The days since the last completed run are included when there are more.
+    An interrupted range out of attempts or too old is abandoned, named in
+    ``summary['abandoned']``, and the current window reconciled instead.
+    """
+    service = service or PayAdvantageService()
+    checkpoint = db.session.get(SyncCheckpoint, RECONCILE_CHECKPOINT) or SyncCheckpoint()
+    cursor = checkpoint.cursor
+    abandoned = None
+    if cursor and cursor.get('page'):
+        started = datetime.fromisoformat(cursor['started']) if cursor.get('started') else checkpoint.updated_at
+        if cursor.get('attempts', 1) < RECONCILE_MAX_ATTEMPTS and \
+                started and started > datetime.utcnow() - timedelta(days=RECONCILE_MAX_AGE_DAYS):
+            return reconcile_payments(service, date.fromisoformat(cursor['from']), date.fromisoformat(cursor['to']))
+        abandoned = f"{cursor['from']}..{cursor['to']}"
+        current_app.logger.warning(f"Abandoning PayAdvantage reconciliation of {abandoned} at page "
+                                   f"{cursor['page']} after {cursor.get('attempts', 1)} attempts")
+
+    date_to = date.today()
+    date_from = date_to - timedelta(days=int(current_app.config.get('PAY_ADVANTAGE_RECONCILE_DAYS', 7)))
+    if checkpoint.watermark is not None:
+        # Back to the last day the previous completed run covered
+        date_from = min(date_from, max(checkpoint.watermark.date(),
+                                       date_to - timedelta(days=RECONCILE_MAX_CATCH_UP_DAYS)))
+    summary = reconcile_payments(service, date_from, date_to, restart=True)
+    summary['abandoned'] = abandoned
+    return summary
+
+
+def _diff(records: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+    """The records whose installment or payment differs from ours, and how many match no schedule of ours."""
+    events = [installment_fields(record) for record in records]
+    schedule_ids = {event['schedule_id'] for event in events if event['schedule_id']}
+    external_ids = {event['external_payment_id'] for event in events if event['external_payment_id']}
+    if not schedule_ids:
+        return [], len(records)
+
+    schedules = dict(db.session.execute(
+        select(DirectDebitSchedule.schedule_id, DirectDebitSchedule.booking_id)
+        .where(DirectDebitSchedule.schedule_id.in_(schedule_ids))
+    ).all())
+    conditions = [DirectDebitInstallment.schedule_id.in_(schedule_ids)]
+    if external_ids:
+        conditions.append(DirectDebitInstallment.external_payment_id.in_(external_ids))
+    installments = DirectDebitInstallment.query.filter(or_(*conditions)).all()
+    by_external = {installment.external_payment_id: installment for installment in installments
+                   if installment.external_payment_id}
+    by_due = {}
+    for installment in installments:
+        by_due.setdefault((installment.schedule_id, installment.booking_id, installment.due_date), installment)
+    paid = set(db.session.execute(
+        select(Payment.booking_id, Payment.gateway_transaction_id).where(
+            Payment.gateway == 'payadvantage',
+            Payment.booking_id.in_(set(schedules.values())),
+        )
+    ).tuples())
+
+    changed, unmatched = [], 0
+    for record, event in zip(records, events):
+        if event['schedule_id'] not in schedules or not event['due_date']:
+            unmatched += 1
+            continue
+        booking_id = event['booking_id'] or schedules[event['schedule_id']]
+        installment = by_external.get(event['external_payment_id']) if event['external_payment_id'] else None
+        if installment is None:
+            installment = by_due.get((event['schedule_id'], booking_id, event['due_date']))
+        if installment is None or _differs(installment, event):
+            changed.append(record)
+            continue
+        if installment.status == 'completed':
+            gateway_txn_id = installment.external_payment_id or \
+                f"sched:{installment.schedule_id}|due:{installment.due_date.isoformat()}"
+            if (installment.booking_id, gateway_txn_id) not in paid:
+                changed.append(record)
+    return changed, unmatched
+
+
+def _differs(installment: DirectDebitInstallment, event: Dict[str, Any]) -> bool:
+    return (
+        installment.status != event['status']
+        or installment.paid_date != event['paid_date']
+        or installment.paid_amount != event['paid_amount']
+        or installment.due_date != event['due_date']
+        or (event['external_payment_id'] and installment.external_payment_id != event['external_payment_id'])
+        or (event['due_amount'] is not None and installment.due_amount != event['due_amount'])
+    )
+
+
+@click.command('payadvantage-reconcile')
+@click.option('--from', 'date_from', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='First payment date (default: PAY_ADVANTAGE_RECONCILE_DAYS days ago).')
+@click.option('--to', 'date_to', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Last payment date (default: today).')
+@click.option('--restart', is_flag=True, help='Start the range from its first page even if a run was interrupted.')
+@with_appcontext
+def payadvantage_reconcile_command(date_from, date_to, restart):
+    """Reconcile direct debit installments and payments with PayAdvantage."""
+    if date_from is None and date_to is None and not restart:
+        summary = reconcile_recent()
+    else:
+        date_to = date_to.date() if date_to else date.today()
+        date_from = date_from.date() if date_from else \
+            date_to - timedelta(days=int(current_app.config.get('PAY_ADVANTAGE_RECONCILE_DAYS', 7)))
+        summary = reconcile_payments(PayAdvantageService(), date_from, date_to, restart=restart)
+    click.echo(f"PayAdvantage payments: {summary['seen']} seen, {summary['changed']} reconciled, "
+               f"{summary['unmatched']} not matched to a schedule ({summary['pages']} pages from page "
+               f"{summary['first_page']})")
+    if summary['abandoned']:
+        click.echo(f"Gave up resuming the interrupted run over {summary['abandoned']}")
+
+
+def init_pay_advantage_reconcile(app):
+    """Register ``flask payadvantage-reconcile``."""
+    app.cli.add_command(payadvantage_reconcile_command)
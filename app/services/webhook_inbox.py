@@ -0,0 +1,397 @@
+"""Inbox for verified PayAdvantage webhook events.
+
+The webhook used to upsert installments and create payments before
+answering, so a burst of events made PayAdvantage time out and redeliver,
+adding to the load. The endpoint now only verifies the signature, stores each
+event as a ``webhook_events`` row and answers 202. The worker processes them:
+
+    flask --app wsgi webhook-events --loop    # long-running worker process
+    flask --app wsgi webhook-events           # process once (also run by scheduled_tasks.py)
+    flask --app wsgi webhook-events-replay    # queue failed events again
+
+Events of one schedule are processed in the order they arrived: an event
+can't be claimed while an earlier event of its ``ordering_key`` is retrying
+or held by another worker. Claims use a conditional ``UPDATE`` like the Xero
+outbox (one ``UPDATE ... RETURNING`` per poll, or one ``UPDATE`` per event on
+MySQL, which has no ``RETURNING``), and an event left ``processing`` by a crashed worker is reclaimed
+after ``WEBHOOK_EVENTS_LEASE_SECONDS``. Each poll applies its claimed events
+with :func:`handle_payadvantage_events` in a few bulk queries. If that batch
+fails, its events are applied one by one so only the bad event is retried,
+with exponential backoff up to ``WEBHOOK_EVENTS_MAX_ATTEMPTS``.
+"""
+
+import hashlib
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, exists, insert, not_, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from app import db
+from app.models import Booking, BookingStatus, Payment, PaymentMethod, PaymentStatus, WebhookEvent
+from app.utils.metrics import track_job
+
+PAYADVANTAGE = 'payadvantage'
+
+# Booking statuses a completed direct debit payment moves to confirmed
+_CONFIRMABLE = [BookingStatus.PENDING, BookingStatus.CANCELLED, BookingStatus.NO_SHOW]
+
+
+def _ordering_key(event: Dict[str, Any]) -> str:
+    schedule_id = event.get('scheduleId') or event.get('ScheduleId') or event.get('schedule_id')
+    if schedule_id:
+        return f'schedule:{schedule_id}'
+    return f"code:{event.get('Code') or event.get('code') or ''}"
+
+
+def _dedupe_key(event: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(event, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def store_events(source: str, events: Iterable[Dict[str, Any]]) -> List[WebhookEvent]:
+    """Add ``events`` to the inbox, skipping any already stored; returns the new rows."""
+    rows = {}
+    for event in events:
+        key = _dedupe_key(event)
+        rows.setdefault(key, WebhookEvent(
+            source=source, event_type=event.get('Event'), ordering_key=_ordering_key(event)[:150],
+            dedupe_key=key, payload=event, status=WebhookEvent.PENDING, next_attempt_at=datetime.utcnow(),
+        ))
+    for _ in range(2):
+        stored = set(db.session.scalars(select(WebhookEvent.dedupe_key).where(
+            WebhookEvent.source == source, WebhookEvent.dedupe_key.in_(list(rows)))))
+        new = [row for key, row in rows.items() if key not in stored]
+        db.session.add_all(new)
+        try:
+            db.session.commit()
+            return new
+        except IntegrityError:
+            # The same delivery arrived on another worker in between; skip what it stored
+            db.session.rollback()
+    raise RuntimeError('Could not store webhook events')
+
+
+def process_events(limit: Optional[int] = None) -> Dict[str, int]:
+    """Process due inbox events once, as one batch; returns counts by outcome."""
+    limit = limit or int(current_app.config.get('WEBHOOK_EVENTS_BATCH_SIZE', 50))
+    summary = {'processed': 0, 'retrying': 0, 'failed': 0, 'waiting': 0}
+    event_ids = _claim(limit)
+    if event_ids:
+        events = WebhookEvent.query.filter(WebhookEvent.id.in_(event_ids)).order_by(WebhookEvent.id).all()
+        for outcome in _process_batch(events):
+            summary[outcome] += 1
+    return summary
+
+
+def replay_events(event_ids: Optional[List[int]] = None, source: Optional[str] = None) -> int:
+    """Queue failed events again (all of them, or ``event_ids``); returns how many."""
+    conditions = [WebhookEvent.status == WebhookEvent.FAILED]
+    if event_ids:
+        conditions.append(WebhookEvent.id.in_(event_ids))
+    if source:
+        conditions.append(WebhookEvent.source == source)
+    result = db.session.execute(
+        update(WebhookEvent).where(*conditions).values(
+            status=WebhookEvent.PENDING, attempts=0, next_attempt_at=datetime.utcnow(),
+            locked_at=None, processed_at=None),
+        execution_options={'synchronize_session': False},
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def _due_condition(now, event=WebhookEvent):
+    lease = timedelta(seconds=int(current_app.config.get('WEBHOOK_EVENTS_LEASE_SECONDS', 300)))
+    return or_(
+        and_(event.status == WebhookEvent.PENDING, event.next_attempt_at <= now),
+        # Left behind by a worker that died mid-event
+        and_(event.status == WebhookEvent.PROCESSING, event.locked_at < now - lease),
+    )
+
+
+def _claim(limit: int) -> List[int]:
+    now = datetime.utcnow()
+    # An event waits while an earlier event of its ordering key is unfinished and not due
+    earlier = aliased(WebhookEvent)
+    blocked = exists().where(
+        earlier.ordering_key == WebhookEvent.ordering_key,
+        earlier.id < WebhookEvent.id,
+        earlier.status.in_([WebhookEvent.PENDING, WebhookEvent.PROCESSING]),
+        not_(_due_condition(now, earlier)),
+    )
+    candidates = db.session.execute(
+        select(WebhookEvent.id, WebhookEvent.ordering_key).where(_due_condition(now), ~blocked)
+        .order_by(WebhookEvent.id).limit(limit)
+    ).all()
+    if not candidates:
+        return []
+    claim = update(WebhookEvent).where(_due_condition(now)).values(status=WebhookEvent.PROCESSING, locked_at=now)
+    if db.engine.dialect.update_returning:
+        # One conditional UPDATE claims every candidate still due; another worker's claims drop out
+        claimed = set(db.session.scalars(
+            claim.where(WebhookEvent.id.in_([event_id for event_id, _ in candidates])).returning(WebhookEvent.id),
+            execution_options={'synchronize_session': False},
+        ))
+    else:
+        # No UPDATE ... RETURNING (MySQL): one conditional UPDATE per candidate, claimed if it matched
+        claimed = {
+            event_id for event_id, _ in candidates
+            if db.session.execute(claim.where(WebhookEvent.id == event_id),
+                                  execution_options={'synchronize_session': False}).rowcount == 1
+        }
+    # Once another worker took an event, the later events of its key are left to it
+    kept, released, lost = [], [], set()
+    for event_id, ordering_key in candidates:
+        if event_id not in claimed:
+            lost.add(ordering_key)
+        elif ordering_key in lost:
+            released.append(event_id)
+        else:
+            kept.append(event_id)
+    if released:
+        db.session.execute(
+            update(WebhookEvent).where(WebhookEvent.id.in_(released))
+            .values(status=WebhookEvent.PENDING, locked_at=None),
+            execution_options={'synchronize_session': False},
+        )
+    db.session.commit()
+    return kept
+
+
+def _process_batch(events: List[WebhookEvent]) -> List[str]:
+    """Apply claimed ``events`` (oldest first) in bulk, falling back to one at a time if the batch fails."""
+    keys = [(event.id, event.ordering_key) for event in events]
+    try:
+        handle_payadvantage_events([event.payload for event in events])
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.warning(f"Webhook batch of {len(keys)} events failed, processing one by one: {e}")
+        outcomes, blocked = [], set()
+        for event_id, ordering_key in keys:
+            event = db.session.get(WebhookEvent, event_id)
+            if ordering_key in blocked:
+                # Handed back to wait behind the earlier event that failed
+                event.status = WebhookEvent.PENDING
+                event.locked_at = None
+                db.session.commit()
+                outcomes.append('waiting')
+                continue
+            outcome = _process(event)
+            if outcome != 'processed':
+                blocked.add(ordering_key)
+            outcomes.append(outcome)
+        return outcomes
+    db.session.execute(
+        update(WebhookEvent).where(WebhookEvent.id.in_([event_id for event_id, _ in keys])).values(
+            status=WebhookEvent.PROCESSED, processed_at=datetime.utcnow(), last_error=None, locked_at=None),
+        execution_options={'synchronize_session': False},
+    )
+    db.session.commit()
+    return ['processed'] * len(keys)
+
+
+def _process(event: WebhookEvent) -> str:
+    config = current_app.config
+    try:
+        handle_payadvantage_event(event.payload)
+    except Exception as e:
+        db.session.rollback()
+        event = db.session.get(WebhookEvent, event.id)
+        event.attempts += 1
+        event.last_error = str(e)[:2000]
+        if event.attempts >= int(config.get('WEBHOOK_EVENTS_MAX_ATTEMPTS', 5)):
+            event.status = WebhookEvent.FAILED
+            event.processed_at = datetime.utcnow()
+            current_app.logger.error(f"Webhook event {event.id} failed after {event.attempts} attempts: {e}")
+            outcome = 'failed'
+        else:
+            base = float(config.get('WEBHOOK_EVENTS_BACKOFF_BASE', 30))
+            delay = min(base * (2 ** (event.attempts - 1)), float(config.get('WEBHOOK_EVENTS_BACKOFF_MAX', 3600)))
+            event.status = WebhookEvent.PENDING
+            event.next_attempt_at = datetime.utcnow() + timedelta(seconds=random.uniform(delay / 2, delay))
+            current_app.logger.warning(f"Webhook event {event.id} attempt {event.attempts} failed: {e}")
+            outcome = 'retrying'
+    else:
+        event.status = WebhookEvent.PROCESSED
+        event.processed_at = datetime.utcnow()
+        event.last_error = None
+        outcome = 'processed'
+    event.locked_at = None
+    db.session.commit()
+    return outcome
+
+
+def handle_payadvantage_event(event: Dict[str, Any]) -> None:
+    """Apply one PayAdvantage event: upsert its installment and record a completed payment once."""
+    from app.services.pay_advantage import PayAdvantageService
+
+    installment = PayAdvantageService().upsert_installment_from_webhook(event)
+
+    # If completed, ensure a Payment record exists (idempotent)
+    if not installment or str(getattr(installment, 'status', '')).lower() != 'completed':
+        return
+    fallback_key = None
+    try:
+        fallback_key = f"sched:{installment.schedule_id}|due:{installment.due_date.isoformat()}"
+    except Exception:
+        fallback_key = None
+    gateway_txn_id = installment.external_payment_id or fallback_key
+
+    existing = None
+    if gateway_txn_id:
+        existing = Payment.query.filter_by(
+            gateway='payadvantage',
+            gateway_transaction_id=gateway_txn_id,
+            booking_id=installment.booking_id
+        ).first()
+    if existing:
+        return
+
+    booking = db.session.get(Booking, installment.booking_id)
+    if not booking:
+        return
+
+    amount = getattr(installment, 'paid_amount', None) or getattr(installment, 'due_amount', 0) or 0
+
+    payment = Payment(
+        booking_id=booking.id,
+        user_id=booking.customer_id,
+        amount=amount,
+        currency='AUD',
+        payment_method=PaymentMethod.DIRECT_DEBIT,
+        status=PaymentStatus.COMPLETED,
+        gateway='payadvantage',
+        gateway_transaction_id=gateway_txn_id,
+        gateway_response=event,
+        description=f'Direct debit payment for booking {booking.booking_number}',
+        processed_at=datetime.utcnow()
+    )
+    payment.generate_transaction_id()
+    db.session.add(payment)
+
+    if booking.status in _CONFIRMABLE:
+        booking.status = BookingStatus.CONFIRMED
+
+    db.session.commit()
+
+
+def handle_payadvantage_events(events: List[Dict[str, Any]]) -> None:
+    """Apply many PayAdvantage events at once, in order; same effect as one :func:`handle_payadvantage_event` each.
+
+    Installments are upserted in bulk, then the payments of completed ones are
+    looked up with one ``IN`` query and the missing ones inserted together
+    (``ON CONFLICT DO NOTHING`` on PostgreSQL's payment idempotency index).
+    """
+    from app.services.pay_advantage import PayAdvantageService
+
+    installments = PayAdvantageService().upsert_installments_from_webhook(events)
+
+    # The last event of each completed installment, as the single-event path would see it
+    completed = {}
+    for event, installment in zip(events, installments):
+        if installment is not None and str(installment.status or '').lower() == 'completed':
+            gateway_txn_id = installment.external_payment_id or \
+                f"sched:{installment.schedule_id}|due:{installment.due_date.isoformat()}"
+            completed.setdefault((installment.booking_id, gateway_txn_id), (installment, event))
+    if not completed:
+        return
+
+    existing = set(db.session.execute(
+        select(Payment.booking_id, Payment.gateway_transaction_id).where(
+            Payment.gateway == 'payadvantage',
+            Payment.gateway_transaction_id.in_({txn_id for _, txn_id in completed}),
+        )
+    ).tuples())
+    missing = {key: value for key, value in completed.items() if key not in existing}
+    if not missing:
+        return
+    bookings = {booking.id: booking for booking in
+                Booking.query.filter(Booking.id.in_({booking_id for booking_id, _ in missing}))}
+
+    now = datetime.utcnow()
+    rows = []
+    for (booking_id, gateway_txn_id), (installment, event) in missing.items():
+        booking = bookings.get(booking_id)
+        if booking is None:
+            continue
+        payment = Payment(booking_id=booking.id)
+        payment.generate_transaction_id()
+        rows.append({
+            'transaction_id': payment.transaction_id,
+            'booking_id': booking.id,
+            'user_id': booking.customer_id,
+            'amount': installment.paid_amount or installment.due_amount or 0,
+            'currency': 'AUD',
+            'payment_method': PaymentMethod.DIRECT_DEBIT,
+            'status': PaymentStatus.COMPLETED,
+            'gateway': 'payadvantage',
+            'gateway_transaction_id': gateway_txn_id,
+            'gateway_response': event,
+            'description': f'Direct debit payment for booking {booking.booking_number}',
+            'processed_at': now,
+            'created_at': now,
+            'updated_at': now,
+        })
+    if not rows:
+        return
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        statement = pg_insert(Payment).on_conflict_do_nothing(
+            index_elements=['booking_id', 'gateway', 'gateway_transaction_id'],
+            index_where=and_(Payment.gateway == 'payadvantage', Payment.gateway_transaction_id.isnot(None)),
+        )
+    else:
+        statement = insert(Payment)
+    db.session.execute(statement, rows)
+    db.session.execute(
+        update(Booking)
+        .where(Booking.id.in_({row['booking_id'] for row in rows}), Booking.status.in_(_CONFIRMABLE))
+        .values(status=BookingStatus.CONFIRMED),
+        execution_options={'synchronize_session': False},
+    )
+    db.session.commit()
+
+
+@click.command('webhook-events')
+@click.option('--loop', is_flag=True, help='Keep processing until stopped (worker process).')
+@click.option('--interval', type=float, default=None, help='Seconds between polls with --loop.')
+@click.option('--limit', type=int, default=None, help='Events claimed per poll.')
+@with_appcontext
+def webhook_events_command(loop, interval, limit):
+    """Process stored webhook events."""
+    interval = interval or float(current_app.config.get('WEBHOOK_EVENTS_POLL_INTERVAL', 2))
+    while True:
+        with track_job('webhook_events'):
+            summary = process_events(limit)
+        db.session.remove()
+        if any(summary.values()):
+            click.echo(f"Webhook events: {summary['processed']} processed, {summary['retrying']} retrying, "
+                       f"{summary['failed']} failed, {summary['waiting']} waiting")
+        if not loop:
+            return
+        # Poll again straight away while there is a backlog
+        if not any(summary.values()):
+            time.sleep(interval)
+
+
+@click.command('webhook-events-replay')
+@click.option('--id', 'event_ids', type=int, multiple=True, help='Replay only this event (repeatable).')
+@click.option('--source', default=None, help='Replay only events from this source, e.g. payadvantage.')
+@with_appcontext
+def webhook_events_replay_command(event_ids, source):
+    """Queue failed webhook events to be processed again."""
+    count = replay_events(list(event_ids), source)
+    click.echo(f"Webhook events: {count} failed events queued again")
+
+
+def init_webhook_inbox(app):
+    """Register ``flask webhook-events`` and ``flask webhook-events-replay``."""
+    app.cli.add_command(webhook_events_command)
+    app.cli.add_command(webhook_events_replay_command)
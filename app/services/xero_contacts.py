@@ -0,0 +1,196 @@
+"""Local map of customers to their Xero contacts.
+
+Invoices reference the customer's ``ContactID`` instead of embedding the
+contact, so Xero no longer matches (or creates) a contact by name on every
+invoice. ``xero_contacts`` holds user -> ContactID plus a fingerprint of the
+contact fields last synced:
+
+* :func:`ensure_contacts` fills it lazily before invoices are sent and sends
+  a contact only when it is new or its fingerprint changed
+* ``flask xero-contacts-sync`` pages through every Xero contact and maps them
+  to customers in bulk, by ``ContactNumber`` and then by email address
+"""
+
+import hashlib
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from app import db
+from app.models import User, XeroContact
+from app.utils.xero import XeroClient
+
+# ContactNumber given to contacts this app creates, e.g. AURORA-42 for user 42
+CONTACT_NUMBER_PREFIX = 'AURORA-'
+
+_ADDRESS_FIELDS = ('AddressLine1', 'City', 'Region', 'PostalCode', 'Country')
+
+
+def contact_payload(user: User) -> Dict:
+    """Xero Contact fields for ``user`` (without ``ContactID``)."""
+    return {
+        'Name': user.full_name,
+        'EmailAddress': user.email,
+        'Phones': [
+            {
+                'PhoneType': 'MOBILE',
+                'PhoneNumber': user.phone or ''
+            }
+        ],
+        'Addresses': [
+            {
+                'AddressType': 'POBOX',
+                'AddressLine1': user.address or '',
+                'City': user.city or '',
+                'Region': user.state or '',
+                'PostalCode': user.zip_code or '',
+                'Country': user.country or 'Australia'
+            }
+        ]
+    }
+
+
+def contact_hash(contact: Dict) -> str:
+    """Fingerprint of the fields we sync, equal for our payload and Xero's copy of the same contact."""
+    phone = next((phone.get('PhoneNumber') or '' for phone in contact.get('Phones') or []
+                  if phone.get('PhoneType') == 'MOBILE'), '')
+    address = next((address for address in contact.get('Addresses') or []
+                    if address.get('AddressType') == 'POBOX'), {})
+    fields = [contact.get('Name') or '', contact.get('EmailAddress') or '', phone]
+    fields += [address.get(field) or '' for field in _ADDRESS_FIELDS]
+    return hashlib.sha256('\x1f'.join(field.strip() for field in fields).encode()).hexdigest()
+
+
+def ensure_contacts(client, users: Iterable[User]) -> Tuple[Dict[int, str], Dict[int, List[str]]]:
+    """ContactIDs for ``users``, creating or updating Xero contacts only where needed.
+
+    Returns ``(contact_ids, errors)`` keyed by user id; a user Xero rejected
+    appears only in ``errors``. A rejected update keeps the existing ContactID.
+    """
+    users = {user.id: user for user in users if user is not None}
+    if not users:
+        return {}, {}
+    mapped = {row.user_id: row for row in XeroContact.query.filter(XeroContact.user_id.in_(list(users)))}
+    payloads = {user_id: contact_payload(user) for user_id, user in users.items()}
+    for user_id, row in mapped.items():
+        # Contacts created under a distinct name keep it
+        distinct = _distinct_name(payloads[user_id], user_id)
+        if row.contact_hash == contact_hash(distinct):
+            payloads[user_id] = distinct
+
+    # Customers invoiced before the mapping existed already have a contact under their name.
+    # It is adopted only when the name is unambiguous: one Xero contact, not mapped to another
+    # customer, and one customer in this batch. Otherwise a contact is created under a distinct
+    # name, since Xero contact names are unique.
+    unmapped = [user_id for user_id in users if user_id not in mapped]
+    if unmapped:
+        by_name = {}
+        for contact in client.get_contacts(names=[payloads[user_id]['Name'] for user_id in unmapped]):
+            by_name.setdefault((contact.get('Name') or '').lower(), []).append(contact)
+        candidates = {contacts[0]['ContactID'] for contacts in by_name.values()
+                      if len(contacts) == 1 and contacts[0].get('ContactID')}
+        owners = dict(db.session.query(XeroContact.contact_id, XeroContact.user_id)
+                      .filter(XeroContact.contact_id.in_(candidates)).all()) if candidates else {}
+        names = {}
+        for user_id in unmapped:
+            names.setdefault(payloads[user_id]['Name'].lower(), []).append(user_id)
+        for name, user_ids in names.items():
+            contacts = by_name.get(name, [])
+            contact = contacts[0] if len(contacts) == 1 else None
+            if len(user_ids) == 1 and contact and contact.get('ContactID') and contact['ContactID'] not in owners:
+                mapped[user_ids[0]] = _remember(user_ids[0], contact['ContactID'], contact_hash(contact))
+            elif contacts or len(user_ids) > 1:
+                for user_id in user_ids:
+                    payloads[user_id] = _distinct_name(payloads[user_id], user_id)
+    hashes = {user_id: contact_hash(payload) for user_id, payload in payloads.items()}
+
+    changed = [user_id for user_id in users if user_id not in mapped or mapped[user_id].contact_hash != hashes[user_id]]
+    errors = {}
+    if changed:
+        contacts = [
+            {**payloads[user_id], 'ContactID': mapped[user_id].contact_id} if user_id in mapped
+            else {**payloads[user_id], 'ContactNumber': f'{CONTACT_NUMBER_PREFIX}{user_id}'}
+            for user_id in changed
+        ]
+        idempotency_key = 'aurora-contacts-' + hashlib.sha256(
+            '|'.join(f'{user_id}:{hashes[user_id]}' for user_id in changed).encode()).hexdigest()[:48]
+        results = client.save_contacts(contacts, idempotency_key=idempotency_key)
+        for user_id, result in zip(changed, results):
+            if result.get('StatusAttributeString') == 'ERROR' or result.get('HasValidationErrors') or not result.get('ContactID'):
+                errors[user_id] = [error.get('Message', '') for error in result.get('ValidationErrors') or []] \
+                    or ['Xero contact was not saved']
+                current_app.logger.warning(f"Xero rejected contact for user {user_id}: {'; '.join(errors[user_id])}")
+                continue
+            mapped[user_id] = _remember(user_id, result['ContactID'], hashes[user_id], mapped.get(user_id))
+    db.session.commit()
+    return {user_id: row.contact_id for user_id, row in mapped.items()}, errors
+
+
+def sync_contacts(client) -> Dict[str, int]:
+    """Map every Xero contact to a customer, reading Xero's Contacts endpoint page by page."""
+    users = User.query.filter(User.email.isnot(None)).all()
+    by_number = {f'{CONTACT_NUMBER_PREFIX}{user.id}': user for user in users}
+    by_email = {user.email.lower(): user for user in users}
+    rows = {row.user_id: row for row in XeroContact.query.all()}
+    owners = {row.contact_id: row.user_id for row in rows.values()}
+
+    summary = {'pages': 0, 'mapped': 0, 'unmatched': 0}
+    page = 1
+    while True:
+        contacts = client.get_contacts(page)
+        summary['pages'] += 1
+        for contact in contacts:
+            contact_id = contact.get('ContactID')
+            if not contact_id or contact.get('ContactStatus') == 'ARCHIVED':
+                continue
+            user = by_number.get(contact.get('ContactNumber'))
+            if user is None:
+                user = by_email.get((contact.get('EmailAddress') or '').lower())
+                # An email match never replaces an existing mapping
+                if user is not None and user.id in rows and rows[user.id].contact_id != contact_id:
+                    user = None
+            if user is None or owners.get(contact_id, user.id) != user.id:
+                summary['unmatched'] += 1
+                continue
+            previous = rows.get(user.id)
+            if previous is not None and previous.contact_id != contact_id:
+                owners.pop(previous.contact_id, None)
+            rows[user.id] = _remember(user.id, contact_id, contact_hash(contact), previous)
+            owners[contact_id] = user.id
+            summary['mapped'] += 1
+        db.session.commit()
+        if len(contacts) < client.CONTACTS_PAGE_SIZE:
+            return summary
+        page += 1
+
+
+def _distinct_name(payload: Dict, user_id: int) -> Dict:
+    """``payload`` named e.g. "John Smith (AURORA-42)", for a customer sharing a name with another contact."""
+    return {**payload, 'Name': f"{payload['Name']} ({CONTACT_NUMBER_PREFIX}{user_id})"}
+
+
+def _remember(user_id, contact_id, fingerprint, row=None):
+    if row is None:
+        row = XeroContact.query.filter_by(user_id=user_id).first() or XeroContact(user_id=user_id)
+        db.session.add(row)
+    row.contact_id = contact_id
+    row.contact_hash = fingerprint
+    row.synced_at = datetime.utcnow()
+    return row
+
+
+@click.command('xero-contacts-sync')
+@with_appcontext
+def xero_contacts_sync_command():
+    """Map existing Xero contacts to customers."""
+    summary = sync_contacts(XeroClient())
+    click.echo(f"Xero contacts: {summary['mapped']} mapped, {summary['unmatched']} not matched to a customer "
+               f"({summary['pages']} pages)")
+
+
+def init_xero_contacts(app):
+    """Register ``flask xero-contacts-sync``."""
+    app.cli.add_command(xero_contacts_sync_command)
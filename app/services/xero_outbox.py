@@ -0,0 +1,190 @@
+"""Durable outbox for Xero operations started from the web UI.
+
+Sending an invoice used to call Xero inside the admin's HTTP request, so a
+slow Xero response meant a slow page or a worker timeout. The send-invoice
+endpoints now only insert a ``xero_outbox`` row and answer 202 with a status
+URL the page polls. The worker drains the outbox:
+
+    flask --app wsgi xero-outbox --loop      # long-running worker process
+    flask --app wsgi xero-outbox             # drain once (also run by scheduled_tasks.py)
+
+Entries are claimed with a conditional ``UPDATE`` (pending -> processing), so
+several workers never send the same entry, and an entry left ``processing``
+by a crashed worker is reclaimed after ``XERO_OUTBOX_LEASE_SECONDS``. Failed
+attempts are retried with exponential backoff up to ``XERO_OUTBOX_MAX_ATTEMPTS``;
+rate-limit deferrals are rescheduled without counting as attempts.
+"""
+
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, or_, select, update
+
+from app import db
+from app.models import Booking, XeroOutbox
+from app.services.xero_contacts import ensure_contacts
+from app.utils.metrics import track_job
+from app.utils.xero import XeroClient, XeroRateLimitExceeded, interactive_calls
+
+SEND_INVOICE = 'send_invoice'
+
+# Errors that retrying cannot fix; the entry fails at once so an admin can reconnect Xero
+_PERMANENT_ERRORS = ('invalid_grant', 'no tenant id', 'no xero token')
+
+
+def enqueue_invoice(booking: Booking, booking_data: Dict[str, Any], invoice_amount: float, due_date,
+                    requested_by_id: Optional[int] = None) -> XeroOutbox:
+    """Queue creating and emailing an invoice for ``booking``; returns the (possibly existing) entry.
+
+    A second click while the same invoice is still queued returns the queued
+    entry instead of adding a duplicate.
+    """
+    due = due_date.strftime('%Y-%m-%d') if hasattr(due_date, 'strftime') else str(due_date)
+    payload = {'booking_data': booking_data, 'invoice_amount': float(invoice_amount), 'due_date': due}
+
+    queued = XeroOutbox.query.filter(
+        XeroOutbox.booking_id == booking.id,
+        XeroOutbox.operation == SEND_INVOICE,
+        XeroOutbox.status.in_([XeroOutbox.PENDING, XeroOutbox.PROCESSING]),
+    ).all()
+    for entry in queued:
+        if entry.payload.get('invoice_amount') == payload['invoice_amount'] and entry.payload.get('due_date') == due:
+            return entry
+
+    entry = XeroOutbox(operation=SEND_INVOICE, booking_id=booking.id, requested_by_id=requested_by_id,
+                       payload=payload, status=XeroOutbox.PENDING, next_attempt_at=datetime.utcnow())
+    db.session.add(entry)
+    db.session.commit()
+    return entry
+
+
+def drain_outbox(limit: Optional[int] = None) -> Dict[str, int]:
+    """Process due outbox entries once; returns counts by outcome."""
+    limit = limit or int(current_app.config.get('XERO_OUTBOX_BATCH_SIZE', 20))
+    summary = {'sent': 0, 'retrying': 0, 'deferred': 0, 'failed': 0}
+    for entry_id in _claim(limit):
+        entry = db.session.get(XeroOutbox, entry_id)
+        summary[_process(entry)] += 1
+    return summary
+
+
+def _due_condition(now):
+    lease = timedelta(seconds=int(current_app.config.get('XERO_OUTBOX_LEASE_SECONDS', 300)))
+    return or_(
+        and_(XeroOutbox.status == XeroOutbox.PENDING, XeroOutbox.next_attempt_at <= now),
+        # Left behind by a worker that died mid-send
+        and_(XeroOutbox.status == XeroOutbox.PROCESSING, XeroOutbox.locked_at < now - lease),
+    )
+
+
+def _claim(limit: int) -> List[int]:
+    now = datetime.utcnow()
+    candidates = db.session.scalars(
+        select(XeroOutbox.id).where(_due_condition(now)).order_by(XeroOutbox.next_attempt_at, XeroOutbox.id).limit(limit)
+    ).all()
+    claimed = []
+    for entry_id in candidates:
+        # Only one worker's UPDATE can match while the entry is still due
+        result = db.session.execute(
+            update(XeroOutbox)
+            .where(XeroOutbox.id == entry_id, _due_condition(now))
+            .values(status=XeroOutbox.PROCESSING, locked_at=now),
+            execution_options={'synchronize_session': False},
+        )
+        if result.rowcount == 1:
+            claimed.append(entry_id)
+    db.session.commit()
+    return claimed
+
+
+def _process(entry: XeroOutbox) -> str:
+    config = current_app.config
+    payload = entry.payload
+    try:
+        # An admin is waiting on this entry, so it may use the rate limiter's daily reserve
+        with interactive_calls():
+            client = XeroClient()
+            result = dict(entry.result or {})
+            if not result.get('invoice_id'):
+                contact_id = None
+                customer = entry.booking.customer if entry.booking is not None else None
+                if customer is not None:
+                    contact_ids, contact_errors = ensure_contacts(client, [customer])
+                    if customer.id not in contact_ids:
+                        raise Exception(f"Xero contact was not saved: {'; '.join(contact_errors.get(customer.id, []))}")
+                    contact_id = contact_ids[customer.id]
+                invoice = client.create_invoice(payload['booking_data'], payload['invoice_amount'],
+                                                payload['due_date'], idempotency_key=f'aurora-outbox-{entry.id}',
+                                                contact_id=contact_id)
+                if not invoice or not invoice.get('InvoiceID'):
+                    raise Exception("Failed to create invoice - no invoice ID returned")
+                result = {'invoice_id': invoice['InvoiceID'], 'invoice_number': invoice.get('InvoiceNumber')}
+                # Saved before emailing, so a retry only re-sends the email
+                entry.result = result
+                db.session.commit()
+            client.email_invoice(result['invoice_id'])
+    except XeroRateLimitExceeded as e:
+        entry.status = XeroOutbox.PENDING
+        entry.next_attempt_at = datetime.utcnow() + timedelta(seconds=e.retry_after + 1)
+        entry.last_error = str(e)
+        outcome = 'deferred'
+    except Exception as e:
+        entry.attempts += 1
+        entry.last_error = str(e)[:2000]
+        permanent = any(marker in str(e).lower() for marker in _PERMANENT_ERRORS)
+        if permanent or entry.attempts >= int(config.get('XERO_OUTBOX_MAX_ATTEMPTS', 6)):
+            entry.status = XeroOutbox.FAILED
+            entry.completed_at = datetime.utcnow()
+            current_app.logger.error(f"Xero outbox entry {entry.id} failed after {entry.attempts} attempts: {e}")
+            outcome = 'failed'
+        else:
+            base = float(config.get('XERO_OUTBOX_BACKOFF_BASE', 30))
+            delay = min(base * (2 ** (entry.attempts - 1)), float(config.get('XERO_OUTBOX_BACKOFF_MAX', 3600)))
+            entry.status = XeroOutbox.PENDING
+            entry.next_attempt_at = datetime.utcnow() + timedelta(seconds=random.uniform(delay / 2, delay))
+            current_app.logger.warning(f"Xero outbox entry {entry.id} attempt {entry.attempts} failed: {e}")
+            outcome = 'retrying'
+    else:
+        entry.status = XeroOutbox.SENT
+        entry.completed_at = datetime.utcnow()
+        entry.last_error = None
+        # Store invoice reference in booking
+        if entry.booking is not None:
+            entry.booking.admin_notes = (entry.booking.admin_notes or '') + \
+                f"\nXero Invoice: {result.get('invoice_number')} (ID: {result.get('invoice_id')})"
+        outcome = 'sent'
+    entry.locked_at = None
+    db.session.commit()
+    return outcome
+
+
+@click.command('xero-outbox')
+@click.option('--loop', is_flag=True, help='Keep draining until stopped (worker process).')
+@click.option('--interval', type=float, default=None, help='Seconds between polls with --loop.')
+@click.option('--limit', type=int, default=None, help='Entries claimed per poll.')
+@with_appcontext
+def xero_outbox_command(loop, interval, limit):
+    """Send queued Xero operations."""
+    interval = interval or float(current_app.config.get('XERO_OUTBOX_POLL_INTERVAL', 2))
+    while True:
+        with track_job('xero_outbox'):
+            summary = drain_outbox(limit)
+        db.session.remove()
+        if any(summary.values()):
+            click.echo(f"Xero outbox: {summary['sent']} sent, {summary['retrying']} retrying, "
+                       f"{summary['deferred']} deferred, {summary['failed']} failed")
+        if not loop:
+            return
+        # Poll again straight away while there is a backlog
+        if not any(summary.values()):
+            time.sleep(interval)
+
+
+def init_xero_outbox(app):
+    """Register ``flask xero-outbox``."""
+    app.cli.add_command(xero_outbox_command)
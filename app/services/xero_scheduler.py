@@ -1,10 +1,32 @@
+import hashlib
 import os
 from datetime import datetime, timedelta, date
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from flask import current_app
+from sqlalchemy import insert, select, update
+from sqlalchemy.orm import joinedload
 from app import db
-from app.models import Booking, DirectDebitSchedule, Payment, PaymentStatus, PaymentMethod
-from app.utils.xero import XeroClient
+from app.models import Booking, DirectDebitSchedule, Payment, PaymentStatus, PaymentMethod, SyncCheckpoint
+from app.services.xero_contacts import ensure_contacts
+from app.utils.xero import XeroClient, XeroRateLimitExceeded, parse_xero_date
+
+
+# Invoices not emailed are retried by later runs for this many days
+UNSENT_INVOICE_RETRY_DAYS = 14
+
+# Invoice claims Xero keeps rejecting are given up after this many attempts or days
+INVOICE_CLAIM_MAX_ATTEMPTS = 5
+INVOICE_CLAIM_RETRY_DAYS = 14
+
+# Checkpoint holding the last Xero invoice modification applied by sync_invoice_statuses
+INVOICE_SYNC_CHECKPOINT = 'xero_invoice_status'
+
+# Local payment status for a Xero invoice status; other statuses leave the payment as is
+_INVOICE_PAYMENT_STATUS = {
+    'PAID': PaymentStatus.COMPLETED,
+    'VOIDED': PaymentStatus.CANCELLED,
+    'DELETED': PaymentStatus.CANCELLED,
+}
 
 
 class XeroInvoiceScheduler:
@@ -54,136 +76,405 @@ class XeroInvoiceScheduler:
         if not booking:
             return None
         
+        item = {
+            'booking': booking,
+            'amount': amount,
+            'due_date': due_date,
+            'description': description,
+        }
+        summary = self.create_scheduled_invoices([item])
+        key = self._invoice_key(item)
+        invoice = next((invoice for invoice in summary['invoices'] if invoice['transaction_id'] == key), None)
+        if invoice is None:
+            return None
+        return {
+            'success': True,
+            'invoice_id': invoice['invoice_id'],
+            'invoice_number': invoice['invoice_number']
+        }
+    
+    def create_scheduled_invoices(self, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Create invoices for many scheduled payments, up to 50 per Xero request.
+        
+        Each item has ``booking``, ``amount``, ``due_date`` and optionally
+        ``description`` / ``schedule_id``. Every invoice gets a deterministic key
+        (``XINV-<booking id>-<due date>``), used both as the Xero InvoiceNumber
+        and as the transaction_id of a pending ``Payment`` claim recorded before
+        anything is sent; items whose claim already has an invoice are skipped.
+        Before creating a batch, invoices already in Xero under those numbers
+        (say, from a request that timed out after Xero processed it) are looked
+        up and adopted instead of created again.
+        
+        Every run sends all claims still without an invoice, so items deferred
+        by the Xero rate limit or rejected by Xero are retried on the next run,
+        and re-sends invoices that were created but could not be emailed.
+        Each failed attempt is counted on the claim with its error; a claim is
+        given up (marked failed) after ``INVOICE_CLAIM_MAX_ATTEMPTS`` attempts
+        or ``INVOICE_CLAIM_RETRY_DAYS`` days. Rate-limit deferrals don't count.
+        
+        Returns ``{'created', 'skipped', 'deferred', 'invoices', 'failed', 'unsent', 'abandoned'}``,
+        where ``failed`` lists the items Xero rejected with their validation errors
+        and ``abandoned`` the claims given up by this run, with their last error.
+        """
+        summary = {'created': 0, 'skipped': 0, 'deferred': 0, 'invoices': [], 'failed': [], 'unsent': [],
+                   'abandoned': []}
+        self._claim_invoices(items, summary)
+        
+        pending = self._pending_claims(summary)
+        batch_size = min(int(current_app.config.get('XERO_INVOICE_BATCH_SIZE', 50)), XeroClient.MAX_INVOICES_PER_REQUEST)
+        for start in range(0, len(pending), batch_size):
+            try:
+                self._create_invoice_batch(pending[start:start + batch_size], summary)
+            except XeroRateLimitExceeded as e:
+                summary['deferred'] = len(pending) - start
+                current_app.logger.warning(f"Deferring {summary['deferred']} Xero invoices to the next run: {e}")
+                break
+        self._email_unsent_invoices(summary)
+        
+        for failure in summary['failed']:
+            current_app.logger.warning(
+                f"Xero invoice for booking {failure['booking_number']} due {failure['due_date']} failed: "
+                f"{'; '.join(failure['errors'])}")
+        for failure in summary['abandoned']:
+            current_app.logger.error(
+                f"Gave up on the Xero invoice for booking {failure['booking_number']} due {failure['due_date']}: "
+                f"{'; '.join(failure['errors'])}")
+        current_app.logger.info(
+            f"Scheduled Xero invoices: {summary['created']} created, {summary['skipped']} already invoiced, "
+            f"{summary['deferred']} deferred, {len(summary['failed'])} failed, {len(summary['unsent'])} not emailed")
+        return summary
+    
+    def _claim_invoices(self, items, summary):
+        """Bulk-insert a pending ``Payment`` for every item not recorded yet."""
+        keyed = {self._invoice_key(item): item for item in items}
+        if not keyed:
+            return
+        existing = dict(db.session.execute(
+            select(Payment.transaction_id, Payment.gateway_transaction_id).where(Payment.transaction_id.in_(list(keyed)))
+        ).all())
+        summary['skipped'] = sum(1 for key in keyed if existing.get(key))
+        claims = [
+            {
+                'transaction_id': key,
+                'booking_id': item['booking'].id,
+                'user_id': item['booking'].customer_id,
+                'amount': item['amount'],
+                'payment_method': PaymentMethod.DIRECT_DEBIT,
+                'status': PaymentStatus.PENDING,
+                'gateway': 'xero',
+                'gateway_transaction_id': None,
+                'gateway_response': {'due_date': item['due_date'].isoformat(), 'schedule_id': item.get('schedule_id')},
+                'description': item.get('description'),
+                'notes': f"Awaiting Xero invoice due {item['due_date']}",
+            }
+            for key, item in keyed.items()
+            if key not in existing
+        ]
+        if claims:
+            db.session.execute(insert(Payment), claims)
+            db.session.commit()
+    
+    def _pending_claims(self, summary) -> List[Dict[str, Any]]:
+        """Invoice claims that have no Xero invoice yet, from this run or earlier ones.
+        
+        Claims out of attempts or older than ``INVOICE_CLAIM_RETRY_DAYS`` are
+        marked failed instead and added to ``summary['abandoned']``.
+        """
+        payments = Payment.query.filter(
+            Payment.gateway == 'xero',
+            Payment.transaction_id.like('XINV-%'),
+            Payment.gateway_transaction_id.is_(None),
+            Payment.status == PaymentStatus.PENDING,
+        ).options(
+            joinedload(Payment.booking).joinedload(Booking.customer),
+            joinedload(Payment.booking).joinedload(Booking.car),
+        ).order_by(Payment.id).all()
+        cutoff = datetime.utcnow() - timedelta(days=INVOICE_CLAIM_RETRY_DAYS)
+        claims, abandoned = [], []
+        for payment in payments:
+            claim = {
+                'payment_id': payment.id,
+                'transaction_id': payment.transaction_id,
+                'booking': payment.booking,
+                'amount': payment.amount,
+                'due_date': date.fromisoformat(payment.gateway_response['due_date']),
+                'description': payment.description,
+                'schedule_id': payment.gateway_response.get('schedule_id'),
+                'gateway_response': payment.gateway_response,
+            }
+            attempts = payment.gateway_response.get('attempts', 0)
+            if attempts < INVOICE_CLAIM_MAX_ATTEMPTS and payment.created_at >= cutoff:
+                claims.append(claim)
+                continue
+            last_error = payment.gateway_response.get('last_error') or 'Invoice was not created'
+            summary['abandoned'].append(self._failure(claim, [last_error]))
+            abandoned.append({
+                'id': payment.id,
+                'status': PaymentStatus.FAILED,
+                'notes': f"Gave up on Xero invoice due {claim['due_date']} after {attempts} attempts: {last_error}",
+            })
+        if abandoned:
+            db.session.execute(update(Payment), abandoned)
+            db.session.commit()
+        return claims
+    
+    @staticmethod
+    def _failed_attempt(item, errors) -> Dict[str, Any]:
+        """Bulk update values counting a failed attempt at ``item``'s invoice."""
+        return {
+            'id': item['payment_id'],
+            'gateway_response': {**item['gateway_response'], 'attempts': item['gateway_response'].get('attempts', 0) + 1,
+                                 'last_error': '; '.join(errors)},
+            'notes': f"Xero rejected invoice due {item['due_date']}: {'; '.join(errors)}",
+        }
+    
+    def _create_invoice_batch(self, batch, summary):
+        keys = [item['transaction_id'] for item in batch]
         try:
-            # Prepare invoice data
-            invoice_data = {
-                'Type': 'ACCREC',  # Accounts Receivable
-                'Contact': {
-                    'Name': booking.customer.full_name,
-                    'EmailAddress': booking.customer.email,
-                    'Phones': [
-                        {
-                            'PhoneType': 'DEFAULT',
-                            'PhoneNumber': booking.customer.phone or ''
-                        }
-                    ],
-                    'Addresses': [
-                        {
-                            'AddressType': 'POBOX',
-                            'AddressLine1': booking.customer.address or '',
-                            'City': booking.customer.city or '',
-                            'Region': booking.customer.state or '',
-                            'PostalCode': booking.customer.zip_code or '',
-                            'Country': booking.customer.country or 'Australia'
+            # The Idempotency-Key only covers retries of this exact batch; the number lookup covers the rest
+            results = self.xero_client.get_invoices_by_number(keys)
+            missing = [item for item in batch if item['transaction_id'] not in results]
+            if missing:
+                contact_ids, contact_errors = ensure_contacts(self.xero_client,
+                                                              [item['booking'].customer for item in missing])
+                sendable = []
+                for item in missing:
+                    customer_id = item['booking'].customer_id
+                    if customer_id in contact_ids:
+                        sendable.append(item)
+                    else:
+                        # Reported like a rejected invoice, so the claim is retried next run
+                        messages = contact_errors.get(customer_id) or ['Xero contact was not saved']
+                        results[item['transaction_id']] = {
+                            'StatusAttributeString': 'ERROR',
+                            'ValidationErrors': [{'Message': message} for message in messages],
                         }
-                    ]
-                },
-                'Date': datetime.utcnow().strftime('%Y-%m-%d'),
-                'DueDate': due_date.strftime('%Y-%m-%d'),
-                'Reference': booking.booking_number,
-                'LineItems': [
-                    {
-                        'Description': description or f'Car Rental - {booking.car.full_name} - Booking {booking.booking_number}',
-                        'Quantity': 1,
-                        'UnitAmount': amount,
-                        'AccountCode': os.getenv('XERO_SALES_ACCOUNT_CODE', '200'),  # Sales account
-                        'TaxType': 'OUTPUT'  # GST on sales
-                    }
-                ],
-                'Status': 'AUTHORISED'  # Create as authorized invoice
-            }
-            
-            # Create invoice in Xero
-            response = self.xero_client.create_invoice(invoice_data)
-            
-            if response and 'Invoices' in response and len(response['Invoices']) > 0:
-                invoice = response['Invoices'][0]
-                invoice_id = invoice.get('InvoiceID')
-                invoice_number = invoice.get('InvoiceNumber')
-                
-                # Record the payment as pending
-                payment = Payment(
-                    booking_id=booking_id,
-                    user_id=booking.customer_id,
-                    amount=amount,
-                    payment_method=PaymentMethod.DIRECT_DEBIT,
-                    status=PaymentStatus.PENDING,
-                    transaction_id=invoice_number,
-                    payment_date=due_date,
-                    notes=f"Scheduled invoice: {invoice_number}"
-                )
-                db.session.add(payment)
-                
-                # Add note to booking
-                invoice_note = f"\nInvoice created: {invoice_number} for ${amount:.2f} due {due_date}"
-                if booking.admin_notes:
-                    booking.admin_notes += invoice_note
+                if sendable:
+                    idempotency_key = 'aurora-invoices-' + hashlib.sha256(
+                        '|'.join(item['transaction_id'] for item in sendable).encode()).hexdigest()[:48]
+                    created = self.xero_client.create_invoices(
+                        [self._invoice_payload(item, contact_ids[item['booking'].customer_id]) for item in sendable],
+                        idempotency_key=idempotency_key)
+                    results.update((item['transaction_id'], result) for item, result in zip(sendable, created))
+        except XeroRateLimitExceeded:
+            raise
+        except Exception as e:
+            # e.g. a failed flush in ensure_contacts; later batches and the emails need a usable session
+            db.session.rollback()
+            for item in batch:
+                summary['failed'].append(self._failure(item, [str(e)]))
+            db.session.execute(update(Payment), [self._failed_attempt(item, [str(e)]) for item in batch])
+            db.session.commit()
+            return
+        
+        updates = []
+        created = []
+        for item in batch:
+            result = results.get(item['transaction_id'], {})
+            booking = item['booking']
+            invoice_id = result.get('InvoiceID')
+            if result.get('StatusAttributeString') == 'ERROR' or result.get('HasErrors') or not invoice_id:
+                errors = [error.get('Message', '') for error in result.get('ValidationErrors') or []] \
+                    or ['Invoice was not created']
+                summary['failed'].append(self._failure(item, errors))
+                # The claim stays pending, so the next run tries again until it runs out of attempts
+                updates.append(self._failed_attempt(item, errors))
+                continue
+            invoice_number = result.get('InvoiceNumber')
+            updates.append({
+                'id': item['payment_id'],
+                'gateway_transaction_id': invoice_id,
+                'gateway_response': {**item['gateway_response'], 'invoice_number': invoice_number, 'emailed': False},
+                'notes': f"Scheduled invoice: {invoice_number} due {item['due_date']}",
+            })
+            # Add note to booking
+            invoice_note = f"\nInvoice created: {invoice_number} for ${item['amount']:.2f} due {item['due_date']}"
+            booking.admin_notes = (booking.admin_notes or '') + invoice_note
+            created.append({'booking_id': booking.id, 'transaction_id': item['transaction_id'],
+                            'invoice_id': invoice_id, 'invoice_number': invoice_number})
+        
+        # Record the invoices before emailing, so a failed email never loses one
+        if updates:
+            db.session.execute(update(Payment), updates)
+        db.session.commit()
+        summary['created'] += len(created)
+        summary['invoices'].extend(created)
+    
+    def _email_unsent_invoices(self, summary):
+        """Email scheduled invoices that are created but not yet sent, including earlier runs' leftovers."""
+        cutoff = datetime.utcnow() - timedelta(days=UNSENT_INVOICE_RETRY_DAYS)
+        payments = Payment.query.filter(
+            Payment.gateway == 'xero',
+            Payment.transaction_id.like('XINV-%'),
+            Payment.gateway_transaction_id.isnot(None),
+            Payment.status == PaymentStatus.PENDING,
+            Payment.created_at >= cutoff,
+        ).order_by(Payment.id).all()
+        unsent = [payment for payment in payments if (payment.gateway_response or {}).get('emailed') is False]
+        try:
+            for position, payment in enumerate(unsent):
+                invoice = {'booking_id': payment.booking_id, 'transaction_id': payment.transaction_id,
+                           'invoice_id': payment.gateway_transaction_id,
+                           'invoice_number': payment.gateway_response.get('invoice_number')}
+                try:
+                    self.xero_client.email_invoice(payment.gateway_transaction_id)
+                except XeroRateLimitExceeded as e:
+                    current_app.logger.warning(f"Deferring {len(unsent) - position} Xero invoice emails: {e}")
+                    summary['unsent'].extend(
+                        {'booking_id': p.booking_id, 'transaction_id': p.transaction_id,
+                         'invoice_id': p.gateway_transaction_id,
+                         'invoice_number': p.gateway_response.get('invoice_number')}
+                        for p in unsent[position:])
+                    break
+                except Exception as e:
+                    current_app.logger.warning(f"Failed to email Xero invoice {invoice['invoice_number']}: {e}")
+                    summary['unsent'].append(invoice)
                 else:
-                    booking.admin_notes = invoice_note
-                
-                db.session.commit()
-                
-                # Send invoice to customer
-                if invoice_id:
-                    self.xero_client.send_invoice(invoice_id)
-                
-                return {
-                    'success': True,
-                    'invoice_id': invoice_id,
-                    'invoice_number': invoice_number
+                    # JSON columns don't track in-place changes
+                    payment.gateway_response = {**payment.gateway_response, 'emailed': True}
+        finally:
+            db.session.commit()
+    
+    def _invoice_payload(self, item: Dict[str, Any], contact_id: str) -> Dict[str, Any]:
+        booking = item['booking']
+        return {
+            'Type': 'ACCREC',  # Accounts Receivable
+            'Contact': {'ContactID': contact_id},
+            'Date': datetime.utcnow().strftime('%Y-%m-%d'),
+            'DueDate': item['due_date'].strftime('%Y-%m-%d'),
+            'InvoiceNumber': item['transaction_id'],
+            'Reference': booking.booking_number,
+            'LineItems': [
+                {
+                    'Description': item.get('description') or f'Car Rental - {booking.car.full_name} - Booking {booking.booking_number}',
+                    'Quantity': 1,
+                    'UnitAmount': item['amount'],
+                    'AccountCode': os.getenv('XERO_SALES_ACCOUNT_CODE', '200'),  # Sales account
+                    'TaxType': 'OUTPUT'  # GST on sales
                 }
+            ],
+            'Status': 'AUTHORISED'  # Create as authorized invoice
+        }
+    
+    @staticmethod
+    def _invoice_key(item: Dict[str, Any]) -> str:
+        return f"XINV-{item['booking'].id}-{item['due_date'].strftime('%Y%m%d')}"
+    
+    @staticmethod
+    def _failure(item: Dict[str, Any], errors: List[str]) -> Dict[str, Any]:
+        return {
+            'booking_id': item['booking'].id,
+            'booking_number': item['booking'].booking_number,
+            'schedule_id': item.get('schedule_id'),
+            'due_date': item['due_date'],
+            'errors': errors,
+        }
+    
+    def sync_invoice_statuses(self) -> Dict[str, int]:
+        """
+        Mark scheduled invoice payments paid or cancelled from their Xero invoice status.
+        
+        Reads only invoices changed since the stored watermark (``If-Modified-Since``),
+        one page at a time, oldest change first. Each page is matched to local
+        payments by invoice number with one query, and the changed payments are
+        updated in one bulk statement. The watermark is saved after every page,
+        so an interrupted run resumes where it stopped.
+        
+        Returns ``{'pages', 'seen', 'matched', 'updated'}``.
+        """
+        summary = {'pages': 0, 'seen': 0, 'matched': 0, 'updated': 0}
+        checkpoint = SyncCheckpoint.load(INVOICE_SYNC_CHECKPOINT)
+        # Re-read the last second, in case Xero's check is strictly "after"; updates are idempotent
+        since = checkpoint.watermark - timedelta(seconds=1) if checkpoint.watermark else None
+        page = 1
+        while True:
+            invoices = self.xero_client.get_modified_invoices(page, modified_since=since)
+            summary['pages'] += 1
+            summary['seen'] += len(invoices)
             
-        except Exception as e:
-            print(f"Error creating scheduled invoice: {e}")
-            return None
+            wanted = {}
+            for invoice in invoices:
+                status = _INVOICE_PAYMENT_STATUS.get(invoice.get('Status'))
+                if status is not None and invoice.get('InvoiceNumber'):
+                    wanted[invoice['InvoiceNumber']] = (status, invoice)
+            if wanted:
+                payments = db.session.execute(
+                    select(Payment.id, Payment.transaction_id, Payment.status).where(
+                        Payment.gateway == 'xero',
+                        Payment.transaction_id.in_(list(wanted)),
+                    )
+                ).all()
+                summary['matched'] += len(payments)
+                updates = []
+                for payment_id, number, current in payments:
+                    status, invoice = wanted[number]
+                    # Only open payments move; a refund recorded locally is not overwritten
+                    if current not in (PaymentStatus.PENDING, PaymentStatus.PROCESSING):
+                        continue
+                    updates.append({
+                        'id': payment_id,
+                        'status': status,
+                        'processed_at': parse_xero_date(invoice.get('FullyPaidOnDate')) or datetime.utcnow(),
+                        'notes': f"Xero invoice {number} {invoice['Status'].lower()}",
+                    })
+                if updates:
+                    db.session.execute(update(Payment), updates)
+                summary['updated'] += len(updates)
+            
+            modified = [parse_xero_date(invoice.get('UpdatedDateUTC')) for invoice in invoices]
+            newest = max((value for value in modified if value), default=None)
+            if newest and (checkpoint.watermark is None or newest > checkpoint.watermark):
+                checkpoint.watermark = newest
+            db.session.commit()
+            if len(invoices) < self.xero_client.INVOICES_PAGE_SIZE:
+                break
+            page += 1
+        
+        current_app.logger.info(
+            f"Xero invoice status sync: {summary['seen']} changed invoices, {summary['matched']} ours, "
+            f"{summary['updated']} payments updated")
+        return summary
     
-    def check_and_create_due_invoices(self):
+    def check_and_create_due_invoices(self) -> Dict[str, Any]:
         """
         Check all active direct debit schedules and create invoices for payments due tomorrow.
         This should be run daily as a scheduled job.
+        
+        Only schedules whose ``next_due_date`` is tomorrow (or earlier, when a
+        run was missed) are read, through the (status, next_due_date) index.
+        Their ``next_due_date`` then moves to the following payment.
         """
         tomorrow = date.today() + timedelta(days=1)
         
-        # Get all active schedules
-        schedules = DirectDebitSchedule.query.filter_by(status='active').all()
+        # Due schedules with the bookings, customers and cars the invoices need
+        schedules = DirectDebitSchedule.query.filter(
+            DirectDebitSchedule.status == 'active',
+            DirectDebitSchedule.next_due_date <= tomorrow,
+        ).options(
+            joinedload(DirectDebitSchedule.booking).joinedload(Booking.customer),
+            joinedload(DirectDebitSchedule.booking).joinedload(Booking.car),
+        ).all()
         
+        items = []
         for schedule in schedules:
-            # Check if an invoice needs to be created based on the schedule
-            if self._should_create_invoice(schedule, tomorrow):
-                # Calculate the invoice amount
-                amount = schedule.recurring_amount
-                
-                # Create the invoice
-                self.create_scheduled_invoice(
-                    booking_id=schedule.booking_id,
-                    amount=amount,
-                    due_date=tomorrow,
-                    description=f"{schedule.description} - Payment due {tomorrow.strftime('%Y-%m-%d')}"
-                )
-    
-    def _should_create_invoice(self, schedule: DirectDebitSchedule, check_date: date) -> bool:
-        """
-        Determine if an invoice should be created for a given date based on the schedule.
-        """
-        if not schedule.recurring_start_date or not schedule.recurring_amount:
-            return False
-        
-        # Check if the date is after the start date
-        if check_date < schedule.recurring_start_date:
-            return False
-        
-        # Calculate based on frequency
-        days_since_start = (check_date - schedule.recurring_start_date).days
-        
-        if schedule.frequency == 'weekly':
-            return days_since_start % 7 == 0
-        elif schedule.frequency == 'fortnightly':
-            return days_since_start % 14 == 0
-        elif schedule.frequency == 'monthly':
-            # Check if it's the same day of the month
-            return check_date.day == schedule.recurring_start_date.day
-        
-        return False
+            # Payments of missed runs are not invoiced late, as before
+            if schedule.next_due_date < tomorrow:
+                schedule.next_due_date = schedule.due_date_on_or_after(tomorrow)
+            if schedule.next_due_date != tomorrow or not schedule.booking:
+                continue
+            items.append({
+                'booking': schedule.booking,
+                'schedule_id': schedule.schedule_id,
+                'amount': schedule.recurring_amount,
+                'due_date': tomorrow,
+                'description': f"{schedule.description} - Payment due {tomorrow.strftime('%Y-%m-%d')}",
+            })
+            schedule.advance_past(tomorrow)
+        # The advanced dates are committed with the invoice claims (or below when nothing was claimed)
+        summary = self.create_scheduled_invoices(items)
+        db.session.commit()
+        return summary
     
     def cancel_scheduled_invoices(self, booking_id: int) -> bool:
         """
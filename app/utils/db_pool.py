@@ -0,0 +1,143 @@
+"""Database connection pool settings and metrics.
+
+``configure_engine_options`` turns the ``DB_*`` settings in ``config.py`` into
+``SQLALCHEMY_ENGINE_OPTIONS`` (pool size, overflow, checkout timeout, recycle,
+pre-ping and a server-side statement timeout) for PostgreSQL and MySQL URLs.
+Explicit ``SQLALCHEMY_ENGINE_OPTIONS`` entries always win, and SQLite keeps
+SQLAlchemy's defaults.
+
+With ``DB_PGBOUNCER`` the options are safe for PgBouncer in transaction pooling
+mode. Consecutive transactions may run on different server connections, so:
+
+* no ``options`` startup parameter (PgBouncer rejects unknown ones) and no
+  session-level ``SET``; the statement timeout is applied per transaction with
+  ``SET LOCAL``,
+* server-side prepared statements are disabled for drivers that use them
+  (psycopg 3's ``prepare_threshold``; psycopg2 never prepares).
+
+The statement timeout is meant for web requests. Inside
+``statement_timeout_disabled()`` (``flask db-sync`` runs every schema step in
+it) each PostgreSQL transaction starts with ``SET LOCAL statement_timeout = 0``,
+so index builds and backfills on large tables are not cancelled.
+
+Every pool checkout is timed into the ``db_pool_checkout_wait_seconds``
+histogram, and checkouts that hit ``pool_timeout`` are counted in
+``db_pool_checkout_timeouts_total``.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+from app.utils.metrics import metrics
+
+_POOLED_BACKENDS = ('postgresql', 'mysql')
+
+_timeouts = threading.local()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that reports how long callers waited for a connection."""
+
+    metrics_bind = 'primary'
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            metrics.inc('db_pool_checkout_timeouts_total', {'bind': self.metrics_bind})
+            raise
+        finally:
+            metrics.observe('db_pool_checkout_wait_seconds', time.perf_counter() - started,
+                            {'bind': self.metrics_bind})
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics_bind = self.metrics_bind
+        return pool
+
+
+def engine_options(config, url) -> dict:
+    """Engine keyword arguments for ``url`` derived from the ``DB_*`` settings."""
+    if not url:
+        return {}
+    url = make_url(url)
+    if url.get_backend_name() not in _POOLED_BACKENDS:
+        return {}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(config.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(config.get('DB_MAX_OVERFLOW', 5)),
+        'pool_timeout': float(config.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(config.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': bool(config.get('DB_POOL_PRE_PING', True)),
+    }
+    connect_args = {}
+    timeout_ms = int(config.get('DB_STATEMENT_TIMEOUT_MS') or 0)
+    if url.get_backend_name() == 'postgresql':
+        if config.get('DB_PGBOUNCER'):
+            if url.get_driver_name() == 'psycopg':
+                connect_args['prepare_threshold'] = None
+        elif timeout_ms:
+            connect_args['options'] = f'-c statement_timeout={timeout_ms}'
+    if connect_args:
+        options['connect_args'] = connect_args
+    return options
+
+
+def configure_engine_options(app):
+    """Fill ``SQLALCHEMY_ENGINE_OPTIONS`` from the ``DB_*`` settings (call before ``db.init_app``)."""
+    computed = engine_options(app.config, app.config.get('SQLALCHEMY_DATABASE_URI'))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {**computed, **(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})}
+
+
+def init_db_pool(app):
+    """Label pool metrics per bind and apply the per-transaction statement timeout (after ``db.init_app``)."""
+    from app import db
+
+    timeout_ms = int(app.config.get('DB_STATEMENT_TIMEOUT_MS') or 0)
+    with app.app_context():
+        for key, engine in db.engines.items():
+            if isinstance(engine.pool, TimedQueuePool):
+                engine.pool.metrics_bind = key or 'primary'
+            if timeout_ms and engine.dialect.name == 'postgresql':
+                _set_local_statement_timeout(engine, timeout_ms, per_transaction=bool(app.config.get('DB_PGBOUNCER')))
+
+
+@contextmanager
+def statement_timeout_disabled():
+    """Run the enclosed database work (in this thread) without ``DB_STATEMENT_TIMEOUT_MS``."""
+    previous = statement_timeout_is_disabled()
+    _timeouts.disabled = True
+    try:
+        yield
+    finally:
+        _timeouts.disabled = previous
+
+
+def statement_timeout_is_disabled() -> bool:
+    return getattr(_timeouts, 'disabled', False)
+
+
+def _set_local_statement_timeout(engine, timeout_ms: int, per_transaction: bool):
+    @event.listens_for(engine, 'begin')
+    def _statement_timeout(conn):
+        apply_statement_timeout(conn, timeout_ms, per_transaction)
+
+
+def apply_statement_timeout(conn, timeout_ms: int, per_transaction: bool):
+    """``SET LOCAL`` the timeout of the transaction ``conn`` is starting.
+
+    Connections outside PgBouncer already have the timeout from their startup
+    options, so they only need the override that disables it.
+    """
+    if statement_timeout_is_disabled():
+        conn.exec_driver_sql('SET LOCAL statement_timeout = 0')
+    elif per_transaction:
+        conn.exec_driver_sql(f'SET LOCAL statement_timeout = {int(timeout_ms)}')
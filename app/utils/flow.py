@@ -0,0 +1,103 @@
+"""Timing and bounded concurrency for the steps of one long request.
+
+A :class:`Flow` records how long each named step of a request takes
+(``flow_step_duration_seconds{flow, step}``) and logs the breakdown when the
+request finishes, so slow requests show which step dominated. Independent
+I/O steps can run side by side on a per-process thread pool of
+``FLOW_MAX_WORKERS`` threads, each waited on for at most its timeout.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from typing import Any, Callable, Dict
+
+from flask import current_app
+
+from app.utils.metrics import metrics
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_flow_executor() -> ThreadPoolExecutor:
+    """Thread pool shared by every flow in this process (created after fork)."""
+    global _executor, _executor_pid
+    if _executor is not None and _executor_pid == os.getpid():
+        return _executor
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            workers = int(current_app.config.get('FLOW_MAX_WORKERS', 8))
+            _executor, _executor_pid = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='flow'), os.getpid()
+    return _executor
+
+
+class Flow:
+    """Step timings of one request, e.g. ``Flow('handover')``."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.timings: Dict[str, float] = {}
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def step(self, name: str):
+        """Time the enclosed block as step ``name``."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, time.perf_counter() - start)
+
+    def concurrently(self, steps: Dict[str, Callable[[], Any]], timeout: float) -> Dict[str, Any]:
+        """Run ``steps`` (name -> callable) on the pool and return their results by name.
+
+        Each callable runs in its own app context, so it must not touch ORM
+        objects of the calling request. Steps named ``kind:n`` share the
+        metric label ``kind``. The first failing step's exception is re-raised
+        once every step has finished; a step still running ``timeout`` seconds
+        after it was submitted raises ``TimeoutError`` (it keeps running in the
+        background and is still timed).
+        """
+        if not steps:
+            return {}
+        app = current_app._get_current_object()
+        executor = get_flow_executor()
+
+        def run(name, fn):
+            start = time.perf_counter()
+            try:
+                with app.app_context():
+                    return fn()
+            finally:
+                self._record(name, time.perf_counter() - start)
+
+        deadline = time.monotonic() + timeout
+        futures = {name: executor.submit(run, name, fn) for name, fn in steps.items()}
+        results, error = {}, None
+        for name, future in futures.items():
+            try:
+                results[name] = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except FutureTimeout:
+                error = error or TimeoutError(f"{self.name} step {name} did not finish within {timeout:g}s")
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+
+    def finish(self, outcome: str = 'ok') -> Dict[str, float]:
+        """Record the total and log the step breakdown, slowest first."""
+        total = time.perf_counter() - self._started
+        metrics.observe('flow_step_duration_seconds', total, {'flow': self.name, 'step': 'total'})
+        breakdown = ', '.join(f'{name}={seconds:.2f}s' for name, seconds in
+                              sorted(self.timings.items(), key=lambda item: item[1], reverse=True))
+        current_app.logger.info(f"{self.name} {outcome} in {total:.2f}s: {breakdown or 'no steps'}")
+        return dict(self.timings)
+
+    def _record(self, name, seconds):
+        self.timings[name] = seconds
+        metrics.observe('flow_step_duration_seconds', seconds, {'flow': self.name, 'step': name.split(':')[0]})
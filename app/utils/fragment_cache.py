@@ -0,0 +1,77 @@
+"""Jinja fragment cache: ``{% cache key, ttl %} ... {% endcache %}``.
+
+``key`` is any expression; lists and tuples are joined, so keys can combine a
+name, record ids and version tokens::
+
+    {% cache ['home-featured', cache_version('fleet')], 600 %}
+        {% for car in featured_cars %}...{% endfor %}
+    {% endcache %}
+
+The block body is only rendered on a miss, so views pass lazy values (query
+objects, callables) and a hit does no database work at all. ``ttl`` is in
+seconds and defaults to ``FRAGMENT_CACHE_DEFAULT_TTL``.
+
+``cache_version(*tags)`` returns the current version of cache tags such as
+``fleet``, ``bookings`` or ``car:12``. The invalidation bus
+(:mod:`app.utils.invalidation`) bumps them when matching rows are committed,
+which invalidates every fragment whose key includes them.
+
+Fragments are stored in the application cache (:mod:`app.cache`) under
+``fragment:<key>``, so they share its local and ``CACHE_TYPE`` tiers, its
+stampede protection and its stats; ``/metrics`` counts them as
+``cache_requests_total{cache="fragment"}``. ``FRAGMENT_CACHE_ENABLED=false``
+renders every block.
+"""
+
+from flask import current_app
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from app.cache import cache
+
+
+class FragmentCacheExtension(Extension):
+    """Adds the ``{% cache key[, ttl] %}...{% endcache %}`` tag."""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache_support', args), [], [], body).set_lineno(lineno)
+
+    def _cache_support(self, key, ttl, caller):
+        return Markup(cached_fragment(key, ttl, caller))
+
+
+def init_fragment_cache(app):
+    """Register the Jinja tag and the ``cache_version`` global."""
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.globals['cache_version'] = cache_version
+
+
+def cached_fragment(key, ttl, render) -> str:
+    """Return the cached fragment for ``key``, calling ``render()`` on a miss."""
+    if not current_app.config.get('FRAGMENT_CACHE_ENABLED', True):
+        return str(render())
+    if ttl is None:
+        ttl = current_app.config.get('FRAGMENT_CACHE_DEFAULT_TTL', 300)
+    return cache.get_or_set(f'fragment:{_format_key(key)}', lambda: str(render()), ttl, metric='fragment')
+
+
+def cache_version(*tags: str) -> str:
+    """Current version token(s) for the given cache tags, e.g. ``cache_version('fleet')``."""
+    return '.'.join(cache.tag_versions(tags).values())
+
+
+# --------------- Internals ---------------
+def _format_key(key) -> str:
+    if isinstance(key, (list, tuple)):
+        return ':'.join('' if part is None else str(part) for part in key)
+    return str(key)
@@ -0,0 +1,142 @@
+"""Model-change invalidation bus.
+
+Session events collect cache tags for every ``Car``, ``Booking``, ``Payment``
+and ``Maintenance`` row written in a flush (``after_flush``), and publish them
+through :meth:`app.cache.Cache.invalidate_tags` once the transaction commits
+(``after_commit``). Tag versions live in the shared cache backend, so every
+worker sees the change; a rollback discards the pending tags.
+
+Tags per model (see ``TAG_RULES``)::
+
+    Car          fleet, car:<id>
+    Booking      bookings, booking:<id>, car:<car_id>, user:<customer_id>:bookings
+    Payment      payments, booking:<booking_id>, revenue:<YYYY-MM-DD>
+    Maintenance  maintenance, fleet, car:<car_id>
+
+Bulk ``insert()`` (executemany) and ``query.update()`` / ``query.delete()``
+statements carry no row identities, so they publish the model's coarse tags
+(``fleet``, ``bookings``, ...) instead.
+"""
+
+from typing import Callable, Dict, Iterable, List, Set
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.orm import Session
+
+_PENDING_KEY = '_invalidation_pending_tags'
+
+# Extra listeners (e.g. tests, audit) notified with the published tag set
+_subscribers: List[Callable[[Set[str]], None]] = []
+
+
+def _car_tags(car) -> List[str]:
+    return ['fleet', f'car:{car.id}']
+
+
+def _booking_tags(booking) -> List[str]:
+    tags = ['bookings', f'booking:{booking.id}']
+    tags += [f'car:{car_id}' for car_id in _current_and_previous(booking, 'car_id')]
+    tags += [f'user:{user_id}:bookings' for user_id in _current_and_previous(booking, 'customer_id')]
+    return tags
+
+
+def _payment_tags(payment) -> List[str]:
+    tags = ['payments', f'booking:{payment.booking_id}']
+    for stamp in _current_and_previous(payment, 'created_at'):
+        tags.append(f'revenue:{stamp.date().isoformat()}')
+    for stamp in _current_and_previous(payment, 'processed_at'):
+        tags.append(f'revenue:{stamp.date().isoformat()}')
+    return tags
+
+
+def _maintenance_tags(record) -> List[str]:
+    return ['maintenance', 'fleet'] + [f'car:{car_id}' for car_id in _current_and_previous(record, 'car_id')]
+
+
+# Model name -> (per-row tag function, coarse tags for bulk statements)
+TAG_RULES: Dict[str, tuple] = {
+    'Car': (_car_tags, ['fleet']),
+    'Booking': (_booking_tags, ['bookings']),
+    'Payment': (_payment_tags, ['payments']),
+    'Maintenance': (_maintenance_tags, ['maintenance', 'fleet']),
+}
+
+
+def init_invalidation_bus():
+    """Attach the session listeners (once per process)."""
+    if getattr(init_invalidation_bus, '_registered', False):
+        return
+    event.listen(Session, 'after_flush', _collect_flushed_tags)
+    event.listen(Session, 'do_orm_execute', _collect_bulk_tags)
+    event.listen(Session, 'after_commit', _publish_pending_tags)
+    event.listen(Session, 'after_rollback', _discard_pending_tags)
+    init_invalidation_bus._registered = True
+
+
+def subscribe(callback: Callable[[Set[str]], None]):
+    """Call ``callback(tags)`` after each commit that published tags."""
+    _subscribers.append(callback)
+
+
+def publish(tags: Iterable[str]):
+    """Invalidate ``tags`` now, independent of any session."""
+    from app.cache import cache
+
+    tags = set(tags)
+    if not tags or not has_app_context():
+        return
+    try:
+        cache.invalidate_tags(*sorted(tags))
+    except Exception as e:
+        current_app.logger.warning(f"Cache tag invalidation failed for {sorted(tags)}: {e}")
+    for callback in list(_subscribers):
+        callback(tags)
+
+
+def tags_for(obj) -> List[str]:
+    """Cache tags affected by a change to ``obj`` (empty for untracked models)."""
+    rule = TAG_RULES.get(type(obj).__name__)
+    if rule is None:
+        return []
+    return rule[0](obj)
+
+
+# --------------- Session listeners ---------------
+def _collect_flushed_tags(session, flush_context):
+    pending = session.info.setdefault(_PENDING_KEY, set())
+    for obj in list(session.new) + list(session.deleted):
+        pending.update(tags_for(obj))
+    for obj in session.dirty:
+        if session.is_modified(obj, include_collections=False):
+            pending.update(tags_for(obj))
+
+
+def _collect_bulk_tags(orm_execute_state):
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    rule = TAG_RULES.get(mapper.class_.__name__) if mapper is not None else None
+    if rule is not None:
+        orm_execute_state.session.info.setdefault(_PENDING_KEY, set()).update(rule[1])
+
+
+def _publish_pending_tags(session):
+    tags = session.info.pop(_PENDING_KEY, None)
+    if tags:
+        publish(tags)
+
+
+def _discard_pending_tags(session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+def _current_and_previous(obj, attr: str) -> Set:
+    """Current value of ``attr`` plus its pre-change value when it was modified."""
+    values = set()
+    current = getattr(obj, attr, None)
+    if current is not None:
+        values.add(current)
+    history = sa_inspect(obj).attrs[attr].history
+    values.update(v for v in history.deleted if v is not None)
+    return values
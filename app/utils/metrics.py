@@ -0,0 +1,423 @@
+"""Prometheus-style metrics shared across gunicorn workers.
+
+Every process keeps its samples in memory and periodically writes them to
+``METRICS_DIR/<pid>-<start time>.json``; the start time keeps a process that
+reuses an old pid from overwriting the file of the one that exited. The
+``/metrics`` endpoint merges the files of all processes (web workers,
+``scheduled_tasks.py`` runs) and renders the Prometheus text exposition format,
+so counters and histograms are aggregated no matter which worker answers the
+scrape.
+
+Counters and histograms from processes that have exited are kept (they are
+cumulative): each scrape folds their files into ``aggregate.json`` and deletes
+them, so the directory doesn't grow with every run. Gauges are only reported
+for processes that are still alive.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; files are then never compacted
+    fcntl = None
+
+# Samples of exited processes, and the names of the files already folded into it
+AGGREGATE_FILE = 'aggregate.json'
+_LOCK_FILE = '.lock'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class MetricsRegistry:
+    """In-process metric store with file based cross-process aggregation."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families: Dict[str, dict] = {}
+        self._samples: Dict[str, Dict[LabelKey, object]] = {}
+        self._collectors: List[Callable[[], Iterable[Tuple[str, Dict[str, str], float]]]] = []
+        self.directory: Optional[str] = None
+        self.flush_interval = 5.0
+        self._last_flush = 0.0
+        self._file_pid = None
+        self._file_name = None
+
+    # --------------- Registration ---------------
+    def counter(self, name: str, help_text: str):
+        self._register(name, 'counter', help_text)
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self._register(name, 'histogram', help_text, buckets=tuple(sorted(buckets)))
+
+    def gauge(self, name: str, help_text: str):
+        self._register(name, 'gauge', help_text)
+
+    def add_collector(self, collector: Callable[[], Iterable[Tuple[str, Dict[str, str], float]]]):
+        """Register a callable yielding ``(gauge_name, labels, value)`` at flush time."""
+        self._collectors.append(collector)
+
+    def _register(self, name, kind, help_text, buckets=None):
+        with self._lock:
+            self._families.setdefault(name, {'type': kind, 'help': help_text, 'buckets': buckets})
+            self._samples.setdefault(name, {})
+
+    # --------------- Recording ---------------
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None, value: float = 1.0):
+        key = _label_key(labels)
+        with self._lock:
+            samples = self._samples[name]
+            samples[key] = samples.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, str]] = None):
+        key = _label_key(labels)
+        buckets = self._families[name]['buckets']
+        with self._lock:
+            samples = self._samples[name]
+            entry = samples.get(key)
+            if entry is None:
+                entry = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+                samples[key] = entry
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry['buckets'][i] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    @contextmanager
+    def timer(self, name: str, labels: Optional[Dict[str, str]] = None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    # --------------- Persistence ---------------
+    def configure(self, directory: str, flush_interval: float):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+
+    def maybe_flush(self):
+        if self.directory and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write this process' samples to the shared directory."""
+        if not self.directory:
+            return
+        gauges: Dict[str, Dict[LabelKey, float]] = {}
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    gauges.setdefault(name, {})[_label_key(labels)] = value
+            except Exception:
+                continue
+        with self._lock:
+            state = {
+                'pid': os.getpid(),
+                'samples': {name: [[list(map(list, key)), value] for key, value in samples.items()]
+                            for name, samples in self._samples.items() if samples},
+                'gauges': {name: [[list(map(list, key)), value] for key, value in samples.items()]
+                           for name, samples in gauges.items()},
+            }
+            payload = json.dumps(state)
+        try:
+            _write_atomic(os.path.join(self.directory, self._own_file()), payload)
+            self._last_flush = time.monotonic()
+        except OSError:
+            pass
+
+    def _own_file(self) -> str:
+        # Named on first flush in each process (gunicorn workers fork after import)
+        pid = os.getpid()
+        if self._file_pid != pid:
+            self._file_pid = pid
+            self._file_name = f'{pid}-{time.time_ns()}.json'
+        return self._file_name
+
+    def _is_live(self, filename: str, state: dict) -> bool:
+        pid = state.get('pid')
+        if pid == os.getpid():
+            return filename == self._own_file()
+        return _pid_alive(pid)
+
+    def compact(self) -> int:
+        """Fold the files of exited processes into ``aggregate.json``, delete them and return how many."""
+        if not self.directory or fcntl is None or not os.path.isdir(self.directory):
+            return 0
+        with open(os.path.join(self.directory, _LOCK_FILE), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return 0  # another process is compacting
+            aggregate = self._load_aggregate()
+            folded = set(aggregate['folded'])
+            samples = {name: {tuple(tuple(pair) for pair in key): value for key, value in rows}
+                       for name, rows in aggregate['samples'].items()}
+            dead = []
+            for filename, state in self._read_states(locked=True):
+                if filename == AGGREGATE_FILE or filename in folded or self._is_live(filename, state):
+                    continue
+                for name, rows in state.get('samples', {}).items():
+                    target = samples.setdefault(name, {})
+                    for key, value in rows:
+                        _add_sample(target, tuple(tuple(pair) for pair in key), value)
+                dead.append(filename)
+            if not dead:
+                return 0
+            # Folded names are remembered until their files are gone, so a crash before
+            # the deletes below never counts a file twice
+            existing = set(os.listdir(self.directory))
+            aggregate = {
+                'pid': None,
+                'folded': sorted(name for name in folded if name in existing) + dead,
+                'samples': {name: [[list(map(list, key)), value] for key, value in rows.items()]
+                            for name, rows in samples.items()},
+            }
+            try:
+                _write_atomic(os.path.join(self.directory, AGGREGATE_FILE), json.dumps(aggregate))
+            except OSError:
+                return 0
+            for filename in dead:
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+            return len(dead)
+
+    def _load_aggregate(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, AGGREGATE_FILE), 'r') as f:
+                aggregate = json.load(f)
+        except (OSError, ValueError):
+            aggregate = {}
+        return {'folded': aggregate.get('folded', []), 'samples': aggregate.get('samples', {})}
+
+    # --------------- Exposition ---------------
+    def render(self) -> str:
+        """Merge every process' samples and render the Prometheus text format."""
+        self.flush()
+        self.compact()
+        merged: Dict[str, Dict[LabelKey, object]] = {name: {} for name in self._families}
+        folded = set()
+        states = list(self._read_states())
+        for filename, state in states:
+            if filename == AGGREGATE_FILE:
+                folded = set(state.get('folded', []))
+        for filename, state in states:
+            if filename in folded:
+                continue
+            alive = filename != AGGREGATE_FILE and self._is_live(filename, state)
+            for section in ('samples', 'gauges'):
+                if section == 'gauges' and not alive:
+                    continue
+                for name, rows in state.get(section, {}).items():
+                    if name not in self._families:
+                        continue
+                    target = merged[name]
+                    for key, value in rows:
+                        _add_sample(target, tuple(tuple(pair) for pair in key), value)
+
+        lines = []
+        for name in sorted(self._families):
+            family = self._families[name]
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['type']}")
+            for key, value in sorted(merged[name].items()):
+                if family['type'] == 'histogram':
+                    for bound, count in zip(family['buckets'], value['buckets']):
+                        lines.append(f"{name}_bucket{_format_labels(key + (('le', _format_float(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(key + (('le', '+Inf'),))} {value['count']}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {_format_float(value['sum'])}")
+                    lines.append(f"{name}_count{_format_labels(key)} {value['count']}")
+                else:
+                    lines.append(f"{name}{_format_labels(key)} {_format_float(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def _read_states(self, locked: bool = False):
+        """``(filename, state)`` of every metrics file, read while no compaction is running.
+
+        ``locked`` when the caller already holds the compaction lock.
+        """
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        lock = None
+        if fcntl is not None and not locked:
+            try:
+                lock = open(os.path.join(self.directory, _LOCK_FILE), 'a')
+                fcntl.flock(lock, fcntl.LOCK_SH)
+            except OSError:
+                pass
+        try:
+            for filename in os.listdir(self.directory):
+                if not filename.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(self.directory, filename), 'r') as f:
+                        yield filename, json.load(f)
+                except (OSError, ValueError):
+                    continue
+        finally:
+            if lock is not None:
+                lock.close()
+
+
+def _add_sample(target: Dict[LabelKey, object], key: LabelKey, value):
+    """Add a counter value or histogram entry to ``target[key]``."""
+    if isinstance(value, dict):
+        entry = target.get(key)
+        if entry is None:
+            target[key] = {'buckets': list(value['buckets']), 'sum': value['sum'], 'count': value['count']}
+        else:
+            entry['buckets'] = [a + b for a, b in zip(entry['buckets'], value['buckets'])]
+            entry['sum'] += value['sum']
+            entry['count'] += value['count']
+    else:
+        target[key] = target.get(key, 0.0) + value
+
+
+def _write_atomic(path: str, payload: str):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+
+
+def _label_key(labels: Optional[Dict[str, str]]) -> LabelKey:
+    if not labels:
+        return ()
+    return tuple(sorted((str(k), '' if v is None else str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey) -> str:
+    if not key:
+        return ''
+    parts = []
+    for name, value in key:
+        value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_float(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _pid_alive(pid) -> bool:
+    if not pid:
+        return False
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Process-wide registry and the metric families used across the app
+metrics = MetricsRegistry()
+metrics.histogram('http_request_duration_seconds', 'HTTP request latency by blueprint and endpoint.')
+metrics.histogram('outbound_request_duration_seconds', 'Latency of calls to external services (Xero, PayAdvantage).')
+metrics.histogram('background_job_duration_seconds', 'Duration of scheduled/background jobs.')
+metrics.counter('background_job_failures_total', 'Scheduled/background job runs that raised.')
+metrics.counter('cache_requests_total', 'Cache lookups by cache name and result (hit/miss).')
+metrics.gauge('db_pool_connections', 'Database connection pool usage by state.')
+metrics.histogram('db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled database connection.',
+                  buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+metrics.counter('db_pool_checkout_timeouts_total', 'Connection checkouts that gave up after pool_timeout.')
+metrics.counter('db_replica_routing_total', 'Requests in @use_replica views by the database they read from.')
+metrics.histogram('xero_rate_limit_wait_seconds', 'Time Xero calls waited for a rate-limit permit.',
+                  buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+metrics.counter('xero_rate_limit_rejections_total', 'Xero calls deferred because no rate-limit permit was available.')
+metrics.histogram('flow_step_duration_seconds', 'Duration of each step of multi-step requests such as handover.')
+
+
+def init_metrics(app):
+    """Configure the shared metrics directory and request timing hooks."""
+    from flask import g, request
+
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    directory = app.config.get('METRICS_DIR') or os.path.join(app.instance_path, 'metrics')
+    metrics.configure(directory, float(app.config.get('METRICS_FLUSH_INTERVAL', 5)))
+
+    @app.before_request
+    def _start_request_timer():
+        g._metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        started = g.pop('_metrics_started', None)
+        if started is not None:
+            metrics.observe('http_request_duration_seconds', time.perf_counter() - started, {
+                'blueprint': request.blueprint or '',
+                'endpoint': request.endpoint or 'unmatched',
+                'method': request.method,
+                'status': str(response.status_code),
+            })
+            metrics.maybe_flush()
+        return response
+
+    if not getattr(init_metrics, '_process_hooks', False):
+        metrics.add_collector(_db_pool_usage)
+        atexit.register(metrics.flush)
+        init_metrics._process_hooks = True
+
+
+def _db_pool_usage():
+    from flask import has_app_context
+    from app import db
+    if not has_app_context():
+        return
+    pool = db.engine.pool
+    for state, getter in (('size', 'size'), ('checked_out', 'checkedout'),
+                          ('checked_in', 'checkedin'), ('overflow', 'overflow')):
+        fn = getattr(pool, getter, None)
+        if callable(fn):
+            yield 'db_pool_connections', {'state': state}, float(fn())
+
+
+def observe_outbound(service: str, method: str, status, seconds: float):
+    """Record the latency of one call to an external service."""
+    metrics.observe('outbound_request_duration_seconds', seconds, {
+        'service': service,
+        'method': method,
+        'status': str(status),
+    })
+
+
+def record_cache_access(cache: str, hit: bool):
+    """Count a cache lookup; hit ratio is hits / (hits + misses)."""
+    metrics.inc('cache_requests_total', {'cache': cache, 'result': 'hit' if hit else 'miss'})
+
+
+def record_replica_routing(target: str):
+    """Count a read-only request served by ``replica`` or falling back to ``primary``."""
+    metrics.inc('db_replica_routing_total', {'target': target})
+
+
+@contextmanager
+def track_job(name: str):
+    """Time a background job and count failures; flushes so short-lived processes are visible."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.inc('background_job_failures_total', {'job': name})
+        raise
+    finally:
+        metrics.observe('background_job_duration_seconds', time.perf_counter() - start, {'job': name})
+        metrics.flush()
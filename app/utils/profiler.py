@@ -0,0 +1,278 @@
+"""On-demand request profiler for managers.
+
+A request is profiled when a logged-in manager adds ``?_profile=1`` to the URL,
+or when the request carries a valid signed ``X-Profile-Token`` header (tokens
+are issued from the admin profiles page). The request runs under pyinstrument
+when it is installed, otherwise under cProfile. Each profile is written to
+``PROFILER_DIR`` together with a small JSON summary (timing and SQL query
+counts) that backs the index page under ``/admin/settings/profiles``.
+"""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from flask import current_app, g, has_request_context, request
+from flask_login import current_user
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    from pyinstrument import Profiler as _Pyinstrument
+except Exception:
+    _Pyinstrument = None
+
+PROFILE_HEADER = 'X-Profile-Token'
+_TOKEN_SALT = 'request-profiler'
+
+
+def init_profiler(app):
+    """Register the profiling hooks on the application."""
+    if not app.config.get('PROFILER_ENABLED'):
+        return
+
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+    app.teardown_request(_discard_profile)
+
+    if not getattr(init_profiler, '_sql_hooked', False):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        init_profiler._sql_hooked = True
+
+
+def generate_profile_token(user_id: int) -> str:
+    """Return a signed token that enables profiling via the X-Profile-Token header."""
+    return _serializer().dumps({'user_id': user_id})
+
+
+def list_profiles(limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Return stored profile summaries, newest first."""
+    directory = _profile_dir()
+    if not os.path.isdir(directory):
+        return []
+    summaries = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name), 'r') as f:
+                summaries.append(json.load(f))
+        except Exception:
+            continue
+    summaries.sort(key=lambda s: s.get('created_at', ''), reverse=True)
+    return summaries[:limit] if limit else summaries
+
+
+def get_profile(profile_id: str) -> Optional[Dict[str, Any]]:
+    """Return the summary for a stored profile, or None if it does not exist."""
+    if not _valid_id(profile_id):
+        return None
+    path = os.path.join(_profile_dir(), f'{profile_id}.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def profile_file_path(summary: Dict[str, Any]) -> str:
+    """Absolute path of the raw profile output described by ``summary``."""
+    return os.path.join(_profile_dir(), summary['filename'])
+
+
+def render_profile_text(summary: Dict[str, Any], limit: int = 60) -> str:
+    """Human readable report for a stored cProfile profile."""
+    if summary.get('engine') != 'cprofile':
+        return ''
+    out = io.StringIO()
+    stats = pstats.Stats(profile_file_path(summary), stream=out)
+    stats.strip_dirs().sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+
+def delete_profile(profile_id: str) -> bool:
+    """Remove a stored profile and its summary."""
+    summary = get_profile(profile_id)
+    if not summary:
+        return False
+    for path in (profile_file_path(summary), os.path.join(_profile_dir(), f'{profile_id}.json')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return True
+
+
+# --------------- Request hooks ---------------
+def _start_profile():
+    if not _profiling_requested():
+        return
+    g._profile = {
+        'id': f"{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}",
+        'started': time.perf_counter(),
+        'query_count': 0,
+        'query_time': 0.0,
+    }
+    try:
+        if _Pyinstrument is not None:
+            profiler = _Pyinstrument()
+            profiler.start()
+            g._profile['engine'] = 'pyinstrument'
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            g._profile['engine'] = 'cprofile'
+    except ValueError as e:
+        # Another profiler is already active on this thread
+        current_app.logger.warning(f"Request profiling skipped: {e}")
+        g.pop('_profile', None)
+        return
+    g._profile['profiler'] = profiler
+
+
+def _finish_profile(response):
+    state = g.pop('_profile', None)
+    if not state:
+        return response
+    profiler = state['profiler']
+    if state['engine'] == 'pyinstrument':
+        profiler.stop()
+    else:
+        profiler.disable()
+    duration = time.perf_counter() - state['started']
+
+    try:
+        summary = _store_profile(state, profiler, response, duration)
+        response.headers['X-Profile-Id'] = summary['id']
+        response.headers['X-Profile-Duration-Ms'] = f"{summary['duration_ms']:.1f}"
+        response.headers['X-Profile-Queries'] = str(summary['query_count'])
+    except Exception as e:
+        current_app.logger.warning(f"Could not store request profile: {e}")
+    return response
+
+
+def _discard_profile(exc):
+    # Make sure a profiler never stays enabled when the request errored out
+    state = g.pop('_profile', None)
+    if not state:
+        return
+    try:
+        if state['engine'] == 'pyinstrument':
+            state['profiler'].stop()
+        else:
+            state['profiler'].disable()
+    except Exception:
+        pass
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    state = _active_state()
+    if state is not None:
+        conn.info.setdefault('_profile_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    state = _active_state()
+    if state is None:
+        return
+    starts = conn.info.get('_profile_query_start')
+    if starts:
+        state['query_time'] += time.perf_counter() - starts.pop()
+    state['query_count'] += 1
+
+
+# --------------- Internals ---------------
+def _profiling_requested() -> bool:
+    if request.endpoint == 'static':
+        return False
+    token = request.headers.get(PROFILE_HEADER)
+    if token:
+        try:
+            payload = _serializer().loads(token, max_age=current_app.config.get('PROFILER_TOKEN_MAX_AGE', 3600))
+        except BadSignature:
+            current_app.logger.warning('Rejected invalid profiling token')
+            return False
+        # The token only stands in for a manager's session; a demoted or deleted user's tokens stop working
+        from app import db
+        from app.models import User
+        user = db.session.get(User, payload.get('user_id')) if isinstance(payload, dict) else None
+        if user is None or not user.is_active or not user.is_manager:
+            current_app.logger.warning('Rejected profiling token for a non-manager user')
+            return False
+        return True
+    if request.args.get('_profile') not in ('1', 'true'):
+        return False
+    return bool(current_user.is_authenticated and current_user.is_manager)
+
+
+def _active_state() -> Optional[Dict[str, Any]]:
+    if not has_request_context():
+        return None
+    return g.get('_profile')
+
+
+def _store_profile(state, profiler, response, duration) -> Dict[str, Any]:
+    directory = _profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    profile_id = state['id']
+
+    if state['engine'] == 'pyinstrument':
+        filename = f'{profile_id}.html'
+        with open(os.path.join(directory, filename), 'w') as f:
+            f.write(profiler.output_html())
+    else:
+        filename = f'{profile_id}.prof'
+        profiler.dump_stats(os.path.join(directory, filename))
+
+    summary = {
+        'id': profile_id,
+        'engine': state['engine'],
+        'filename': filename,
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'status_code': response.status_code,
+        'duration_ms': duration * 1000.0,
+        'query_count': state['query_count'],
+        'query_time_ms': state['query_time'] * 1000.0,
+        'user': current_user.email if current_user and current_user.is_authenticated else None,
+        'pid': os.getpid(),
+        'created_at': datetime.utcnow().isoformat(),
+    }
+    with open(os.path.join(directory, f'{profile_id}.json'), 'w') as f:
+        json.dump(summary, f)
+
+    _prune(directory, current_app.config.get('PROFILER_MAX_PROFILES', 200))
+    return summary
+
+
+def _prune(directory: str, keep: int):
+    if not keep:
+        return
+    summaries = sorted(n for n in os.listdir(directory) if n.endswith('.json'))
+    for name in summaries[:-keep]:
+        profile_id = name[:-len('.json')]
+        for ext in ('.json', '.prof', '.html'):
+            try:
+                os.remove(os.path.join(directory, profile_id + ext))
+            except OSError:
+                pass
+
+
+def _profile_dir() -> str:
+    return current_app.config.get('PROFILER_DIR') or os.path.join(current_app.instance_path, 'profiles')
+
+
+def _serializer() -> URLSafeTimedSerializer:
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt=_TOKEN_SALT)
+
+
+def _valid_id(profile_id: str) -> bool:
+    return bool(profile_id) and all(c.isalnum() or c == '_' for c in profile_id)
@@ -0,0 +1,144 @@
+"""Read-replica routing for reports and analytics.
+
+When ``SQLALCHEMY_REPLICA_URL`` is configured it is registered as the
+``replica`` entry of ``SQLALCHEMY_BINDS``. Views decorated with
+:func:`use_replica` then send their ORM reads (``db.session`` and
+``Model.query``) to the replica; flushes and anything outside the decorator
+keep using the primary::
+
+    @bp.route('/revenue')
+    @login_required
+    @manager_required
+    @use_replica
+    def revenue():
+        ...
+
+Before routing a request to the replica its replication lag is checked (at
+most every ``REPLICA_LAG_CHECK_INTERVAL`` seconds per worker). If the lag is
+above ``REPLICA_MAX_LAG_SECONDS`` or the replica cannot be reached, the request
+falls back to the primary. Only decorate views that do not write.
+"""
+
+import threading
+import time
+from functools import wraps
+from typing import Optional
+
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import text
+
+from app.utils.metrics import record_replica_routing
+
+REPLICA_BIND = 'replica'
+
+_G_FLAG = '_db_use_replica'
+
+# Per-process lag probe result: (checked_at monotonic, lag seconds or None when unreachable)
+_lag_state = {'checked_at': None, 'lag': None}
+_lag_lock = threading.Lock()
+
+_PG_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+
+class RoutingSession(Session):
+    """Session that sends reads to the replica inside :func:`use_replica`."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context() and g.get(_G_FLAG):
+            engine = self._db.engines.get(REPLICA_BIND)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def configure_replica_bind(app):
+    """Register ``SQLALCHEMY_REPLICA_URL`` as the ``replica`` bind (call before ``db.init_app``)."""
+    url = app.config.get('SQLALCHEMY_REPLICA_URL')
+    if not url:
+        return
+    if url.startswith('postgres://'):
+        url = url.replace('postgres://', 'postgresql://', 1)
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    # Binds don't inherit SQLALCHEMY_ENGINE_OPTIONS; give the replica the same pool settings
+    binds.setdefault(REPLICA_BIND, {**(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}), 'url': url})
+    app.config['SQLALCHEMY_BINDS'] = binds
+
+
+def use_replica(f):
+    """Decorator routing a read-only view's queries to the replica when it is healthy."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        previous = g.get(_G_FLAG, False)
+        setattr(g, _G_FLAG, replica_available())
+        try:
+            return f(*args, **kwargs)
+        finally:
+            setattr(g, _G_FLAG, previous)
+    return decorated_function
+
+
+def replica_available() -> bool:
+    """True when a replica is configured, reachable and within the lag threshold."""
+    from app import db
+
+    if REPLICA_BIND not in current_app.config.get('SQLALCHEMY_BINDS', {}):
+        return False
+    lag = replica_lag()
+    max_lag = float(current_app.config.get('REPLICA_MAX_LAG_SECONDS', 30))
+    if lag is None or lag > max_lag:
+        record_replica_routing('primary')
+        return False
+    # Pending changes would be invisible on the replica; keep read-your-writes
+    if db.session.new or db.session.dirty or db.session.deleted:
+        record_replica_routing('primary')
+        return False
+    record_replica_routing('replica')
+    return True
+
+
+def replica_lag() -> Optional[float]:
+    """Replication lag in seconds (cached per worker), or None if the replica is unreachable."""
+    interval = float(current_app.config.get('REPLICA_LAG_CHECK_INTERVAL', 5))
+    now = time.monotonic()
+    with _lag_lock:
+        checked_at = _lag_state['checked_at']
+        if checked_at is not None and now - checked_at < interval:
+            return _lag_state['lag']
+        # Claim the probe so concurrent requests reuse the previous value meanwhile
+        _lag_state['checked_at'] = now
+
+    lag = _probe_lag()
+    with _lag_lock:
+        _lag_state['lag'] = lag
+    if lag is None or lag > float(current_app.config.get('REPLICA_MAX_LAG_SECONDS', 30)):
+        current_app.logger.warning(f"Replica unavailable or lagging ({lag} s); reports use the primary")
+    return lag
+
+
+def reset_replica_lag():
+    """Forget the cached lag so the next request probes again."""
+    with _lag_lock:
+        _lag_state['checked_at'] = None
+        _lag_state['lag'] = None
+
+
+def _probe_lag() -> Optional[float]:
+    from app import db
+
+    engine = db.engines[REPLICA_BIND]
+    try:
+        with engine.connect() as conn:
+            if engine.dialect.name != 'postgresql':
+                conn.execute(text('SELECT 1'))
+                return 0.0
+            return float(conn.execute(text(_PG_LAG_SQL)).scalar() or 0)
+    except Exception as e:
+        current_app.logger.warning(f"Replica lag check failed: {e}")
+        return None
@@ -0,0 +1,327 @@
+"""Versioned schema sync, run explicitly via ``flask db-sync``.
+
+Table creation, PostgreSQL enum sync and the partial/unique index fix-ups used
+to run inside ``create_app()`` on every worker boot. They now live here as an
+ordered list of numbered steps. The highest applied step is recorded in the
+``schema_version`` table, so once the database is current a sync is a single
+``SELECT`` and app startup performs no DDL at all.
+
+To change the schema, append a new step to ``SCHEMA_STEPS`` with the next
+version number; never edit or renumber a step that has already shipped.
+"""
+
+from contextlib import contextmanager
+from datetime import date, datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text
+
+from app import db
+from app.utils.db_pool import statement_timeout_disabled
+
+# Kept out of db.metadata so create_all()/drop_all() in tests never touch it
+_schema_metadata = MetaData()
+schema_version_table = Table(
+    'schema_version',
+    _schema_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('applied_at', DateTime, nullable=False, default=datetime.utcnow),
+)
+
+# Arbitrary key for pg_advisory_lock so concurrent deploys don't sync at once
+_PG_LOCK_KEY = 727001
+
+
+# --------------- Steps ---------------
+def _create_tables():
+    import app.models  # noqa: F401 - register every model on db.metadata
+    # Primary only; a configured read replica receives DDL through replication
+    db.create_all(bind_key=None)
+
+
+def _sync_car_category_enum():
+    if db.engine.dialect.name != 'postgresql':
+        return
+    from app.models.car import CarCategory
+    with db.engine.begin() as conn:
+        existing_values = set(
+            row[0]
+            for row in conn.execute(
+                text(
+                    """
+                    SELECT e.enumlabel
+                    FROM pg_type t
+                    JOIN pg_enum e ON t.oid = e.enumtypid
+                    WHERE t.typname = :type_name
+                    """
+                ),
+                {"type_name": "carcategory"},
+            )
+        )
+        for member in CarCategory:
+            if member.value not in existing_values:
+                conn.execute(
+                    text("ALTER TYPE carcategory ADD VALUE IF NOT EXISTS :val"),
+                    {"val": member.value},
+                )
+
+
+def _payments_idempotency_index():
+    if db.engine.dialect.name != 'postgresql':
+        return
+    with db.engine.begin() as conn:
+        conn.execute(
+            text(
+                """
+                CREATE UNIQUE INDEX IF NOT EXISTS uq_payments_gateway_txn_payadvantage
+                ON payments (booking_id, gateway, gateway_transaction_id)
+                WHERE gateway = 'payadvantage' AND gateway_transaction_id IS NOT NULL
+                """
+            )
+        )
+
+
+def _cars_partial_unique_indexes():
+    """VIN and license plate are unique only among active cars."""
+    if db.engine.dialect.name != 'postgresql':
+        return
+    with db.engine.begin() as conn:
+        conn.execute(text("ALTER TABLE cars DROP CONSTRAINT IF EXISTS cars_vin_key"))
+        conn.execute(text("ALTER TABLE cars DROP CONSTRAINT IF EXISTS cars_license_plate_key"))
+        conn.execute(text("DROP INDEX IF EXISTS cars_vin_key"))
+        conn.execute(text("DROP INDEX IF EXISTS cars_license_plate_key"))
+        conn.execute(
+            text(
+                """
+                CREATE UNIQUE INDEX IF NOT EXISTS uq_cars_vin_active
+                ON cars (vin)
+                WHERE is_active = true
+                """
+            )
+        )
+        conn.execute(
+            text(
+                """
+                CREATE UNIQUE INDEX IF NOT EXISTS uq_cars_license_plate_active
+                ON cars (license_plate)
+                WHERE is_active = true
+                """
+            )
+        )
+
+
+# Secondary indexes for the hot filters in app/routes, scheduled_tasks.py and
+# the Pay Advantage/Xero services: (name, table, columns, partial WHERE or None).
+# Enum columns store member names, hence 'IN_PROGRESS' rather than 'in_progress'.
+WORKLOAD_INDEXES = [
+    # Status counts on the dashboards, the confirmed -> in-progress sweep in
+    # bookings.index and the admin "active bookings" counts
+    ('ix_bookings_status', 'bookings', ['status'], None),
+    # Next-available date per car (car_id IN / status IN / return_date >=,
+    # ordered by return_date), availability overlap checks and the
+    # "car has active bookings" guards
+    ('ix_bookings_car_status_return', 'bookings', ['car_id', 'status', 'return_date'], None),
+    # "My bookings" pages, user profile stats and recent bookings, ordered by created_at
+    ('ix_bookings_customer_created', 'bookings', ['customer_id', 'created_at'], None),
+    ('ix_bookings_driver_created', 'bookings', ['driver_id', 'created_at'], None),
+    # Dashboard recent bookings and per-day booking counts
+    ('ix_bookings_created_at', 'bookings', ['created_at'], None),
+    # Overdue sweep in scheduled_tasks.py; only the few in-progress rows are indexed
+    ('ix_bookings_in_progress_return', 'bookings', ['return_date'], "status = 'IN_PROGRESS'"),
+    # Completed revenue totals and per-day/per-month revenue charts
+    ('ix_payments_status_created', 'payments', ['status', 'created_at'], None),
+    # Payments of a booking (booking view, payments tab, duplicate payment checks)
+    ('ix_payments_booking_created', 'payments', ['booking_id', 'created_at'], None),
+    ('ix_payments_user_id', 'payments', ['user_id'], None),
+    # schedule.installments and the installment upsert lookup in the Pay Advantage sync
+    ('ix_dd_installments_schedule_due', 'direct_debit_installments', ['schedule_id', 'due_date'], None),
+    # Installment table on the admin booking payments view, ordered by due_date
+    ('ix_dd_installments_booking_due', 'direct_debit_installments', ['booking_id', 'due_date'], None),
+    ('ix_dd_schedules_booking_id', 'direct_debit_schedules', ['booking_id'], None),
+]
+
+
+def workload_index_ddl(name, table, columns, where=None, concurrently=False) -> str:
+    sql = f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+    if where:
+        sql += f" WHERE {where}"
+    return sql
+
+
+def _create_indexes(indexes):
+    """Create ``(name, table, columns, where)`` indexes; on PostgreSQL without blocking writes."""
+    if db.engine.dialect.name != 'postgresql':
+        with db.engine.begin() as conn:
+            for name, table, columns, where in indexes:
+                conn.execute(text(workload_index_ddl(name, table, columns, where)))
+        return
+    # CONCURRENTLY can't run in a transaction, so SET LOCAL doesn't apply; the
+    # session timeout is lifted for this connection and reset before it returns to the pool
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text("SET statement_timeout = 0"))
+        try:
+            # An interrupted CONCURRENTLY build leaves an invalid index that IF NOT EXISTS would keep
+            invalid = conn.execute(text(
+                "SELECT c.relname FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+                "WHERE NOT i.indisvalid AND c.relname = ANY(:names)"
+            ), {"names": [name for name, *_ in indexes]}).scalars().all()
+            for name in invalid:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+            for name, table, columns, where in indexes:
+                conn.execute(text(workload_index_ddl(name, table, columns, where, concurrently=True)))
+        finally:
+            conn.execute(text("RESET statement_timeout"))
+
+
+def _workload_indexes():
+    _create_indexes(WORKLOAD_INDEXES)
+
+
+def _xero_outbox():
+    # Databases synced before this step already ran create_tables
+    from app.models import XeroOutbox
+    XeroOutbox.__table__.create(db.engine, checkfirst=True)
+
+
+def _xero_contacts():
+    from app.models import XeroContact
+    XeroContact.__table__.create(db.engine, checkfirst=True)
+
+
+def _sync_checkpoints():
+    from app.models import SyncCheckpoint
+    SyncCheckpoint.__table__.create(db.engine, checkfirst=True)
+
+
+def _webhook_events():
+    from app.models import WebhookEvent
+    WebhookEvent.__table__.create(db.engine, checkfirst=True)
+
+
+def _dd_schedule_next_due_date():
+    from app.models import DirectDebitSchedule
+    columns = {column['name'] for column in inspect(db.engine).get_columns('direct_debit_schedules')}
+    if 'next_due_date' not in columns:
+        with db.engine.begin() as conn:
+            conn.execute(text("ALTER TABLE direct_debit_schedules ADD COLUMN next_due_date DATE"))
+    _create_indexes([('ix_dd_schedules_status_next_due', 'direct_debit_schedules', ['status', 'next_due_date'], None)])
+    # Existing schedules: the next payment from today (the daily job never invoiced past dates)
+    today = date.today()
+    schedules = DirectDebitSchedule.query.filter(DirectDebitSchedule.next_due_date.is_(None),
+                                                 DirectDebitSchedule.recurring_start_date.isnot(None)).all()
+    for schedule in schedules:
+        schedule.next_due_date = schedule.due_date_on_or_after(today)
+    db.session.commit()
+
+
+def _projected_installments():
+    from app.models import ProjectedInstallment
+    ProjectedInstallment.__table__.create(db.engine, checkfirst=True)
+
+
+# (version, name, callable) - append only
+SCHEMA_STEPS = [
+    (1, 'create_tables', _create_tables),
+    (2, 'sync_car_category_enum', _sync_car_category_enum),
+    (3, 'payments_idempotency_index', _payments_idempotency_index),
+    (4, 'cars_partial_unique_indexes', _cars_partial_unique_indexes),
+    (5, 'workload_indexes', _workload_indexes),
+    (6, 'xero_outbox', _xero_outbox),
+    (7, 'xero_contacts', _xero_contacts),
+    (8, 'sync_checkpoints', _sync_checkpoints),
+    (9, 'webhook_events', _webhook_events),
+    (10, 'dd_schedule_next_due_date', _dd_schedule_next_due_date),
+    (11, 'projected_installments', _projected_installments),
+]
+
+LATEST_SCHEMA_VERSION = SCHEMA_STEPS[-1][0]
+
+
+# --------------- Public API ---------------
+def current_schema_version() -> int:
+    """Highest applied step, or 0 if the database has never been synced."""
+    try:
+        with db.engine.connect() as conn:
+            version = conn.execute(select(func.max(schema_version_table.c.version))).scalar()
+    except Exception:
+        # Table does not exist yet
+        return 0
+    return version or 0
+
+
+def schema_is_current() -> bool:
+    return current_schema_version() >= LATEST_SCHEMA_VERSION
+
+
+def sync_schema(force: bool = False) -> list:
+    """Apply pending schema steps and return the names of the steps that ran.
+
+    With ``force`` every step is re-run (they are all idempotent), which is
+    useful after restoring a database dump that predates the version table.
+    """
+    if not force and schema_is_current():
+        return []
+
+    applied = []
+    # Index builds and backfills may take longer than the web statement timeout
+    with statement_timeout_disabled(), _sync_lock():
+        _schema_metadata.create_all(db.engine)
+        # Re-read under the lock; another process may have finished meanwhile
+        current = 0 if force else current_schema_version()
+        for version, name, step in SCHEMA_STEPS:
+            if version <= current:
+                continue
+            current_app.logger.info(f"Applying schema step {version}: {name}")
+            step()
+            with db.engine.begin() as conn:
+                conn.execute(schema_version_table.delete().where(schema_version_table.c.version == version))
+                conn.execute(schema_version_table.insert().values(
+                    version=version, name=name, applied_at=datetime.utcnow()))
+            applied.append(name)
+    return applied
+
+
+def init_schema(app):
+    """Register ``flask db-sync`` and, when SCHEMA_AUTO_SYNC is set, sync on startup."""
+    app.cli.add_command(db_sync_command)
+
+    if app.config.get('SCHEMA_AUTO_SYNC'):
+        with app.app_context():
+            try:
+                sync_schema()
+            except Exception as e:
+                app.logger.warning(f"Schema auto-sync failed: {e}")
+
+
+@click.command('db-sync')
+@click.option('--check', is_flag=True, help='Exit with status 1 if the schema is out of date; change nothing.')
+@click.option('--force', is_flag=True, help='Re-run every step even if the recorded version is current.')
+@with_appcontext
+def db_sync_command(check, force):
+    """Create tables and apply pending schema steps."""
+    current = current_schema_version()
+    if check:
+        click.echo(f"Schema version {current}, latest {LATEST_SCHEMA_VERSION}")
+        raise SystemExit(0 if current >= LATEST_SCHEMA_VERSION else 1)
+
+    applied = sync_schema(force=force)
+    if applied:
+        click.echo(f"Applied schema steps: {', '.join(applied)}")
+    click.echo(f"Schema is current (version {LATEST_SCHEMA_VERSION})")
+
+
+@contextmanager
+def _sync_lock():
+    """Session-level advisory lock on PostgreSQL; a no-op elsewhere."""
+    if db.engine.dialect.name != 'postgresql':
+        yield
+        return
+    with db.engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": _PG_LOCK_KEY})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": _PG_LOCK_KEY})
@@ -0,0 +1,123 @@
+"""Post-fork worker warm-up.
+
+A fresh gunicorn worker otherwise pays for mapper configuration, database
+connects, Jinja compilation and storage client creation on its first
+requests. ``gunicorn.conf.py`` calls :func:`warm_up` from ``post_worker_init``
+so that work happens before the worker accepts traffic, and ``/api/ready``
+only reports ready once it has finished.
+
+Other modules can add their own priming (e.g. hot caches) with
+:func:`register_warmup_task`.
+"""
+
+import time
+from typing import Callable, Dict, List, Tuple
+
+from flask import current_app
+
+from app import db
+
+_tasks: List[Tuple[str, Callable[[], object]]] = []
+
+
+def register_warmup_task(name: str, fn: Callable[[], object]):
+    """Run ``fn`` inside an app context during warm-up; its return value is reported."""
+    if all(existing != name for existing, _ in _tasks):
+        _tasks.append((name, fn))
+
+
+def init_warmup(app):
+    """Track warm-up state; apps not started by gunicorn are ready immediately."""
+    app.extensions['warmup'] = {
+        'ready': not app.config.get('WARMUP_ON_FORK'),
+        'steps': {},
+        'duration_ms': None,
+    }
+
+
+def is_ready(app=None) -> bool:
+    app = app or current_app
+    return bool(app.extensions.get('warmup', {}).get('ready'))
+
+
+def warmup_state(app=None) -> Dict:
+    app = app or current_app
+    return app.extensions.get('warmup', {})
+
+
+def warm_up(app) -> Dict:
+    """Run every warm-up step and mark the app ready; failures are logged, never raised."""
+    state = app.extensions.setdefault('warmup', {'ready': False, 'steps': {}, 'duration_ms': None})
+    started = time.perf_counter()
+    steps = [
+        ('mappers', _configure_mappers),
+        ('db_connections', lambda: _open_pool_connections(app.config.get('WARMUP_DB_CONNECTIONS', 2))),
+        ('templates', lambda: _compile_templates(app)),
+        ('storage', _init_storage),
+    ] + list(_tasks)
+
+    with app.app_context():
+        for name, step in steps:
+            step_started = time.perf_counter()
+            try:
+                result = step()
+                state['steps'][name] = {
+                    'ok': True,
+                    'result': result,
+                    'ms': round((time.perf_counter() - step_started) * 1000, 1),
+                }
+            except Exception as e:
+                app.logger.warning(f"Warm-up step '{name}' failed: {e}")
+                state['steps'][name] = {'ok': False, 'error': str(e)}
+        # The warm-up checkouts must not stay bound to this context's session
+        db.session.remove()
+
+    state['duration_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    state['ready'] = True
+    app.logger.info(f"Worker warm-up finished in {state['duration_ms']} ms")
+    return state
+
+
+# --------------- Steps ---------------
+def _configure_mappers():
+    from sqlalchemy.orm import configure_mappers
+    import app.models  # noqa: F401
+    configure_mappers()
+
+
+def _open_pool_connections(count: int) -> int:
+    """Check out ``count`` connections at once so the pool holds that many open."""
+    if count <= 0:
+        return 0
+    pool = db.engine.pool
+    limit = getattr(pool, 'size', None)
+    if callable(limit):
+        # Don't spill into overflow connections, which are closed again on return
+        count = min(count, limit())
+    connections = []
+    try:
+        for _ in range(count):
+            conn = db.engine.connect()
+            conn.exec_driver_sql('SELECT 1')
+            connections.append(conn)
+    finally:
+        for conn in connections:
+            conn.close()
+    return len(connections)
+
+
+def _compile_templates(app) -> int:
+    env = app.jinja_env
+    compiled = 0
+    for name in env.list_templates(extensions=['html']):
+        try:
+            env.get_template(name)
+            compiled += 1
+        except Exception as e:
+            app.logger.debug(f"Warm-up could not compile template {name}: {e}")
+    return compiled
+
+
+def _init_storage() -> str:
+    from app.services.storage import get_storage
+    return get_storage().provider
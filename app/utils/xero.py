@@ -1,12 +1,218 @@
 import base64
 import json
+import os
+import random
 import secrets
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlencode
-import requests
-from flask import current_app, url_for
+from flask import current_app, has_request_context, url_for
 from app import db
 from app.models import XeroToken
+from app.utils.metrics import observe_outbound
+from app.utils.xero_rate_limit import XeroRateLimitExceeded, xero_rate_limiter  # noqa: F401 - re-exported for callers
+
+# Keep-alive session shared by every Xero call in this process (see get_xero_session)
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+# Access tokens cached per tenant: key -> (CachedXeroToken, loaded_at monotonic)
+_token_cache = {}
+_token_cache_lock = threading.Lock()
+_token_refresh_locks = {}
+
+# Set while the outbox worker performs an operation an admin asked for (see interactive_calls)
+_interactive = threading.local()
+
+_IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def get_xero_session():
+    """Pooled ``requests.Session`` for Xero, created once per process (after fork)."""
+    global _session, _session_pid
+    if _session is not None and _session_pid == os.getpid():
+        return _session
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            # Imported on first call; requests is slow to import and most processes never call out
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            pool_size = int(current_app.config.get('XERO_HTTP_POOL_SIZE', 10))
+            session = requests.Session()
+            # Retries are handled in xero_request so Retry-After and idempotency can be honoured
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session, _session_pid = session, os.getpid()
+    return _session
+
+
+@contextmanager
+def interactive_calls():
+    """Treat Xero calls in this block as made for a waiting user (``urgent``)."""
+    previous = getattr(_interactive, 'active', False)
+    _interactive.active = True
+    try:
+        yield
+    finally:
+        _interactive.active = previous
+
+
+def xero_request(method, url, **kwargs):
+    """Issue an HTTP request to Xero with timeouts and retries, recording each attempt's latency.
+
+    Throttling (429) and failed connects are always retried, the former after
+    the ``Retry-After`` delay. 5xx responses, read timeouts and dropped
+    connections are retried only when repeating the call is safe: idempotent
+    methods, or POSTs carrying an ``Idempotency-Key``, which is added
+    automatically to calls against the accounting API. The call gives
+    up once the next wait would exceed ``XERO_RETRY_BUDGET`` seconds and
+    returns the last response (or re-raises the last connection error).
+
+    Tenant API calls (those with a ``Xero-tenant-id`` header) wait for a
+    permit from the shared rate limiter first. ``urgent`` defaults to True
+    inside a web request or :func:`interactive_calls`; background calls may
+    not use the daily reserve and raise ``XeroRateLimitExceeded`` when they
+    have to be deferred.
+    """
+    import requests
+
+    config = current_app.config
+    method = method.upper()
+    urgent = kwargs.pop('urgent', None)
+    if urgent is None:
+        urgent = has_request_context() or getattr(_interactive, 'active', False)
+    kwargs.setdefault('timeout', (float(config.get('XERO_CONNECT_TIMEOUT', 3.05)),
+                                  float(config.get('XERO_READ_TIMEOUT', 20))))
+    headers = dict(kwargs.pop('headers', None) or {})
+    if method not in _IDEMPOTENT_METHODS and url.startswith(XeroClient.XERO_API_URL):
+        headers.setdefault('Idempotency-Key', uuid.uuid4().hex)
+    kwargs['headers'] = headers
+    can_repeat = method in _IDEMPOTENT_METHODS or 'Idempotency-Key' in headers
+    tenant_id = headers.get('Xero-tenant-id') if config.get('XERO_RATE_LIMIT_ENABLED', True) else None
+
+    max_retries = int(config.get('XERO_MAX_RETRIES', 3))
+    budget = float(config.get('XERO_RETRY_BUDGET', 30))
+    session = get_xero_session()
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        lease = xero_rate_limiter.acquire(tenant_id, urgent) if tenant_id else None
+        attempt_start = time.perf_counter()
+        status = 'error'
+        error = None
+        response = None
+        try:
+            response = session.request(method, url, **kwargs)
+            status = response.status_code
+        except requests.exceptions.ConnectionError as e:
+            # A dropped connection may come after Xero got the body; only a failed connect is always safe to repeat
+            error = e
+            retryable = can_repeat or _never_sent(e)
+        except requests.exceptions.Timeout as e:
+            error = e
+            retryable = can_repeat
+        else:
+            retryable = status == 429 or (status in _RETRY_STATUSES and can_repeat)
+        finally:
+            observe_outbound('xero', method, status, time.perf_counter() - attempt_start)
+            if lease is not None:
+                xero_rate_limiter.release(tenant_id, lease, response)
+
+        if not retryable or attempt >= max_retries:
+            if error is not None:
+                raise error
+            return response
+        delay = _retry_delay(response, attempt, float(config.get('XERO_BACKOFF_BASE', 0.5)))
+        if time.monotonic() - started + delay > budget:
+            if error is not None:
+                raise error
+            return response
+        current_app.logger.warning(
+            f"Xero {method} {url} failed ({error or status}); retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+        time.sleep(delay)
+        attempt += 1
+
+
+def _never_sent(error):
+    """True if a ``requests`` connection error happened before the request could reach Xero."""
+    import requests
+    from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def parse_xero_date(value):
+    """Naive UTC datetime from Xero's ``/Date(1573755038314+0000)/`` format (or ISO 8601)."""
+    if not value:
+        return None
+    if value.startswith('/Date('):
+        millis = int(value[6:].split(')')[0].split('+')[0].split('-')[0])
+        return datetime.utcfromtimestamp(millis / 1000)
+    return datetime.fromisoformat(value.rstrip('Z'))
+
+
+def _retry_delay(response, attempt, backoff_base):
+    """Seconds to wait before the next attempt: Retry-After if given, else jittered exponential backoff."""
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            pass
+        try:
+            when = parsedate_to_datetime(retry_after)
+            return max((when - datetime.now(when.tzinfo)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, backoff_base * (2 ** attempt))
+
+
+class CachedXeroToken:
+    """Read-only copy of a ``XeroToken`` row, safe to share between requests and threads."""
+
+    __slots__ = ('id', 'access_token', 'tenant_id', 'tenant_name', 'expires_at')
+
+    def __init__(self, token):
+        self.id = token.id
+        self.access_token = token.access_token
+        self.tenant_id = token.tenant_id
+        self.tenant_name = token.tenant_name
+        self.expires_at = token.expires_at
+
+    # Same thresholds as XeroToken
+    is_expired = XeroToken.is_expired
+    needs_refresh = XeroToken.needs_refresh
+
+
+def invalidate_xero_token_cache():
+    """Drop this process's cached tokens (after reconnecting or disconnecting Xero)."""
+    with _token_cache_lock:
+        _token_cache.clear()
+
+
+def _cached_token(key):
+    ttl = float(current_app.config.get('XERO_TOKEN_CACHE_TTL', 60))
+    with _token_cache_lock:
+        entry = _token_cache.get(key)
+    if entry is None or time.monotonic() - entry[1] > ttl or entry[0].needs_refresh:
+        return None
+    return entry[0]
+
+
+def _refresh_lock_for(key):
+    with _token_cache_lock:
+        return _token_refresh_locks.setdefault(key, threading.Lock())
 
 
 class XeroClient:
@@ -16,6 +222,10 @@ class XeroClient:
     XERO_TOKEN_URL = 'https://identity.xero.com/connect/token'
     XERO_CONNECTIONS_URL = 'https://api.xero.com/connections'
     XERO_API_URL = 'https://api.xero.com/api.xro/2.0'
+    MAX_INVOICES_PER_REQUEST = 50
+    # Xero's largest Contacts / Invoices pages
+    CONTACTS_PAGE_SIZE = 1000
+    INVOICES_PAGE_SIZE = 1000
     
     def __init__(self):
         self.client_id = current_app.config.get('XERO_CLIENT_ID')
@@ -51,7 +261,7 @@ class XeroClient:
             'redirect_uri': self.callback_url
         }
         
-        response = requests.post(self.XERO_TOKEN_URL, headers=headers, data=data)
+        response = xero_request('POST', self.XERO_TOKEN_URL, headers=headers, data=data)
         
         if response.status_code == 200:
             return response.json()
@@ -70,7 +280,7 @@ class XeroClient:
             'refresh_token': refresh_token
         }
         
-        response = requests.post(self.XERO_TOKEN_URL, headers=headers, data=data)
+        response = xero_request('POST', self.XERO_TOKEN_URL, headers=headers, data=data)
         
         if response.status_code == 200:
             return response.json()
@@ -84,49 +294,87 @@ class XeroClient:
             'Content-Type': 'application/json'
         }
         
-        response = requests.get(self.XERO_CONNECTIONS_URL, headers=headers)
+        response = xero_request('GET', self.XERO_CONNECTIONS_URL, headers=headers)
         
         if response.status_code == 200:
             return response.json()
         else:
             raise Exception(f"Failed to get connections: {response.text}")
     
-    def get_valid_token(self):
-        """Get a valid access token, refreshing if necessary."""
-        # Get the latest token from database
-        token = XeroToken.query.order_by(XeroToken.created_at.desc()).first()
+    def get_valid_token(self, tenant_id=None):
+        """Get a valid access token (latest connection by default), refreshing if necessary.
+
+        Tokens are cached in-process until they near expiry (re-read from the
+        database at least every ``XERO_TOKEN_CACHE_TTL`` seconds). Refreshes are
+        single-flight: one thread per process, and one process across workers
+        thanks to a row lock on ``xero_tokens``, so a refresh token is never
+        spent twice.
+        """
+        key = tenant_id or '_latest'
+        token = _cached_token(key)
+        if token is not None:
+            return token
+
+        with _refresh_lock_for(key):
+            # Another thread may have refreshed while we waited
+            token = _cached_token(key)
+            if token is None:
+                token = self._load_or_refresh_token(tenant_id)
+                with _token_cache_lock:
+                    _token_cache[key] = (token, time.monotonic())
+        return token
+
+    def _load_or_refresh_token(self, tenant_id=None):
+        query = XeroToken.query
+        if tenant_id:
+            query = query.filter_by(tenant_id=tenant_id)
+        token = query.order_by(XeroToken.created_at.desc()).first()
         
         if not token:
             raise Exception("No Xero token found. Please authorize the application first.")
         
-        # Check if token needs refresh
-        if token.needs_refresh:
-            try:
-                # Refresh the token
-                token_data = self.refresh_access_token(token.refresh_token)
-                
-                # Update the token in database
-                token.update_tokens(token_data)
-                db.session.commit()
-                
-                current_app.logger.info("Xero token refreshed successfully")
-            except Exception as e:
-                current_app.logger.error(f"Failed to refresh Xero token: {str(e)}")
-                raise
+        cached = CachedXeroToken(token)
+        if not cached.needs_refresh:
+            return cached
         
-        return token
+        try:
+            return self._refresh_token_locked(token.id)
+        except Exception as e:
+            current_app.logger.error(f"Failed to refresh Xero token: {str(e)}")
+            raise
+
+    def _refresh_token_locked(self, token_id):
+        """Refresh under ``SELECT ... FOR UPDATE`` so concurrent workers queue behind one refresh."""
+        from sqlalchemy.orm import Session
+
+        with Session(db.engine, expire_on_commit=False) as session:
+            with session.begin():
+                token = session.get(XeroToken, token_id, with_for_update=True)
+                if token is None:
+                    raise Exception("Xero token was removed. Please authorize the application again.")
+                if token.needs_refresh:
+                    token.update_tokens(self.refresh_access_token(token.refresh_token))
+                    current_app.logger.info("Xero token refreshed successfully")
+                # else: another worker refreshed it while we waited for the lock
+            return CachedXeroToken(token)
     
-    def create_invoice(self, booking_data, invoice_amount, due_date):
-        """Create an invoice in Xero."""
+    def create_invoice(self, booking_data, invoice_amount, due_date, idempotency_key=None, contact_id=None):
+        """Create an invoice in Xero.
+        
+        Pass a stable ``idempotency_key`` when the same invoice may be submitted
+        again later (the outbox worker uses one per entry), and the customer's
+        ``contact_id`` (see ``app.services.xero_contacts``) so Xero doesn't have
+        to match the contact by name.
+        """
         token = self.get_valid_token()
         
         if not token.tenant_id:
             raise Exception("No tenant ID found. Please reconnect to Xero.")
         
-        # Prepare invoice data
-        invoice = {
-            "Type": "ACCREC",  # Accounts Receivable invoice
-            "Contact": {
+        if contact_id:
+            contact = {"ContactID": contact_id}
+        else:
+            contact = {
                 "Name": booking_data.get('customer_name'),
                 "EmailAddress": booking_data.get('customer_email'),
                 "Phones": [
@@ -135,7 +383,12 @@ class XeroClient:
                         "PhoneNumber": booking_data.get('customer_phone', '')
                     }
                 ]
-            },
+            }
+        
+        # Prepare invoice data
+        invoice = {
+            "Type": "ACCREC",  # Accounts Receivable invoice
+            "Contact": contact,
             "Date": datetime.utcnow().strftime("%Y-%m-%d"),
             "DueDate": due_date.strftime("%Y-%m-%d") if isinstance(due_date, datetime) else due_date,
             "Reference": booking_data.get('booking_number'),
@@ -160,7 +413,11 @@ class XeroClient:
             'Accept': 'application/json'
         }
         
-        response = requests.post(
+        if idempotency_key:
+            headers['Idempotency-Key'] = idempotency_key
+        
+        response = xero_request(
+            'POST',
             f"{self.XERO_API_URL}/Invoices",
             headers=headers,
             json={"Invoices": [invoice]}
@@ -172,6 +429,173 @@ class XeroClient:
         else:
             raise Exception(f"Failed to create invoice: {response.text}")
     
+    def create_invoices(self, invoices, idempotency_key=None):
+        """Create up to ``MAX_INVOICES_PER_REQUEST`` invoices in one call.
+
+        Sent with ``summarizeErrors=false``, so one invalid invoice doesn't
+        reject the batch: the result list matches ``invoices`` in order and each
+        entry has ``StatusAttributeString`` ``OK`` or ``ERROR`` (with
+        ``ValidationErrors``). Pass a deterministic ``idempotency_key`` so a
+        repeated batch returns the original result instead of duplicating.
+        """
+        if len(invoices) > self.MAX_INVOICES_PER_REQUEST:
+            raise ValueError(f"Xero accepts at most {self.MAX_INVOICES_PER_REQUEST} invoices per request")
+        token = self.get_valid_token()
+        
+        if not token.tenant_id:
+            raise Exception("No tenant ID found. Please reconnect to Xero.")
+        
+        headers = {
+            'Authorization': f'Bearer {token.access_token}',
+            'Xero-tenant-id': token.tenant_id,
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        }
+        if idempotency_key:
+            headers['Idempotency-Key'] = idempotency_key
+        
+        response = xero_request(
+            'POST',
+            f"{self.XERO_API_URL}/Invoices",
+            params={'summarizeErrors': 'false'},
+            headers=headers,
+            json={"Invoices": invoices}
+        )
+        
+        if response.status_code in [200, 201]:
+            return response.json().get('Invoices', [])
+        else:
+            raise Exception(f"Failed to create invoices: {response.text}")
+    
+    def get_invoices_by_number(self, invoice_numbers):
+        """Existing (not deleted) invoices with the given numbers, keyed by InvoiceNumber."""
+        if not invoice_numbers:
+            return {}
+        token = self.get_valid_token()
+        headers = {
+            'Authorization': f'Bearer {token.access_token}',
+            'Xero-tenant-id': token.tenant_id,
+            'Accept': 'application/json'
+        }
+        response = xero_request(
+            'GET',
+            f"{self.XERO_API_URL}/Invoices",
+            params={'InvoiceNumbers': ','.join(invoice_numbers), 'summaryOnly': 'true'},
+            headers=headers
+        )
+        if response.status_code != 200:
+            raise Exception(f"Failed to look up invoices: {response.text}")
+        return {
+            invoice['InvoiceNumber']: invoice
+            for invoice in response.json().get('Invoices', [])
+            if invoice.get('Status') != 'DELETED'
+        }
+    
+    def get_modified_invoices(self, page=1, modified_since=None):
+        """One page of sales invoices changed after ``modified_since``, oldest change first.
+
+        Summary fields only (no line items), up to ``INVOICES_PAGE_SIZE`` per page.
+        """
+        token = self.get_valid_token()
+        headers = {
+            'Authorization': f'Bearer {token.access_token}',
+            'Xero-tenant-id': token.tenant_id,
+            'Accept': 'application/json'
+        }
+        if modified_since:
+            headers['If-Modified-Since'] = modified_since.strftime('%Y-%m-%dT%H:%M:%S')
+        response = xero_request(
+            'GET',
+            f"{self.XERO_API_URL}/Invoices",
+            params={
+                'page': page,
+                'pageSize': self.INVOICES_PAGE_SIZE,
+                'where': 'Type=="ACCREC"',
+                'order': 'UpdatedDateUTC ASC',
+                'summaryOnly': 'true',
+            },
+            headers=headers
+        )
+        # Nothing changed since modified_since
+        if response.status_code == 304:
+            return []
+        if response.status_code != 200:
+            raise Exception(f"Failed to get invoices: {response.text}")
+        return response.json().get('Invoices', [])
+    
+    def save_contacts(self, contacts, idempotency_key=None):
+        """Create or update contacts in one call; those with a ``ContactID`` are updated.
+
+        Sent with ``summarizeErrors=false`` like :meth:`create_invoices`, so the
+        result list matches ``contacts`` in order.
+        """
+        token = self.get_valid_token()
+        
+        if not token.tenant_id:
+            raise Exception("No tenant ID found. Please reconnect to Xero.")
+        
+        headers = {
+            'Authorization': f'Bearer {token.access_token}',
+            'Xero-tenant-id': token.tenant_id,
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        }
+        if idempotency_key:
+            headers['Idempotency-Key'] = idempotency_key
+        
+        response = xero_request(
+            'POST',
+            f"{self.XERO_API_URL}/Contacts",
+            params={'summarizeErrors': 'false'},
+            headers=headers,
+            json={"Contacts": contacts}
+        )
+        
+        if response.status_code in [200, 201]:
+            return response.json().get('Contacts', [])
+        else:
+            raise Exception(f"Failed to save contacts: {response.text}")
+    
+    def get_contacts(self, page=1, names=None):
+        """One page of up to ``CONTACTS_PAGE_SIZE`` contacts, optionally only those with the given names."""
+        token = self.get_valid_token()
+        headers = {
+            'Authorization': f'Bearer {token.access_token}',
+            'Xero-tenant-id': token.tenant_id,
+            'Accept': 'application/json'
+        }
+        params = {'page': page, 'pageSize': self.CONTACTS_PAGE_SIZE}
+        if names:
+            params['where'] = ' OR '.join(f'Name=="{name.replace(chr(34), "")}"' for name in names)
+        response = xero_request(
+            'GET',
+            f"{self.XERO_API_URL}/Contacts",
+            params=params,
+            headers=headers
+        )
+        if response.status_code != 200:
+            raise Exception(f"Failed to get contacts: {response.text}")
+        return response.json().get('Contacts', [])
+    
+    def email_invoice(self, invoice_id):
+        """Email an existing invoice to its contact, without looking it up first."""
+        token = self.get_valid_token()
+        headers = {
+            'Authorization': f'Bearer {token.access_token}',
+            'Xero-tenant-id': token.tenant_id,
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        }
+        response = xero_request(
+            'POST',
+            f"{self.XERO_API_URL}/Invoices/{invoice_id}/Email",
+            headers=headers,
+            json={}
+        )
+        if response.status_code not in [200, 204]:
+            raise Exception(f"Failed to send invoice: {response.text}")
+        return True
+    
     def send_invoice(self, invoice_id):
         """Send an invoice to the customer via email."""
         token = self.get_valid_token()
@@ -187,7 +611,8 @@ class XeroClient:
         }
         
         # First, get the invoice to ensure it exists and get the contact email
-        invoice_response = requests.get(
+        invoice_response = xero_request(
+            'GET',
             f"{self.XERO_API_URL}/Invoices/{invoice_id}",
             headers=headers
         )
@@ -202,7 +627,8 @@ class XeroClient:
             "IncludeOnline": True  # Include online invoice link
         }
         
-        response = requests.post(
+        response = xero_request(
+            'POST',
             f"{self.XERO_API_URL}/Invoices/{invoice_id}/Email",
             headers=headers,
             json=email_data
@@ -292,6 +718,7 @@ class XeroClient:
             # Delete all stored tokens
             XeroToken.query.delete()
             db.session.commit()
+            invalidate_xero_token_cache()
             return True
         except Exception as e:
             current_app.logger.error(f"Failed to disconnect from Xero: {str(e)}")
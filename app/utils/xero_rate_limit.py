@@ -0,0 +1,173 @@
+"""Per-tenant Xero API rate limiting shared by every worker.
+
+Xero allows each tenant 60 calls per rolling minute, 5000 per day and 5 in
+flight at once; going over returns 429s that every worker then retries. Each
+call made through :func:`app.utils.xero.xero_request` first takes a permit
+from :data:`xero_rate_limiter`:
+
+* minute limit - a token bucket holding ``XERO_RATE_LIMIT_BURST`` tokens and
+  refilling so that burst plus refill never exceeds
+  ``XERO_RATE_LIMIT_PER_MINUTE`` in any 60 seconds
+* day limit - a count of calls per UTC day; background calls stop
+  ``XERO_RATE_LIMIT_DAILY_RESERVE`` short of ``XERO_RATE_LIMIT_PER_DAY`` so
+  interactive ones (admin "send invoice") still get through
+* concurrency - at most ``XERO_RATE_LIMIT_CONCURRENT`` leased calls in flight
+
+The state lives in the shared cache (``cache.update``), so the limits hold
+across gunicorn workers and ``scheduled_tasks.py``. Xero's
+``X-MinLimit-Remaining`` / ``X-DayLimit-Remaining`` headers and 429
+``Retry-After`` replies correct it, which covers calls made by other
+processes or apps on the same tenant.
+
+A call that would exceed a limit waits for a permit: up to
+``XERO_RATE_LIMIT_MAX_WAIT`` seconds inside a web request, and up to
+``XERO_RATE_LIMIT_BACKGROUND_MAX_WAIT`` otherwise. If no permit comes in time,
+or the day's budget is spent, it raises :class:`XeroRateLimitExceeded` with
+``retry_after``, and the caller defers the work.
+"""
+
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from app.cache import cache
+from app.utils.metrics import metrics
+
+# Day counters must outlive the day they count
+_STATE_TTL = 2 * 24 * 3600
+
+
+class XeroRateLimitExceeded(Exception):
+    """No Xero call permit is available now; try again after ``retry_after`` seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class XeroRateLimiter:
+    """Token bucket, day budget and concurrency leases per Xero tenant."""
+
+    def acquire(self, tenant_id, urgent=False):
+        """Block until a call for ``tenant_id`` may start; returns a lease for :meth:`release`."""
+        config = current_app.config
+        max_wait = float(config.get('XERO_RATE_LIMIT_MAX_WAIT' if urgent else 'XERO_RATE_LIMIT_BACKGROUND_MAX_WAIT',
+                                    10 if urgent else 120))
+        lease = uuid.uuid4().hex
+        limits = self._limits(urgent)
+        started = time.monotonic()
+        while True:
+            try:
+                outcome, wait = cache.update(self._key(tenant_id), lambda state: self._take(state, lease, limits),
+                                             _STATE_TTL)
+            except TimeoutError:
+                # Another worker holds the state lock; treat it like a full bucket
+                outcome, wait = 'busy', 0.05
+            if outcome == 'ok':
+                waited = time.monotonic() - started
+                if waited > 0:
+                    metrics.observe('xero_rate_limit_wait_seconds', waited, {'urgent': str(urgent).lower()})
+                return lease
+            waited = time.monotonic() - started
+            if outcome == 'day' or waited + wait > max_wait:
+                metrics.inc('xero_rate_limit_rejections_total', {'limit': outcome})
+                raise XeroRateLimitExceeded(
+                    f"Xero {outcome} limit reached for tenant {tenant_id}; retry in {wait:.0f}s", wait)
+            time.sleep(wait)
+
+    def release(self, tenant_id, lease, response=None):
+        """End a leased call, folding Xero's rate-limit headers from ``response`` into the state."""
+        limits = self._limits(True)
+        headers = response.headers if response is not None else {}
+        status = response.status_code if response is not None else None
+        try:
+            cache.update(self._key(tenant_id), lambda state: self._settle(state, lease, headers, status, limits),
+                         _STATE_TTL)
+        except TimeoutError:
+            # The lease expires on its own after lease_ttl
+            current_app.logger.warning(f"Could not release Xero rate-limit lease for tenant {tenant_id}")
+
+    # --------------- State transitions (run under the cache.update lock) ---------------
+    @staticmethod
+    def _fresh(state, limits):
+        now = time.time()
+        today = datetime.utcnow().strftime('%Y-%m-%d')
+        state = dict(state or {'tokens': float(limits['burst']), 'updated': now, 'inflight': {}})
+        if state.get('day') != today:
+            state['day'], state['day_used'] = today, 0
+        # Refill the bucket for the time since the last update
+        elapsed = max(now - state['updated'], 0.0)
+        state['tokens'] = min(float(limits['burst']), state['tokens'] + elapsed * limits['rate'])
+        state['updated'] = now
+        # Drop leases of calls that never released (crashed worker)
+        state['inflight'] = {lease: expires for lease, expires in state['inflight'].items() if expires > now}
+        return state, now
+
+    def _take(self, state, lease, limits):
+        state, now = self._fresh(state, limits)
+        if state.get('blocked_until', 0) > now:
+            return state, ('minute', state['blocked_until'] - now)
+        if state['day_used'] >= limits['day']:
+            midnight = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+            return state, ('day', (midnight - datetime.utcnow()).total_seconds())
+        if len(state['inflight']) >= limits['concurrent']:
+            return state, ('concurrent', 0.25)
+        # Refill arithmetic leaves tokens a hair under 1; never ask for a wait the clock can't resolve
+        if state['tokens'] < 1 - 1e-9:
+            return state, ('minute', max((1 - state['tokens']) / limits['rate'], 0.01))
+        state['tokens'] -= 1
+        state['day_used'] += 1
+        state['inflight'][lease] = now + limits['lease_ttl']
+        return state, ('ok', 0.0)
+
+    def _settle(self, state, lease, headers, status, limits):
+        state, now = self._fresh(state, limits)
+        state['inflight'].pop(lease, None)
+        minute_remaining = _int_header(headers, 'X-MinLimit-Remaining')
+        if minute_remaining is not None:
+            state['tokens'] = min(state['tokens'], float(minute_remaining))
+        day_remaining = _int_header(headers, 'X-DayLimit-Remaining')
+        if day_remaining is not None:
+            state['day_used'] = max(state['day_used'], limits['per_day'] - day_remaining)
+        if status == 429:
+            retry_after = _int_header(headers, 'Retry-After') or 60
+            problem = (headers.get('X-Rate-Limit-Problem') or '').lower()
+            if problem == 'day':
+                state['day_used'] = limits['per_day']
+            elif problem != 'concurrent':
+                state['blocked_until'] = max(state.get('blocked_until', 0), now + retry_after)
+                state['tokens'] = 0.0
+        return state, None
+
+    @staticmethod
+    def _limits(urgent):
+        config = current_app.config
+        per_minute = int(config.get('XERO_RATE_LIMIT_PER_MINUTE', 60))
+        burst = min(int(config.get('XERO_RATE_LIMIT_BURST', 10)), per_minute)
+        per_day = int(config.get('XERO_RATE_LIMIT_PER_DAY', 5000))
+        reserve = 0 if urgent else int(config.get('XERO_RATE_LIMIT_DAILY_RESERVE', 250))
+        return {
+            'burst': burst,
+            # burst + 60 * rate <= per_minute, so no rolling minute exceeds the limit
+            'rate': max(per_minute - burst, 1) / 60.0,
+            'per_day': per_day,
+            'day': per_day - reserve,
+            'concurrent': int(config.get('XERO_RATE_LIMIT_CONCURRENT', 5)),
+            'lease_ttl': float(config.get('XERO_CONNECT_TIMEOUT', 3.05)) + float(config.get('XERO_READ_TIMEOUT', 20)) + 5,
+        }
+
+    @staticmethod
+    def _key(tenant_id):
+        return f'xero:ratelimit:{tenant_id}'
+
+
+def _int_header(headers, name):
+    try:
+        return int(float(headers.get(name)))
+    except (TypeError, ValueError):
+        return None
+
+
+xero_rate_limiter = XeroRateLimiter()
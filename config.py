@@ -25,6 +25,19 @@ class Config:
         SQLALCHEMY_DATABASE_URI = 'sqlite:///' + _project_db_path
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # Connection pool (PostgreSQL/MySQL only, see app/utils/db_pool.py). Size it so
+    # gunicorn workers x (DB_POOL_SIZE + DB_MAX_OVERFLOW) fits the server's connection limit
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or 5)
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW') or 5)
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT') or 30)
+    # Managed Postgres drops idle connections and fails over; recycle and ping before use
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE') or 1800)
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ['true', 'on', '1']
+    DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS') or 0)
+    # Behind PgBouncer in transaction pooling mode: no startup options, SET LOCAL timeouts,
+    # no server-side prepared statements
+    DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', 'false').lower() in ['true', 'on', '1']
+    
     # JWT
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY') or SECRET_KEY
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=1)
@@ -63,13 +76,112 @@ class Config:
     REMEMBER_COOKIE_HTTPONLY = True
     REMEMBER_COOKIE_SAMESITE = os.environ.get('REMEMBER_COOKIE_SAMESITE', 'Lax')
     
+    # Request profiler (managers can append ?_profile=1 to any URL)
+    PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', 'true').lower() in ['true', 'on', '1']
+    PROFILER_DIR = os.environ.get('PROFILER_DIR') or os.path.join(basedir, 'instance', 'profiles')
+    PROFILER_MAX_PROFILES = int(os.environ.get('PROFILER_MAX_PROFILES') or 200)
+    PROFILER_TOKEN_MAX_AGE = int(os.environ.get('PROFILER_TOKEN_MAX_AGE') or 3600)
+    
+    # Metrics (/metrics, aggregated across gunicorn workers via METRICS_DIR)
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ['true', 'on', '1']
+    METRICS_DIR = os.environ.get('METRICS_DIR') or os.path.join(basedir, 'instance', 'metrics')
+    METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL') or 5)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    
+    # Application cache (app.cache): per-worker LRU in front of a shared backend
+    # CACHE_TYPE: filesystem | sqlite | redis | null
+    CACHE_TYPE = os.environ.get('CACHE_TYPE', 'filesystem')
+    CACHE_DIR = os.environ.get('CACHE_DIR') or os.path.join(basedir, 'instance', 'cache')
+    CACHE_SQLITE_PATH = os.environ.get('CACHE_SQLITE_PATH') or os.path.join(basedir, 'instance', 'cache.sqlite3')
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL') or os.environ.get('REDIS_URL')
+    CACHE_KEY_PREFIX = os.environ.get('CACHE_KEY_PREFIX', 'aurora:')
+    CACHE_DEFAULT_TTL = int(os.environ.get('CACHE_DEFAULT_TTL') or 300)
+    CACHE_LOCAL_TTL = int(os.environ.get('CACHE_LOCAL_TTL') or 30)
+    CACHE_LOCAL_MAX_ENTRIES = int(os.environ.get('CACHE_LOCAL_MAX_ENTRIES') or 1000)
+    CACHE_LOCK_TTL = int(os.environ.get('CACHE_LOCK_TTL') or 30)
+    # How long a worker trusts its copy of a tag version before re-reading the shared backend
+    CACHE_TAG_VERSION_TTL = float(os.environ.get('CACHE_TAG_VERSION_TTL') or 1.0)
+    
+    # Template fragment cache ({% cache %}), stored in the application cache above
+    FRAGMENT_CACHE_ENABLED = os.environ.get('FRAGMENT_CACHE_ENABLED', 'true').lower() in ['true', 'on', '1']
+    FRAGMENT_CACHE_DEFAULT_TTL = int(os.environ.get('FRAGMENT_CACHE_DEFAULT_TTL') or 300)
+    
+    # Worker warm-up: gunicorn.conf.py sets WARMUP_ON_FORK so /api/ready waits for it
+    WARMUP_ON_FORK = os.environ.get('WARMUP_ON_FORK', 'false').lower() in ['true', 'on', '1']
+    WARMUP_DB_CONNECTIONS = int(os.environ.get('WARMUP_DB_CONNECTIONS') or 2)
+    
+    # Optional read replica for reports and analytics (@use_replica views); they
+    # fall back to the primary when it lags more than REPLICA_MAX_LAG_SECONDS
+    SQLALCHEMY_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+    REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS') or 30)
+    REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('REPLICA_LAG_CHECK_INTERVAL') or 5)
+    
+    # Schema sync: production runs `flask db-sync` once per deploy, so workers start without DDL
+    SCHEMA_AUTO_SYNC = os.environ.get('SCHEMA_AUTO_SYNC', 'false').lower() in ['true', 'on', '1']
+    
     # Webhooks
     PAY_ADVANTAGE_WEBHOOK_SECRET = os.environ.get('PAY_ADVANTAGE_WEBHOOK_SECRET')
+    # HTTP behaviour of app/services/pay_advantage.py: pooled keep-alive session and
+    # (connect, read) timeouts; tokens are cached in the shared cache for their
+    # lifetime, or PAY_ADVANTAGE_TOKEN_TTL seconds when the API doesn't say
+    PAY_ADVANTAGE_HTTP_POOL_SIZE = int(os.environ.get('PAY_ADVANTAGE_HTTP_POOL_SIZE') or 10)
+    PAY_ADVANTAGE_CONNECT_TIMEOUT = float(os.environ.get('PAY_ADVANTAGE_CONNECT_TIMEOUT') or 3.05)
+    PAY_ADVANTAGE_READ_TIMEOUT = float(os.environ.get('PAY_ADVANTAGE_READ_TIMEOUT') or 20)
+    PAY_ADVANTAGE_TOKEN_TTL = int(os.environ.get('PAY_ADVANTAGE_TOKEN_TTL') or 3600)
+    # Days of PayAdvantage payments `flask payadvantage-reconcile` checks by default (run nightly)
+    PAY_ADVANTAGE_RECONCILE_DAYS = int(os.environ.get('PAY_ADVANTAGE_RECONCILE_DAYS') or 7)
+    # Days ahead `flask cashflow-project` projects schedules without an end amount
+    CASH_FLOW_HORIZON_DAYS = int(os.environ.get('CASH_FLOW_HORIZON_DAYS') or 365)
+    
+    # Webhook inbox worker (`flask webhook-events`): events claimed per poll, retries
+    # with exponential backoff, and how long a claimed event stays locked to one worker
+    WEBHOOK_EVENTS_BATCH_SIZE = int(os.environ.get('WEBHOOK_EVENTS_BATCH_SIZE') or 50)
+    WEBHOOK_EVENTS_POLL_INTERVAL = float(os.environ.get('WEBHOOK_EVENTS_POLL_INTERVAL') or 2)
+    WEBHOOK_EVENTS_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_EVENTS_MAX_ATTEMPTS') or 5)
+    WEBHOOK_EVENTS_BACKOFF_BASE = float(os.environ.get('WEBHOOK_EVENTS_BACKOFF_BASE') or 30)
+    WEBHOOK_EVENTS_BACKOFF_MAX = float(os.environ.get('WEBHOOK_EVENTS_BACKOFF_MAX') or 3600)
+    WEBHOOK_EVENTS_LEASE_SECONDS = int(os.environ.get('WEBHOOK_EVENTS_LEASE_SECONDS') or 300)
+    
+    # Independent steps of long requests (handover photo uploads, PayAdvantage
+    # customer check) run on a pool of FLOW_MAX_WORKERS threads per process
+    FLOW_MAX_WORKERS = int(os.environ.get('FLOW_MAX_WORKERS') or 8)
+    HANDOVER_STEP_TIMEOUT = float(os.environ.get('HANDOVER_STEP_TIMEOUT') or 30)
     
     # Xero Configuration
     XERO_CLIENT_ID = os.environ.get('XERO_CLIENT_ID')
     XERO_CLIENT_SECRET = os.environ.get('XERO_CLIENT_SECRET')
     XERO_CALLBACK_URL = os.environ.get('XERO_CALLBACK_URL') or 'http://localhost:5000/xero/callback'
+    # HTTP behaviour of app/utils/xero.py: pooled keep-alive session, (connect, read)
+    # timeouts and retries on 429/5xx within XERO_RETRY_BUDGET seconds
+    XERO_HTTP_POOL_SIZE = int(os.environ.get('XERO_HTTP_POOL_SIZE') or 10)
+    XERO_CONNECT_TIMEOUT = float(os.environ.get('XERO_CONNECT_TIMEOUT') or 3.05)
+    XERO_READ_TIMEOUT = float(os.environ.get('XERO_READ_TIMEOUT') or 20)
+    XERO_MAX_RETRIES = int(os.environ.get('XERO_MAX_RETRIES') or 3)
+    XERO_BACKOFF_BASE = float(os.environ.get('XERO_BACKOFF_BASE') or 0.5)
+    XERO_RETRY_BUDGET = float(os.environ.get('XERO_RETRY_BUDGET') or 30)
+    # How long a worker reuses its cached access token before re-reading xero_tokens
+    XERO_TOKEN_CACHE_TTL = float(os.environ.get('XERO_TOKEN_CACHE_TTL') or 60)
+    # Per-tenant Xero API limits, shared by all workers (app/utils/xero_rate_limit.py).
+    # Background calls leave XERO_RATE_LIMIT_DAILY_RESERVE calls of the daily
+    # budget to interactive ones and wait up to XERO_RATE_LIMIT_BACKGROUND_MAX_WAIT
+    XERO_RATE_LIMIT_ENABLED = os.environ.get('XERO_RATE_LIMIT_ENABLED', 'true').lower() in ['true', 'on', '1']
+    XERO_RATE_LIMIT_PER_MINUTE = int(os.environ.get('XERO_RATE_LIMIT_PER_MINUTE') or 60)
+    XERO_RATE_LIMIT_BURST = int(os.environ.get('XERO_RATE_LIMIT_BURST') or 10)
+    XERO_RATE_LIMIT_PER_DAY = int(os.environ.get('XERO_RATE_LIMIT_PER_DAY') or 5000)
+    XERO_RATE_LIMIT_DAILY_RESERVE = int(os.environ.get('XERO_RATE_LIMIT_DAILY_RESERVE') or 250)
+    XERO_RATE_LIMIT_CONCURRENT = int(os.environ.get('XERO_RATE_LIMIT_CONCURRENT') or 5)
+    XERO_RATE_LIMIT_MAX_WAIT = float(os.environ.get('XERO_RATE_LIMIT_MAX_WAIT') or 10)
+    XERO_RATE_LIMIT_BACKGROUND_MAX_WAIT = float(os.environ.get('XERO_RATE_LIMIT_BACKGROUND_MAX_WAIT') or 120)
+    # Invoices sent per POST /Invoices by the daily scheduler (Xero accepts up to 50)
+    XERO_INVOICE_BATCH_SIZE = int(os.environ.get('XERO_INVOICE_BATCH_SIZE') or 50)
+    # Outbox worker (`flask xero-outbox`): entries claimed per poll, retries with
+    # exponential backoff, and how long a claimed entry stays locked to one worker
+    XERO_OUTBOX_BATCH_SIZE = int(os.environ.get('XERO_OUTBOX_BATCH_SIZE') or 20)
+    XERO_OUTBOX_POLL_INTERVAL = float(os.environ.get('XERO_OUTBOX_POLL_INTERVAL') or 2)
+    XERO_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('XERO_OUTBOX_MAX_ATTEMPTS') or 6)
+    XERO_OUTBOX_BACKOFF_BASE = float(os.environ.get('XERO_OUTBOX_BACKOFF_BASE') or 30)
+    XERO_OUTBOX_BACKOFF_MAX = float(os.environ.get('XERO_OUTBOX_BACKOFF_MAX') or 3600)
+    XERO_OUTBOX_LEASE_SECONDS = int(os.environ.get('XERO_OUTBOX_LEASE_SECONDS') or 300)
     XERO_SCOPES = [
         'openid',
         'profile',
@@ -85,6 +197,7 @@ class DevelopmentConfig(Config):
     """Development configuration."""
     DEBUG = True
     TESTING = False
+    SCHEMA_AUTO_SYNC = os.environ.get('SCHEMA_AUTO_SYNC', 'true').lower() in ['true', 'on', '1']
 
 
 class TestingConfig(Config):
@@ -93,6 +206,8 @@ class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     WTF_CSRF_ENABLED = False
+    SCHEMA_AUTO_SYNC = True
+    CACHE_TYPE = 'null'
 
 
 class ProductionConfig(Config):
@@ -100,6 +215,12 @@ class ProductionConfig(Config):
     DEBUG = False
     TESTING = False
     
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or 10)
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW') or 10)
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT') or 10)
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE') or 300)
+    DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS') or 30000)
+    
     # Use DATABASE_URL if provided; otherwise inherit from base (instance SQLite if present)
     _db_url_env = os.environ.get('DATABASE_URL')
     if _db_url_env:
@@ -0,0 +1,18 @@
+"""Gunicorn settings for the web container (`gunicorn -c gunicorn.conf.py wsgi:app`)."""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+
+# Workers report not-ready on /api/ready until post_worker_init has warmed them up
+os.environ.setdefault('WARMUP_ON_FORK', 'true')
+
+
+def post_worker_init(worker):
+    """Open pool connections, compile templates and build clients before serving traffic."""
+    from app.utils.warmup import warm_up
+    state = warm_up(worker.wsgi)
+    worker.log.info(f"Worker {worker.pid} warmed up in {state['duration_ms']} ms")
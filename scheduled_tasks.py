@@ -7,8 +7,13 @@ This script should be run daily to handle recurring tasks.
 import sys
 from datetime import datetime, date, timedelta
 from app import create_app, db
+from app.services.cash_flow import refresh_projections
+from app.services.pay_advantage_reconcile import reconcile_recent
+from app.services.webhook_inbox import process_events
+from app.services.xero_outbox import drain_outbox
 from app.services.xero_scheduler import XeroInvoiceScheduler
 from app.models import Booking, BookingStatus, DirectDebitSchedule
+from app.utils.metrics import track_job
 
 def run_daily_tasks():
     """Run all daily scheduled tasks."""
@@ -20,31 +25,42 @@ def run_daily_tasks():
         # 1. Create invoices for direct debit payments due tomorrow
         try:
             print("Checking for direct debit invoices to create...")
-            scheduler = XeroInvoiceScheduler()
-            scheduler.check_and_create_due_invoices()
-            print("✓ Direct debit invoice check completed")
+            with track_job('xero_due_invoices'):
+                scheduler = XeroInvoiceScheduler()
+                summary = scheduler.check_and_create_due_invoices()
+            print(f"✓ Direct debit invoice check completed: {summary['created']} created, "
+                  f"{summary['skipped']} already invoiced, {summary['deferred']} deferred by the Xero rate limit, "
+                  f"{len(summary['failed'])} failed")
+            for failure in summary['failed']:
+                print(f"  ✗ Booking {failure['booking_number']}: {'; '.join(failure['errors'])}")
+            for invoice in summary['unsent']:
+                print(f"  ! Invoice {invoice['invoice_number']} created but not emailed")
+            for failure in summary['abandoned']:
+                print(f"  ✗ Gave up on booking {failure['booking_number']} due {failure['due_date']}: "
+                      f"{'; '.join(failure['errors'])}")
         except Exception as e:
             print(f"✗ Error creating direct debit invoices: {e}")
         
         # 2. Check for overdue bookings
         try:
             print("Checking for overdue bookings...")
-            overdue_bookings = Booking.query.filter(
-                Booking.status == BookingStatus.IN_PROGRESS,
-                Booking.return_date < datetime.utcnow()
-            ).all()
-            
-            for booking in overdue_bookings:
-                days_overdue = (datetime.utcnow() - booking.return_date).days
-                note = f"\n[System] Booking is {days_overdue} days overdue as of {date.today()}"
-                if booking.admin_notes:
-                    # Only add note if it's not already there
-                    if f"overdue as of {date.today()}" not in booking.admin_notes:
-                        booking.admin_notes += note
-                else:
-                    booking.admin_notes = note
-            
-            db.session.commit()
+            with track_job('overdue_bookings'):
+                overdue_bookings = Booking.query.filter(
+                    Booking.status == BookingStatus.IN_PROGRESS,
+                    Booking.return_date < datetime.utcnow()
+                ).all()
+                
+                for booking in overdue_bookings:
+                    days_overdue = (datetime.utcnow() - booking.return_date).days
+                    note = f"\n[System] Booking is {days_overdue} days overdue as of {date.today()}"
+                    if booking.admin_notes:
+                        # Only add note if it's not already there
+                        if f"overdue as of {date.today()}" not in booking.admin_notes:
+                            booking.admin_notes += note
+                    else:
+                        booking.admin_notes = note
+                
+                db.session.commit()
             print(f"✓ Found {len(overdue_bookings)} overdue bookings")
         except Exception as e:
             print(f"✗ Error checking overdue bookings: {e}")
@@ -52,19 +68,32 @@ def run_daily_tasks():
         # 3. Update direct debit schedule statuses
         try:
             print("Updating direct debit schedule statuses...")
-            pending_schedules = DirectDebitSchedule.query.filter_by(
-                status='pending_authorization'
-            ).all()
-            
-            for schedule in pending_schedules:
-                # In production, you would check with PayAdvantage API
-                # to see if the authorization has been completed
-                pass
+            with track_job('direct_debit_status'):
+                pending_schedules = DirectDebitSchedule.query.filter_by(
+                    status='pending_authorization'
+                ).all()
+                
+                for schedule in pending_schedules:
+                    # In production, you would check with PayAdvantage API
+                    # to see if the authorization has been completed
+                    pass
             
             print("✓ Direct debit status check completed")
         except Exception as e:
             print(f"✗ Error updating direct debit statuses: {e}")
         
+        # 4. Correct installments and payments whose webhook was missed
+        try:
+            print("Reconciling PayAdvantage payments...")
+            with track_job('payadvantage_reconcile'):
+                summary = reconcile_recent()
+            print(f"✓ PayAdvantage payments: {summary['seen']} seen, {summary['changed']} reconciled, "
+                  f"{summary['unmatched']} not matched to a schedule")
+            if summary['abandoned']:
+                print(f"✗ Gave up resuming the PayAdvantage reconciliation of {summary['abandoned']}")
+        except Exception as e:
+            print(f"✗ Error reconciling PayAdvantage payments (resumes on the next run): {e}")
+        
         print(f"Daily tasks completed at {datetime.utcnow()}")
 
 def run_hourly_tasks():
@@ -74,7 +103,43 @@ def run_hourly_tasks():
     with app.app_context():
         print(f"Running hourly tasks at {datetime.utcnow()}")
         
-        # Add any hourly tasks here
+        # 1. Send queued Xero operations, in case no `flask xero-outbox --loop` worker is running
+        try:
+            print("Draining the Xero outbox...")
+            with track_job('xero_outbox'):
+                summary = drain_outbox()
+            print(f"✓ Xero outbox: {summary['sent']} sent, {summary['retrying']} retrying, "
+                  f"{summary['deferred']} deferred, {summary['failed']} failed")
+        except Exception as e:
+            print(f"✗ Error draining the Xero outbox: {e}")
+        
+        # 2. Mark scheduled invoice payments paid or voided from Xero
+        try:
+            print("Syncing Xero invoice statuses...")
+            with track_job('xero_invoice_status_sync'):
+                summary = XeroInvoiceScheduler().sync_invoice_statuses()
+            print(f"✓ Xero invoice statuses: {summary['seen']} changed invoices, {summary['updated']} payments updated")
+        except Exception as e:
+            print(f"✗ Error syncing Xero invoice statuses: {e}")
+        
+        # 3. Process stored webhook events, in case no `flask webhook-events --loop` worker is running
+        try:
+            print("Processing webhook events...")
+            with track_job('webhook_events'):
+                summary = process_events()
+            print(f"✓ Webhook events: {summary['processed']} processed, {summary['retrying']} retrying, "
+                  f"{summary['failed']} failed, {summary['waiting']} waiting")
+        except Exception as e:
+            print(f"✗ Error processing webhook events: {e}")
+        
+        # 4. Re-project the direct debit schedules changed since the last run for the cash-flow forecast
+        try:
+            print("Refreshing projected installments...")
+            with track_job('cash_flow_projection'):
+                summary = refresh_projections()
+            print(f"✓ Projected installments: {summary['installments']} for {summary['schedules']} schedules")
+        except Exception as e:
+            print(f"✗ Error refreshing projected installments: {e}")
         
         print(f"Hourly tasks completed at {datetime.utcnow()}")
 
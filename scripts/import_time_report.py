@@ -0,0 +1,97 @@
+"""Summarise ``python -X importtime`` for app startup.
+
+Runs the given startup code in a fresh interpreter (by default the same
+``create_app()`` call CLI tools and ``scheduled_tasks.py`` make), parses the
+import-time trace from stderr and prints the slowest imports and the total
+self time per top-level package.
+
+Examples:
+    python scripts/import_time_report.py
+    python scripts/import_time_report.py --runs 5 --top 30
+    python scripts/import_time_report.py --code "import scheduled_tasks"
+"""
+
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+import click
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DEFAULT_CODE = "from app import create_app; create_app('testing')"
+
+_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)\s*$')
+
+
+def run_importtime(code):
+    """Run ``code`` under -X importtime; return (wall seconds, [(name, depth, self_us, cumulative_us)])."""
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=ROOT, capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise click.ClickException(f"Startup code failed:\n{proc.stderr[-2000:]}")
+    rows = []
+    for line in proc.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((name, len(indent) // 2, int(self_us), int(cumulative_us)))
+    return wall, rows
+
+
+def _median_rows(runs):
+    """Merge several runs into per-module medians (first-seen order and depth are kept)."""
+    samples = defaultdict(lambda: ([], []))
+    depth = {}
+    for rows in runs:
+        for name, level, self_us, cumulative_us in rows:
+            samples[name][0].append(self_us)
+            samples[name][1].append(cumulative_us)
+            depth.setdefault(name, level)
+    return [
+        (name, depth[name], int(statistics.median(s)), int(statistics.median(c)))
+        for name, (s, c) in samples.items()
+    ]
+
+
+@click.command()
+@click.option('--code', default=DEFAULT_CODE, show_default=True, help='Python code to time.')
+@click.option('--runs', default=3, show_default=True, help='Fresh interpreters to run; medians are reported.')
+@click.option('--top', default=25, show_default=True, help='Number of slowest imports to list.')
+@click.option('--only', default=None, help='Only list modules under this package prefix (e.g. app).')
+def main(code, runs, top, only):
+    walls, traces = [], []
+    for _ in range(max(runs, 1)):
+        wall, rows = run_importtime(code)
+        walls.append(wall)
+        traces.append(rows)
+    rows = _median_rows(traces)
+
+    total_us = sum(r[2] for r in rows)
+    click.echo(f"Startup: {code}")
+    click.echo(f"Wall time (median of {len(walls)}): {statistics.median(walls) * 1000:.0f} ms, "
+               f"import time: {total_us / 1000:.0f} ms across {len(rows)} modules\n")
+
+    listed = [r for r in rows if not only or r[0] == only or r[0].startswith(only + '.')]
+    listed.sort(key=lambda r: r[3], reverse=True)
+    click.echo(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for name, level, self_us, cumulative_us in listed[:top]:
+        click.echo(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>9.1f}  {'  ' * level}{name}")
+
+    by_package = defaultdict(int)
+    for name, _, self_us, _ in rows:
+        by_package[name.split('.')[0]] += self_us
+    click.echo(f"\n{'self ms':>9}  top-level package")
+    for package, self_us in sorted(by_package.items(), key=lambda kv: kv[1], reverse=True)[:top]:
+        click.echo(f"{self_us / 1000:>9.1f}  {package}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""Before/after query plans for the workload index set (schema step 5).
+
+Seeds a scratch database with a realistic mix of cars, customers, bookings,
+payments and direct debit installments, then runs the hot queries from
+``app/routes``, ``scheduled_tasks.py`` and the Pay Advantage sync twice: once
+without the ``WORKLOAD_INDEXES`` and once with them. For each query it prints
+the plan (``EXPLAIN QUERY PLAN`` on SQLite, ``EXPLAIN`` on PostgreSQL) and the
+median execution time.
+
+Examples:
+    python scripts/index_benchmark.py
+    python scripts/index_benchmark.py --bookings 200000 --runs 9
+    python scripts/index_benchmark.py --database-url postgresql://localhost/aurora_bench
+
+The target database is wiped and re-seeded, so never point it at real data.
+"""
+
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import click
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import func, text  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.models import Booking, BookingStatus, Car, Payment, PaymentStatus, User  # noqa: E402
+from app.models.car import CarCategory, CarStatus  # noqa: E402
+from app.models.pay_advantage import DirectDebitInstallment, DirectDebitSchedule  # noqa: E402
+from app.models.payment import PaymentMethod  # noqa: E402
+from app.utils.schema import WORKLOAD_INDEXES, workload_index_ddl  # noqa: E402
+from config import config  # noqa: E402
+
+ACTIVE = [BookingStatus.PENDING, BookingStatus.CONFIRMED, BookingStatus.IN_PROGRESS]
+
+
+def _queries(now, sample):
+    """(label, statement) pairs mirroring the routes that motivated each index."""
+    today = datetime.combine(now.date(), datetime.min.time())
+    return [
+        ('dashboard: in-progress count',
+         db.select(func.count()).select_from(Booking).where(Booking.status == BookingStatus.IN_PROGRESS)),
+        ('cars.index: next available per car',
+         db.select(Booking.car_id, Booking.return_date)
+         .where(Booking.car_id.in_(sample['car_ids']), Booking.status.in_(ACTIVE), Booking.return_date >= now)
+         .order_by(Booking.return_date.asc())),
+        ('cars.delete: active bookings for car',
+         db.select(func.count()).select_from(Booking)
+         .where(Booking.car_id == sample['car_id'], Booking.status.in_(ACTIVE))),
+        ('bookings.index: my bookings, newest first',
+         db.select(Booking).where(Booking.customer_id == sample['customer_id'])
+         .order_by(Booking.created_at.desc()).limit(20)),
+        ('dashboard: recent bookings',
+         db.select(Booking).order_by(Booking.created_at.desc()).limit(10)),
+        ('scheduled_tasks: overdue bookings',
+         db.select(Booking).where(Booking.status == BookingStatus.IN_PROGRESS, Booking.return_date < now)),
+        ('dashboard: completed revenue today',
+         db.select(func.sum(Payment.amount)).where(
+             Payment.status == PaymentStatus.COMPLETED,
+             Payment.created_at >= today, Payment.created_at < today + timedelta(days=1))),
+        ('bookings.view: payments for booking',
+         db.select(Payment).where(Payment.booking_id == sample['booking_id']).order_by(Payment.created_at.desc())),
+        ('pay_advantage: installment upsert lookup',
+         db.select(DirectDebitInstallment).where(
+             DirectDebitInstallment.schedule_id == sample['schedule_id'],
+             DirectDebitInstallment.booking_id == sample['schedule_booking_id'],
+             DirectDebitInstallment.due_date == sample['due_date'])),
+        ('admin: installments for booking',
+         db.select(DirectDebitInstallment).where(DirectDebitInstallment.booking_id == sample['schedule_booking_id'])
+         .order_by(DirectDebitInstallment.due_date.asc())),
+    ]
+
+
+def seed(bookings, seed_value):
+    """Bulk-insert a dataset sized by ``bookings``; returns sample ids for the queries."""
+    rng = random.Random(seed_value)
+    now = datetime.utcnow()
+    n_cars = max(bookings // 200, 10)
+    n_users = max(bookings // 4, 10)
+
+    db.session.execute(db.insert(User), [
+        {'email': f'bench{i}@example.com', 'password_hash': 'x', 'first_name': 'Bench', 'last_name': str(i)}
+        for i in range(n_users)
+    ])
+    db.session.execute(db.insert(Car), [
+        {'make': 'Bench', 'model': f'M{i}', 'year': 2022, 'license_plate': f'BEN{i:05d}', 'vin': f'VINBENCH{i:08d}',
+         'category': rng.choice(list(CarCategory)), 'seats': 5, 'daily_rate': 80.0, 'status': CarStatus.AVAILABLE}
+        for i in range(n_cars)
+    ])
+    user_ids = db.session.scalars(db.select(User.id)).all()
+    car_ids = db.session.scalars(db.select(Car.id)).all()
+
+    # Mostly historical bookings, a thin slice of live ones, as in production
+    statuses = ([BookingStatus.COMPLETED] * 80 + [BookingStatus.CANCELLED] * 10 + [BookingStatus.CONFIRMED] * 4
+                + [BookingStatus.IN_PROGRESS] * 3 + [BookingStatus.PENDING] * 3)
+    historical = (BookingStatus.COMPLETED, BookingStatus.CANCELLED)
+    rows = []
+    for i in range(bookings):
+        status = rng.choice(statuses)
+        # Live bookings are recent; only history spans the full two years
+        created = now - timedelta(days=rng.uniform(0, 730 if status in historical else 14))
+        pickup = created + timedelta(days=rng.uniform(0, 30))
+        days = rng.randint(1, 28)
+        rows.append({
+            'booking_number': f'BK-BENCH-{i}', 'customer_id': rng.choice(user_ids), 'car_id': rng.choice(car_ids),
+            'pickup_date': pickup, 'return_date': pickup + timedelta(days=days),
+            'pickup_location': 'Depot', 'return_location': 'Depot', 'daily_rate': 80.0, 'total_days': days,
+            'subtotal': 80.0 * days, 'total_amount': 88.0 * days, 'status': status,
+            'license_document_url': 'bench', 'created_at': created,
+        })
+    db.session.execute(db.insert(Booking), rows)
+
+    booked = db.session.execute(db.select(Booking.id, Booking.customer_id, Booking.created_at)).all()
+    db.session.execute(db.insert(Payment), [
+        {'transaction_id': f'TX-BENCH-{b.id}-{k}', 'booking_id': b.id, 'user_id': b.customer_id,
+         'amount': rng.uniform(50, 2000), 'payment_method': PaymentMethod.CREDIT_CARD,
+         'status': rng.choice([PaymentStatus.COMPLETED] * 8 + [PaymentStatus.PENDING, PaymentStatus.FAILED]),
+         'created_at': b.created_at + timedelta(hours=k)}
+        for b in booked for k in range(rng.randint(1, 2))
+    ])
+
+    # Direct debit plans on one booking in ten, weekly for a quarter
+    scheduled = booked[::10]
+    db.session.execute(db.insert(DirectDebitSchedule), [
+        {'booking_id': b.id, 'schedule_id': f'SCH-BENCH-{b.id}', 'status': 'active', 'created_at': b.created_at}
+        for b in scheduled
+    ])
+    db.session.execute(db.insert(DirectDebitInstallment), [
+        {'schedule_id': f'SCH-BENCH-{b.id}', 'booking_id': b.id, 'due_date': b.created_at.date() + timedelta(weeks=w),
+         'due_amount': 100.0, 'status': 'pending', 'created_at': b.created_at}
+        for b in scheduled for w in range(13)
+    ])
+    db.session.commit()
+
+    probe = scheduled[len(scheduled) // 2]
+    return {
+        'car_ids': car_ids[:12],
+        'car_id': car_ids[0],
+        'customer_id': user_ids[0],
+        'booking_id': booked[len(booked) // 2].id,
+        'schedule_id': f'SCH-BENCH-{probe.id}',
+        'schedule_booking_id': probe.id,
+        'due_date': probe.created_at.date() + timedelta(weeks=4),
+    }, now
+
+
+def explain(stmt) -> str:
+    dialect = db.engine.dialect
+    sql = str(stmt.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect.name == 'sqlite' else 'EXPLAIN '
+    rows = db.session.execute(text(prefix + sql)).all()
+    if dialect.name == 'sqlite':
+        return '; '.join(row[-1] for row in rows)
+    return ' / '.join(row[0].strip() for row in rows)
+
+
+def time_query(stmt, runs) -> float:
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        db.session.execute(stmt).all()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def measure(queries, runs):
+    db.session.execute(text('ANALYZE'))
+    return {label: (explain(stmt), time_query(stmt, runs)) for label, stmt in queries}
+
+
+def drop_workload_indexes():
+    for name, *_ in WORKLOAD_INDEXES:
+        db.session.execute(text(f'DROP INDEX IF EXISTS {name}'))
+    db.session.commit()
+
+
+def create_workload_indexes():
+    for name, table, columns, where in WORKLOAD_INDEXES:
+        db.session.execute(text(workload_index_ddl(name, table, columns, where)))
+    db.session.commit()
+
+
+@click.command()
+@click.option('--database-url', default=None, help='Scratch database to seed (default: a temporary SQLite file).')
+@click.option('--bookings', default=50000, show_default=True, help='Number of bookings to seed.')
+@click.option('--runs', default=5, show_default=True, help='Executions per query; medians are reported.')
+@click.option('--seed', 'seed_value', default=7, show_default=True, help='Random seed for the dataset.')
+def main(database_url, bookings, runs, seed_value):
+    scratch = None
+    if not database_url:
+        scratch = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        database_url = f'sqlite:///{scratch.name}'
+
+    class BenchmarkConfig(config['testing']):
+        SQLALCHEMY_DATABASE_URI = database_url
+        SQLALCHEMY_ENGINE_OPTIONS = {}
+        SCHEMA_AUTO_SYNC = False
+
+    config['index_benchmark'] = BenchmarkConfig
+    try:
+        app = create_app('index_benchmark')
+    finally:
+        del config['index_benchmark']
+
+    try:
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            drop_workload_indexes()
+            click.echo(f"Seeding {bookings} bookings into {db.engine.url.render_as_string(hide_password=True)} ...")
+            started = time.perf_counter()
+            sample, now = seed(bookings, seed_value)
+            click.echo(f"Seeded in {time.perf_counter() - started:.1f}s\n")
+
+            queries = _queries(now, sample)
+            before = measure(queries, runs)
+            create_workload_indexes()
+            after = measure(queries, runs)
+
+            click.echo(f"{'before ms':>10} {'after ms':>10} {'speed-up':>9}  query")
+            for label, _ in queries:
+                b_ms, a_ms = before[label][1], after[label][1]
+                click.echo(f"{b_ms:>10.2f} {a_ms:>10.2f} {b_ms / a_ms if a_ms else 0:>8.1f}x  {label}")
+
+            click.echo('\nPlans:')
+            for label, _ in queries:
+                click.echo(f"\n{label}\n  before: {before[label][0]}\n  after:  {after[label][0]}")
+            db.session.remove()
+            db.drop_all()
+    finally:
+        if scratch is not None:
+            scratch.close()
+            os.remove(scratch.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+// Polls a queued Xero operation (see app/services/xero_outbox.py) until the
+// outbox worker has sent or given up on it.
+
+async function waitForXeroOutbox(statusUrl, options = {}) {
+    const interval = options.interval || 2000;
+    const timeout = options.timeout || 120000;
+    const started = Date.now();
+
+    while (true) {
+        const response = await fetch(statusUrl, { headers: { 'Accept': 'application/json' } });
+        const entry = await response.json();
+        if (!response.ok) {
+            throw new Error(entry.error || 'Could not check the invoice status');
+        }
+        if (entry.status === 'sent' || entry.status === 'failed') {
+            return entry;
+        }
+        if (Date.now() - started > timeout) {
+            // Still queued (e.g. Xero rate limit); the worker will keep trying
+            return entry;
+        }
+        await new Promise(resolve => setTimeout(resolve, interval));
+    }
+}
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Tests for the two-tier application cache (app.cache).
+"""
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from app import create_app
+from app import cache as cache_module
+from app.cache import cache
+
+
+class AppCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.app = create_app('testing')
+        self.app.config.update(CACHE_TYPE='filesystem', CACHE_DIR=self.cache_dir)
+        cache.init_app(self.app)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_shared_tier_survives_local_eviction(self):
+        cache.set('fleet:summary', {'cars': 3}, ttl=60)
+        self.app.extensions['cache'].local.clear()
+        self.assertEqual(cache.get('fleet:summary'), {'cars': 3})
+        stats = cache.stats()
+        self.assertEqual(stats['shared_hits'], 1)
+        self.assertEqual(cache.get('fleet:summary'), {'cars': 3})
+        self.assertEqual(cache.stats()['local_hits'], 1)
+
+        cache.delete('fleet:summary')
+        self.assertIsNone(cache.get('fleet:summary'))
+
+    def test_cached_decorator_and_invalidate(self):
+        calls = []
+
+        @cache.cached(ttl=60)
+        def quote(car_id, days=1):
+            calls.append((car_id, days))
+            return car_id * days
+
+        self.assertEqual(quote(5, days=3), 15)
+        self.assertEqual(quote(5, days=3), 15)
+        self.assertEqual(quote(6), 6)
+        self.assertEqual(calls, [(5, 3), (6, 1)])
+
+        quote.invalidate(5, days=3)
+        quote(5, days=3)
+        self.assertEqual(len(calls), 3)
+
+    def test_concurrent_misses_compute_once(self):
+        calls = []
+        results = []
+
+        def slow_factory():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'value'
+
+        def worker():
+            with self.app.app_context():
+                results.append(cache.get_or_set('stampede', slow_factory, ttl=60))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ['value'] * 8)
+        self.assertEqual(len(calls), 1)
+
+    def test_update_is_serialised_and_respects_foreign_locks(self):
+        def bump(value):
+            return (value or 0) + 1, None
+
+        threads = [threading.Thread(target=lambda: self._in_context(cache.update, 'counter', bump))
+                   for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(cache.update('counter', lambda value: (value, value)), 8)
+
+        # A lock held by another worker is never broken or deleted
+        backend = self.app.extensions['cache'].backend
+        lock_key = 'aurora:lock:counter'
+        backend.add(lock_key, 'other-worker', 60)
+        with mock.patch.object(cache_module, 'UPDATE_LOCK_TTL', 0.05):
+            with self.assertRaises(TimeoutError):
+                cache.update('counter', bump)
+        self.assertEqual(backend.get(lock_key), (True, 'other-worker'))
+
+    def _in_context(self, fn, *args):
+        with self.app.app_context():
+            fn(*args)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Tests for projected direct debit installments and the cash-flow forecast report.
+"""
+
+import unittest
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+from app import create_app, db
+from app.models import (Booking, BookingStatus, Car, CarCategory, CarStatus, DirectDebitSchedule,
+                        ProjectedInstallment, Role, User)
+from app.services import cash_flow
+from app.services.cash_flow import cash_flow_forecast, project_schedule, refresh_projections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HORIZON = date(2027, 12, 31)
+
+
+def _schedule(**fields):
+    return DirectDebitSchedule(schedule_id='SCH', recurring_amount=100.0, **fields)
+
+
+class ProjectScheduleTestCase(unittest.TestCase):
+    def _project(self, schedule):
+        # The one-at-a-time generation, whether or not NumPy is installed
+        with mock.patch.object(cash_flow, '_numpy', return_value=None):
+            return project_schedule(schedule, HORIZON)
+
+    def test_recurring_payments_stop_at_the_end_amount(self):
+        schedule = _schedule(upfront_amount=50.0, upfront_date=date(2027, 1, 1), frequency='fortnightly',
+                             recurring_start_date=date(2027, 1, 4), end_condition_amount=250.0)
+        self.assertEqual(self._project(schedule), [
+            (date(2027, 1, 1), 50.0, 'upfront'),
+            (date(2027, 1, 4), 100.0, 'recurring'),
+            (date(2027, 1, 18), 100.0, 'recurring'),
+            (date(2027, 2, 1), 50.0, 'recurring'),
+        ])
+
+    def test_open_ended_schedule_runs_to_the_horizon(self):
+        schedule = _schedule(frequency='weekly', recurring_start_date=date(2027, 12, 1))
+        dates = [row[0] for row in self._project(schedule)]
+        self.assertEqual(dates, [date(2027, 12, 1), date(2027, 12, 8), date(2027, 12, 15),
+                                 date(2027, 12, 22), date(2027, 12, 29)])
+
+    def test_monthly_payments_skip_months_without_the_start_day(self):
+        schedule = _schedule(frequency='monthly', recurring_start_date=date(2027, 1, 31), end_condition_amount=400.0)
+        dates = [row[0] for row in self._project(schedule)]
+        self.assertEqual(dates, [date(2027, 1, 31), date(2027, 3, 31), date(2027, 5, 31), date(2027, 7, 31)])
+
+    @unittest.skipUnless(numpy, 'numpy is not installed')
+    def test_numpy_dates_match_the_schedule(self):
+        schedules = [
+            _schedule(frequency='weekly', recurring_start_date=date(2027, 2, 3), end_condition_amount=1250.0),
+            _schedule(frequency='fortnightly', recurring_start_date=date(2027, 2, 3)),
+            _schedule(frequency='monthly', recurring_start_date=date(2027, 1, 31), end_condition_amount=2000.0),
+            _schedule(frequency='monthly', recurring_start_date=date(2027, 1, 29)),
+        ]
+        for schedule in schedules:
+            self.assertEqual(project_schedule(schedule, HORIZON), self._project(schedule))
+
+
+class CashFlowTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        car = Car(
+            make='Kia', model='Rio', year=2023, category=CarCategory.SEDAN,
+            license_plate='CASH1', vin='VINCASHFLOW1', seats=5, transmission='Automatic',
+            fuel_type='Gasoline', daily_rate=60, weekly_rate=350, status=CarStatus.AVAILABLE,
+        )
+        admin = User(email='admin@test.com', username='admin', first_name='A', last_name='D', role=Role.ADMIN)
+        admin.set_password('password')
+        customer = User(email='cash@test.com', username='cash', first_name='C', last_name='F', role=Role.CUSTOMER)
+        customer.set_password('password')
+        db.session.add_all([car, admin, customer])
+        db.session.flush()
+        self.booking = Booking(
+            booking_number='BK-CASH', customer_id=customer.id, car_id=car.id,
+            pickup_date=datetime.utcnow(), return_date=datetime.utcnow() + timedelta(days=7),
+            pickup_location='HQ', return_location='HQ', daily_rate=60, total_days=7,
+            subtotal=420, total_amount=420, license_document_url='/uploads/license.pdf',
+            status=BookingStatus.IN_PROGRESS,
+        )
+        db.session.add(self.booking)
+        db.session.flush()
+        # Both start on a Monday
+        self.monday = date.today() - timedelta(days=date.today().weekday()) + timedelta(weeks=1)
+        db.session.add_all([
+            DirectDebitSchedule(booking_id=self.booking.id, schedule_id='SCH1', status='active', frequency='weekly',
+                                upfront_amount=200.0, upfront_date=self.monday, recurring_amount=100.0,
+                                recurring_start_date=self.monday, end_condition_amount=400.0),
+            DirectDebitSchedule(booking_id=self.booking.id, schedule_id='SCH2', status='active',
+                                frequency='fortnightly', recurring_amount=50.0, recurring_start_date=self.monday),
+        ])
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(admin.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_only_changed_schedules_are_projected_again(self):
+        self.app.config['CASH_FLOW_HORIZON_DAYS'] = 28
+        summary = refresh_projections()
+        self.assertTrue(summary['full'])
+        self.assertEqual(ProjectedInstallment.query.filter_by(schedule_id='SCH1').count(), 5)
+        self.assertEqual(ProjectedInstallment.query.filter_by(schedule_id='SCH2').count(), 2)
+
+        self.assertEqual(refresh_projections()['schedules'], 0)
+
+        schedule = DirectDebitSchedule.query.filter_by(schedule_id='SCH1').one()
+        schedule.recurring_amount = 200.0
+        db.session.commit()
+        summary = refresh_projections()
+        self.assertEqual(summary['schedules'], 1)
+        self.assertEqual(summary['removed'], 5)
+        amounts = [row.amount for row in ProjectedInstallment.query.filter_by(schedule_id='SCH1', kind='recurring')]
+        self.assertEqual(amounts, [200.0, 200.0])
+
+        schedule.status = 'cancelled'
+        db.session.commit()
+        refresh_projections()
+        self.assertEqual(ProjectedInstallment.query.filter_by(schedule_id='SCH1').count(), 0)
+        self.assertEqual(ProjectedInstallment.query.filter_by(schedule_id='SCH2').count(), 2)
+
+    def test_open_ended_schedules_follow_the_horizon(self):
+        self.app.config['CASH_FLOW_HORIZON_DAYS'] = 28
+        refresh_projections()
+        self.app.config['CASH_FLOW_HORIZON_DAYS'] = 56
+        summary = refresh_projections()
+        self.assertEqual(summary['schedules'], 1)
+        self.assertEqual(ProjectedInstallment.query.filter_by(schedule_id='SCH2').count(), 4)
+
+    def test_forecast_sums_projections_by_week_and_month(self):
+        self.app.config['CASH_FLOW_HORIZON_DAYS'] = 28
+        refresh_projections()
+        weeks = cash_flow_forecast(self.monday, self.monday + timedelta(weeks=2), 'week')
+        self.assertEqual([(row['period_start'], row['amount'], row['installments']) for row in weeks], [
+            (self.monday, 350.0, 3),
+            (self.monday + timedelta(weeks=1), 100.0, 1),
+            (self.monday + timedelta(weeks=2), 150.0, 2),
+        ])
+        months = cash_flow_forecast(self.monday, self.monday + timedelta(weeks=8), 'month')
+        self.assertEqual(sum(row['amount'] for row in months), 700.0)
+        self.assertEqual(months[0]['period_start'], self.monday.replace(day=1))
+
+        response = self.client.get('/reports/cash-flow', query_string={
+            'start_date': self.monday.isoformat(), 'period': 'month'})
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertEqual(body['total_amount'], 700.0)
+        self.assertEqual(body['periods'][0]['period_start'], self.monday.replace(day=1).isoformat())
+        self.assertEqual(self.client.get('/reports/cash-flow?period=day').status_code, 400)
+
+        response = self.client.get('/reports/export/cash-flow', query_string={'start_date': self.monday.isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data.decode().strip().splitlines()), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Tests for connection pool settings, PgBouncer mode and pool checkout metrics.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine, text
+
+from app.utils.db_pool import TimedQueuePool, apply_statement_timeout, engine_options, statement_timeout_disabled
+from app.utils.metrics import metrics
+
+
+class EngineOptionsTestCase(unittest.TestCase):
+    def test_postgres_gets_pool_settings_and_statement_timeout(self):
+        settings = {'DB_POOL_SIZE': 8, 'DB_MAX_OVERFLOW': 2, 'DB_POOL_RECYCLE': 300, 'DB_STATEMENT_TIMEOUT_MS': 5000}
+        options = engine_options(settings, 'postgresql://u:p@db.example.com/aurora')
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertEqual(options['pool_size'], 8)
+        self.assertEqual(options['max_overflow'], 2)
+        self.assertEqual(options['pool_recycle'], 300)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=5000'})
+
+    def test_pgbouncer_mode_avoids_startup_options_and_prepared_statements(self):
+        settings = {'DB_PGBOUNCER': True, 'DB_STATEMENT_TIMEOUT_MS': 5000}
+        self.assertNotIn('connect_args', engine_options(settings, 'postgresql://u:p@pgbouncer:6432/aurora'))
+        options = engine_options(settings, 'postgresql+psycopg://u:p@pgbouncer:6432/aurora')
+        self.assertEqual(options['connect_args'], {'prepare_threshold': None})
+
+    def test_sqlite_keeps_defaults(self):
+        self.assertEqual(engine_options({'DB_POOL_SIZE': 20}, 'sqlite:///:memory:'), {})
+        self.assertEqual(engine_options({}, 'sqlite:////tmp/aurora.db'), {})
+
+    def test_statement_timeout_is_lifted_inside_statement_timeout_disabled(self):
+        conn = mock.Mock()
+        apply_statement_timeout(conn, 5000, per_transaction=False)
+        conn.exec_driver_sql.assert_not_called()
+        apply_statement_timeout(conn, 5000, per_transaction=True)
+        conn.exec_driver_sql.assert_called_with('SET LOCAL statement_timeout = 5000')
+        with statement_timeout_disabled():
+            apply_statement_timeout(conn, 5000, per_transaction=False)
+            conn.exec_driver_sql.assert_called_with('SET LOCAL statement_timeout = 0')
+        apply_statement_timeout(conn, 5000, per_transaction=True)
+        conn.exec_driver_sql.assert_called_with('SET LOCAL statement_timeout = 5000')
+
+
+class TimedQueuePoolTestCase(unittest.TestCase):
+    def test_checkout_wait_is_observed(self):
+        metrics_dir = tempfile.mkdtemp()
+        metrics.configure(metrics_dir, 0)
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        engine = create_engine(f'sqlite:///{path}', poolclass=TimedQueuePool, pool_size=1, max_overflow=0)
+        engine.pool.metrics_bind = 'unit_test'
+        try:
+            with engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+            metrics.flush()
+            self.assertIn('db_pool_checkout_wait_seconds_count{bind="unit_test"} 1', metrics.render())
+        finally:
+            engine.dispose()
+            os.remove(path)
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Tests for the {% cache %} template fragment cache.
+"""
+
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import event
+
+from app import create_app, db
+from app.models import Car, CarCategory, CarStatus
+from config import config
+
+
+class FragmentCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        with self.app.app_context():
+            db.create_all()
+            db.session.add(Car(
+                make='Toyota', model='Camry', year=2023, category=CarCategory.SEDAN,
+                license_plate='FRAG001', vin='VINFRAG001', seats=5, transmission='Automatic',
+                fuel_type='Gasoline', daily_rate=80, weekly_rate=450, status=CarStatus.AVAILABLE,
+            ))
+            db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.drop_all()
+
+    def _count_queries(self, path):
+        statements = []
+
+        def _record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', _record)
+        try:
+            resp = self.client.get(path)
+        finally:
+            event.remove(engine, 'before_cursor_execute', _record)
+        return resp, statements
+
+    def test_home_page_hit_does_not_query_database(self):
+        resp, statements = self._count_queries('/')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'2023 Toyota Camry', resp.data)
+        self.assertTrue(statements)
+
+        resp, statements = self._count_queries('/')
+        self.assertIn(b'2023 Toyota Camry', resp.data)
+        self.assertEqual(statements, [])
+
+    def test_car_change_invalidates_fragments(self):
+        self.client.get('/')
+        self.client.get('/cars/')
+        with self.app.app_context():
+            car = Car.query.filter_by(license_plate='FRAG001').first()
+            car.model = 'Corolla'
+            db.session.commit()
+
+        self.assertIn(b'2023 Toyota Corolla', self.client.get('/').data)
+        fleet = self.client.get('/cars/')
+        self.assertEqual(fleet.status_code, 200)
+        self.assertIn(b'2023 Toyota Corolla', fleet.data)
+        self.assertNotIn(b'2023 Toyota Camry', fleet.data)
+
+    def test_fleet_page_hit_does_not_query_database(self):
+        self._count_queries('/cars/')
+        resp, statements = self._count_queries('/cars/')
+        self.assertIn(b'2023 Toyota Camry', resp.data)
+        self.assertEqual(statements, [])
+
+    def test_fragments_are_shared_through_the_cache_backend(self):
+        cache_dir = tempfile.mkdtemp()
+
+        class SharedCacheConfig(config['testing']):
+            CACHE_TYPE = 'filesystem'
+            CACHE_DIR = cache_dir
+
+        config['shared_cache'] = SharedCacheConfig
+        try:
+            self.app = create_app('shared_cache')
+            with self.app.app_context():
+                db.session.add(Car(
+                    make='Toyota', model='Camry', year=2023, category=CarCategory.SEDAN,
+                    license_plate='FRAG001', vin='VINFRAG001', seats=5, transmission='Automatic',
+                    fuel_type='Gasoline', daily_rate=80, weekly_rate=450, status=CarStatus.AVAILABLE,
+                ))
+                db.session.commit()
+            self.client = self.app.test_client()
+            self._count_queries('/')
+
+            # Another worker: an empty local tier, the same shared backend
+            self.app = create_app('shared_cache')
+            self.client = self.app.test_client()
+            resp, statements = self._count_queries('/')
+            self.assertIn(b'2023 Toyota Camry', resp.data)
+            self.assertEqual(statements, [])
+        finally:
+            del config['shared_cache']
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Tests for the handover flow: concurrent photo uploads and customer checks, step timings.
+"""
+
+import base64
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from app import create_app, db
+from app.models import (Booking, BookingPhoto, BookingStatus, Car, CarCategory, CarStatus,
+                        PayAdvantageCustomer, Role, User)
+from app.services.pay_advantage import PayAdvantageService
+from app.services.storage import StorageService
+from app.utils.flow import Flow
+from app.utils.metrics import _label_key, metrics
+
+PHOTO = 'data:image/jpeg;base64,' + base64.b64encode(b'jpeg-bytes').decode()
+
+
+def _step_count(step):
+    entry = metrics._samples['flow_step_duration_seconds'].get(_label_key({'flow': 'handover', 'step': step}))
+    return entry['count'] if entry else 0
+
+
+class HandoverFlowTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        car = Car(
+            make='Kia', model='Rio', year=2023, category=CarCategory.SEDAN,
+            license_plate='HAND1', vin='VINHANDOVER1', seats=5, transmission='Automatic',
+            fuel_type='Gasoline', daily_rate=60, weekly_rate=350, status=CarStatus.AVAILABLE,
+        )
+        admin = User(email='admin@test.com', username='admin', first_name='A', last_name='D', role=Role.ADMIN)
+        admin.set_password('password')
+        customer = User(email='handover@test.com', username='handover', first_name='H', last_name='C',
+                        role=Role.CUSTOMER, phone='0400000000')
+        customer.set_password('password')
+        db.session.add_all([car, admin, customer])
+        db.session.flush()
+        self.booking = Booking(
+            booking_number='BK-HANDOVER', customer_id=customer.id, car_id=car.id,
+            pickup_date=datetime.utcnow(), return_date=datetime.utcnow() + timedelta(days=7),
+            pickup_location='HQ', return_location='HQ', daily_rate=60, total_days=7,
+            subtotal=420, total_amount=420, license_document_url='/uploads/license.pdf',
+            status=BookingStatus.CONFIRMED,
+        )
+        db.session.add(self.booking)
+        db.session.add(PayAdvantageCustomer(user_id=customer.id, customer_code='CUS1'))
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(admin.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def _complete(self, payload):
+        return self.client.post(f'/admin/api/booking/{self.booking.id}/complete-handover', json=payload)
+
+    def test_photos_and_customer_check_run_concurrently(self):
+        running, peak, lock = [0], [0], threading.Lock()
+
+        def slow(*args, **kwargs):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.2)
+            with lock:
+                running[0] -= 1
+            return True
+
+        def upload(data, key, content_type=None):
+            slow()
+            return f'/uploads/{key}'
+
+        uploads_before = _step_count('photo_upload')
+        schedule = {'schedule_id': 'SCH1', 'authorization_url': 'https://pay.example/auth'}
+        with mock.patch.object(StorageService, 'upload_bytes', side_effect=upload), \
+                mock.patch.object(PayAdvantageService, 'verify_customer', side_effect=slow) as verify, \
+                mock.patch.object(PayAdvantageService, 'create_direct_debit_schedule', return_value=schedule):
+            started = time.perf_counter()
+            response = self._complete({
+                'photos': [{'name': 'front', 'data': PHOTO}, {'name': 'rear', 'data': PHOTO}],
+                'direct_debit': {'upfront_amount': 100},
+            })
+            elapsed = time.perf_counter() - started
+
+        body = response.get_json()
+        self.assertTrue(body['success'], body)
+        self.assertEqual(body['authorization_url'], 'https://pay.example/auth')
+        self.assertEqual(peak[0], 3)
+        self.assertLess(elapsed, 0.5)
+        verify.assert_called_once_with('CUS1', '0400000000')
+        photos = BookingPhoto.query.filter_by(booking_id=self.booking.id).all()
+        self.assertEqual(sorted(photo.description for photo in photos), ['front', 'rear'])
+        self.assertEqual(db.session.get(Booking, self.booking.id).status, BookingStatus.IN_PROGRESS)
+        self.assertEqual(_step_count('photo_upload') - uploads_before, 2)
+
+    def test_slow_upload_fails_the_handover(self):
+        self.app.config['HANDOVER_STEP_TIMEOUT'] = 0.1
+
+        def upload(data, key, content_type=None):
+            time.sleep(0.3)
+            return f'/uploads/{key}'
+
+        with mock.patch.object(StorageService, 'upload_bytes', side_effect=upload):
+            body = self._complete({'photos': [{'name': 'front', 'data': PHOTO}]}).get_json()
+        self.assertFalse(body['success'])
+        self.assertIn('did not finish', body['message'])
+        self.assertEqual(db.session.get(Booking, self.booking.id).status, BookingStatus.CONFIRMED)
+        self.assertEqual(BookingPhoto.query.count(), 0)
+
+    def test_flow_reraises_the_failing_step(self):
+        flow = Flow('handover')
+
+        def fail():
+            raise ValueError('storage unavailable')
+
+        with self.assertRaisesRegex(ValueError, 'storage unavailable'):
+            flow.concurrently({'ok': lambda: 1, 'broken': fail}, timeout=5)
+        self.assertEqual(set(flow.timings), {'ok', 'broken'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Tests for the model-change cache invalidation bus.
+"""
+
+import unittest
+from datetime import datetime, timedelta
+
+from app import create_app, db
+from app.cache import cache
+from app.models import Booking, Car, CarCategory, CarStatus, Role, User
+from app.utils.invalidation import subscribe, _subscribers
+
+
+class InvalidationBusTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.car = Car(
+            make='Mazda', model='3', year=2022, category=CarCategory.SEDAN,
+            license_plate='BUS001', vin='VINBUS001', seats=5, transmission='Automatic',
+            fuel_type='Gasoline', daily_rate=70, weekly_rate=400, status=CarStatus.AVAILABLE,
+        )
+        self.user = User(email='bus@test.com', username='bus', first_name='B', last_name='U', role=Role.CUSTOMER)
+        self.user.set_password('password')
+        db.session.add_all([self.car, self.user])
+        db.session.commit()
+        self.published = []
+        subscribe(self.published.append)
+
+    def tearDown(self):
+        _subscribers.remove(self.published.append)
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_commit_publishes_row_and_group_tags(self):
+        self.car.daily_rate = 75
+        db.session.commit()
+        self.assertEqual(self.published[-1], {'fleet', f'car:{self.car.id}'})
+
+        booking = Booking(
+            booking_number='BK-BUS-1', customer_id=self.user.id, car_id=self.car.id,
+            pickup_date=datetime.utcnow(), return_date=datetime.utcnow() + timedelta(days=2),
+            pickup_location='HQ', return_location='HQ', daily_rate=75, total_days=2,
+            subtotal=150, total_amount=150, license_document_url='/uploads/license.pdf',
+        )
+        db.session.add(booking)
+        db.session.commit()
+        self.assertIn(f'car:{self.car.id}', self.published[-1])
+        self.assertIn(f'user:{self.user.id}:bookings', self.published[-1])
+        self.assertIn('bookings', self.published[-1])
+
+    def test_rollback_publishes_nothing(self):
+        self.car.daily_rate = 99
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(self.published, [])
+
+    def test_tagged_entries_expire_on_commit(self):
+        cache.set('car-summary', 'old', ttl=600, tags=[f'car:{self.car.id}'])
+        cache.set('unrelated', 'kept', ttl=600, tags=['car:999999'])
+        self.assertEqual(cache.get('car-summary'), 'old')
+
+        self.car.seats = 4
+        db.session.commit()
+        self.assertIsNone(cache.get('car-summary'))
+        self.assertEqual(cache.get('unrelated'), 'kept')
+
+    def test_bulk_update_publishes_coarse_tags(self):
+        Car.query.filter_by(id=self.car.id).update({'seats': 7})
+        db.session.commit()
+        self.assertIn('fleet', self.published[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Tests for the Prometheus /metrics endpoint.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from app import create_app
+from app.utils.metrics import AGGREGATE_FILE, metrics, track_job
+
+# No process runs under this pid (above the Linux pid_max)
+DEAD_PID = 2 ** 23
+
+
+class MetricsEndpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+        self.app = create_app('testing')
+        # The registry is process-wide; point it at a scratch directory for this test
+        metrics.configure(self.metrics_dir, 0)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+    def test_request_latency_histogram_is_exposed(self):
+        self.client.get('/api/health')
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        body = resp.get_data(as_text=True)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', body)
+        self.assertIn('http_request_duration_seconds_bucket{', body)
+        self.assertIn('endpoint="api.health"', body)
+
+    def test_background_job_failures_are_counted(self):
+        with self.assertRaises(RuntimeError):
+            with track_job('unit_test_job'):
+                raise RuntimeError('boom')
+        body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('background_job_failures_total{job="unit_test_job"} 1', body)
+
+    def test_token_is_required_when_configured(self):
+        self.app.config['METRICS_TOKEN'] = 'scrape-secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        resp = self.client.get('/metrics', headers={'Authorization': 'Bearer scrape-secret'})
+        self.assertEqual(resp.status_code, 200)
+
+    def _write_state(self, filename, pid, failures):
+        state = {'pid': pid, 'gauges': {},
+                 'samples': {'background_job_failures_total': [[[['job', 'exited_job']], failures]]}}
+        with open(os.path.join(self.metrics_dir, filename), 'w') as f:
+            json.dump(state, f)
+
+    def test_files_of_exited_processes_are_folded_into_the_aggregate(self):
+        # Two processes that had the same pid, one after the other
+        self._write_state(f'{DEAD_PID}-1.json', DEAD_PID, 2)
+        self._write_state(f'{DEAD_PID}-2.json', DEAD_PID, 3)
+        for _ in range(2):
+            body = self.client.get('/metrics').get_data(as_text=True)
+            self.assertIn('background_job_failures_total{job="exited_job"} 5', body)
+        files = os.listdir(self.metrics_dir)
+        self.assertIn(AGGREGATE_FILE, files)
+        self.assertFalse([name for name in files if name.startswith(f'{DEAD_PID}-')])
+
+        self._write_state(f'{DEAD_PID}-3.json', DEAD_PID, 1)
+        body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('background_job_failures_total{job="exited_job"} 6', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Tests for PayAdvantage token caching and the pooled session.
+"""
+
+import base64
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+from app import create_app
+from app.services import pay_advantage
+from app.services.pay_advantage import PayAdvantageService, get_pay_advantage_session
+from config import config
+
+
+def _response(status, body=None):
+    response = requests.Response()
+    response.status_code = status
+    response._content = requests.compat.json.dumps(body or {}).encode()
+    return response
+
+
+class FakePayAdvantage:
+    """Answers auth and API calls, counting authentications."""
+
+    def __init__(self, expires_in=3600, auth_delay=0):
+        self.expires_in = expires_in
+        self.auth_delay = auth_delay
+        self.auth_calls = 0
+        self.revoked = set()
+        self.lock = threading.Lock()
+
+    def __call__(self, method, url, **kwargs):
+        if url.endswith('/v3/authenticate'):
+            time.sleep(self.auth_delay)
+            with self.lock:
+                self.auth_calls += 1
+                token = f'token-{self.auth_calls}'
+            return _response(200, {'token': token, 'expires_in': self.expires_in})
+        if kwargs['headers']['Authorization'].split()[-1] in self.revoked:
+            return _response(401, {'message': 'token expired'})
+        return _response(200, {'customerCode': 'CUS1'})
+
+
+class PayAdvantageTokenTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.fake = FakePayAdvantage()
+        patcher = mock.patch.object(get_pay_advantage_session(), 'request', side_effect=self.fake)
+        self.send = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def test_token_is_reused_across_service_instances(self):
+        PayAdvantageService()._make_request('GET', '/v3/customers/CUS1')
+        PayAdvantageService()._make_request('GET', '/v3/customers/CUS1')
+        self.assertEqual(self.fake.auth_calls, 1)
+        self.assertEqual(self.send.call_count, 3)
+
+    def test_calls_use_timeouts(self):
+        PayAdvantageService()._make_request('GET', '/v3/customers/CUS1')
+        self.assertEqual(self.send.call_args.kwargs['timeout'], (3.05, 20.0))
+
+    def test_short_lived_token_is_refreshed(self):
+        self.fake.expires_in = 0.2
+        PayAdvantageService()._make_request('GET', '/v3/customers/CUS1')
+        PayAdvantageService()._make_request('GET', '/v3/customers/CUS1')
+        self.assertEqual(self.fake.auth_calls, 1)
+        # Replaced once past the middle of its life
+        time.sleep(0.15)
+        PayAdvantageService()._make_request('GET', '/v3/customers/CUS1')
+        self.assertEqual(self.fake.auth_calls, 2)
+
+    def test_rejected_token_is_replaced_once(self):
+        PayAdvantageService()._make_request('GET', '/v3/customers/CUS1')
+        self.fake.revoked.add('token-1')
+        result = PayAdvantageService()._make_request('GET', '/v3/customers/CUS1')
+        self.assertEqual(result, {'customerCode': 'CUS1'})
+        self.assertEqual(self.fake.auth_calls, 2)
+
+    def test_concurrent_callers_authenticate_once(self):
+        self.fake.auth_delay = 0.2
+        tokens = []
+
+        def call():
+            with self.app.app_context():
+                tokens.append(PayAdvantageService()._get_token())
+
+        threads = [threading.Thread(target=call) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.fake.auth_calls, 1)
+        self.assertEqual(set(tokens), {'token-1'})
+
+    def test_jwt_expiry_is_used_when_response_has_none(self):
+        claims = base64.urlsafe_b64encode(b'{"exp": 2000000000}').decode().rstrip('=')
+        self.assertEqual(pay_advantage._token_expiry({}, f'header.{claims}.signature'), 2000000000)
+
+
+class SharedTokenTestCase(unittest.TestCase):
+    def test_token_is_shared_between_workers(self):
+        fd, path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        class SharedCacheConfig(config['testing']):
+            CACHE_TYPE = 'sqlite'
+            CACHE_SQLITE_PATH = path
+
+        config['pay_advantage_test'] = SharedCacheConfig
+        try:
+            workers = [create_app('pay_advantage_test'), create_app('pay_advantage_test')]
+        finally:
+            del config['pay_advantage_test']
+
+        fake = FakePayAdvantage()
+        for app in workers:
+            with app.app_context(), mock.patch.object(get_pay_advantage_session(), 'request', side_effect=fake):
+                PayAdvantageService()._make_request('GET', '/v3/customers/CUS1')
+        self.assertEqual(fake.auth_calls, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Tests for reconciling direct debit installments and payments with PayAdvantage.
+"""
+
+import unittest
+from datetime import date, datetime, timedelta
+
+from app import create_app, db
+from app.models import (Booking, BookingStatus, Car, CarCategory, CarStatus, DirectDebitInstallment,
+                        DirectDebitSchedule, Payment, Role, SyncCheckpoint, User)
+from app.services.pay_advantage_reconcile import (RECONCILE_CHECKPOINT, RECONCILE_MAX_AGE_DAYS, RECONCILE_MAX_ATTEMPTS,
+                                                  reconcile_payments, reconcile_recent)
+
+TODAY = date.today()
+
+
+def _payment(payment_id, days, status='completed', schedule_id='SCH1'):
+    due = (TODAY - timedelta(days=days)).isoformat()
+    return {'id': payment_id, 'scheduleId': schedule_id, 'dueDate': due, 'dueAmount': 100.0,
+            'paidDate': due if status == 'completed' else None,
+            'paidAmount': 100.0 if status == 'completed' else None, 'status': status}
+
+
+class FakePayments:
+    """Serves ``payments`` two per page, optionally failing on one page."""
+
+    PAYMENTS_PAGE_SIZE = 2
+
+    def __init__(self, payments, fail_on_page=None):
+        self.payments = payments
+        self.fail_on_page = fail_on_page
+        self.pages = []
+
+    def get_payments(self, date_from, date_to, page=1):
+        self.pages.append(page)
+        if page == self.fail_on_page:
+            raise Exception('PayAdvantage API error: 503')
+        start = (page - 1) * self.PAYMENTS_PAGE_SIZE
+        return self.payments[start:start + self.PAYMENTS_PAGE_SIZE]
+
+
+class ReconcileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        car = Car(
+            make='Kia', model='Rio', year=2023, category=CarCategory.SEDAN,
+            license_plate='RECON1', vin='VINRECON1', seats=5, transmission='Automatic',
+            fuel_type='Gasoline', daily_rate=60, weekly_rate=350, status=CarStatus.AVAILABLE,
+        )
+        customer = User(email='recon@test.com', username='recon', first_name='R', last_name='C', role=Role.CUSTOMER)
+        customer.set_password('password')
+        db.session.add_all([car, customer])
+        db.session.flush()
+        self.booking = Booking(
+            booking_number='BK-RECON', customer_id=customer.id, car_id=car.id,
+            pickup_date=datetime.utcnow(), return_date=datetime.utcnow() + timedelta(days=7),
+            pickup_location='HQ', return_location='HQ', daily_rate=60, total_days=7,
+            subtotal=420, total_amount=420, license_document_url='/uploads/license.pdf',
+            status=BookingStatus.IN_PROGRESS,
+        )
+        db.session.add(self.booking)
+        db.session.flush()
+        db.session.add(DirectDebitSchedule(booking_id=self.booking.id, schedule_id='SCH1'))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_missed_payments_are_recorded_and_matching_ones_left_alone(self):
+        # Already up to date from its webhook
+        db.session.add(DirectDebitInstallment(
+            schedule_id='SCH1', booking_id=self.booking.id, external_payment_id='PAY1',
+            due_date=TODAY - timedelta(days=3), due_amount=100.0, status='pending'))
+        db.session.commit()
+        payments = [_payment('PAY1', 3, status='pending'), _payment('PAY2', 2), _payment('PAY3', 1),
+                    _payment('OTHER', 1, schedule_id='SCH9')]
+
+        summary = reconcile_payments(FakePayments(payments), TODAY - timedelta(days=7), TODAY)
+        self.assertEqual(summary['seen'], 4)
+        self.assertEqual(summary['changed'], 2)
+        self.assertEqual(summary['unmatched'], 1)
+        self.assertEqual(DirectDebitInstallment.query.count(), 3)
+        self.assertEqual({payment.gateway_transaction_id for payment in Payment.query}, {'PAY2', 'PAY3'})
+
+        # A second run finds nothing to write
+        summary = reconcile_payments(FakePayments(payments), TODAY - timedelta(days=7), TODAY)
+        self.assertEqual(summary['changed'], 0)
+
+    def test_installment_paid_without_a_webhook_is_updated(self):
+        db.session.add(DirectDebitInstallment(schedule_id='SCH1', booking_id=self.booking.id,
+                                              due_date=TODAY - timedelta(days=1), due_amount=100.0))
+        db.session.commit()
+        reconcile_payments(FakePayments([_payment('PAY1', 1)]), TODAY - timedelta(days=7), TODAY)
+        installment = DirectDebitInstallment.query.one()
+        self.assertEqual(installment.status, 'completed')
+        self.assertEqual(installment.external_payment_id, 'PAY1')
+        self.assertEqual(Payment.query.one().amount, 100.0)
+
+    def test_missing_payment_of_a_completed_installment_is_added(self):
+        db.session.add(DirectDebitInstallment(
+            schedule_id='SCH1', booking_id=self.booking.id, external_payment_id='PAY1',
+            due_date=TODAY - timedelta(days=1), due_amount=100.0, paid_date=TODAY - timedelta(days=1),
+            paid_amount=100.0, status='completed'))
+        db.session.commit()
+        summary = reconcile_payments(FakePayments([_payment('PAY1', 1)]), TODAY - timedelta(days=7), TODAY)
+        self.assertEqual(summary['changed'], 1)
+        self.assertEqual(Payment.query.one().gateway_transaction_id, 'PAY1')
+
+    def test_interrupted_run_resumes_at_its_page(self):
+        payments = [_payment(f'PAY{i}', i) for i in range(1, 6)]
+        self.app.config['PAY_ADVANTAGE_RECONCILE_DAYS'] = 7
+        failing = FakePayments(payments, fail_on_page=2)
+        with self.assertRaises(Exception):
+            reconcile_recent(failing)
+        cursor = db.session.get(SyncCheckpoint, RECONCILE_CHECKPOINT).cursor
+        self.assertEqual(cursor['page'], 2)
+        self.assertEqual(Payment.query.count(), 2)
+
+        service = FakePayments(payments)
+        summary = reconcile_recent(service)
+        # From the page before, in case payments moved back while the run was interrupted
+        self.assertEqual(service.pages, [1, 2, 3])
+        self.assertEqual(summary['changed'], 3)
+        self.assertEqual(Payment.query.count(), 5)
+        checkpoint = db.session.get(SyncCheckpoint, RECONCILE_CHECKPOINT)
+        self.assertIsNone(checkpoint.cursor)
+        self.assertEqual(checkpoint.watermark.date(), TODAY)
+
+    def test_range_that_keeps_failing_is_abandoned_for_the_current_window(self):
+        self.app.config['PAY_ADVANTAGE_RECONCILE_DAYS'] = 7
+        stale = {'from': (TODAY - timedelta(days=20)).isoformat(), 'to': (TODAY - timedelta(days=13)).isoformat(),
+                 'started': datetime.utcnow().isoformat(), 'attempts': 1, 'page': 2}
+        db.session.add(SyncCheckpoint(name=RECONCILE_CHECKPOINT, cursor=stale))
+        db.session.commit()
+        payments = [_payment(f'PAY{i}', i) for i in range(1, 6)]
+        for attempt in range(2, RECONCILE_MAX_ATTEMPTS + 1):
+            with self.assertRaises(Exception):
+                reconcile_recent(FakePayments(payments, fail_on_page=1))
+            self.assertEqual(db.session.get(SyncCheckpoint, RECONCILE_CHECKPOINT).cursor['attempts'], attempt)
+
+        service = FakePayments(payments)
+        summary = reconcile_recent(service)
+        self.assertEqual(summary['abandoned'], f"{stale['from']}..{stale['to']}")
+        self.assertEqual(summary['seen'], 5)
+        self.assertEqual(service.pages, [1, 2, 3])
+        self.assertIsNone(db.session.get(SyncCheckpoint, RECONCILE_CHECKPOINT).cursor)
+
+    def test_range_begun_too_long_ago_is_abandoned(self):
+        started = datetime.utcnow() - timedelta(days=RECONCILE_MAX_AGE_DAYS + 1)
+        db.session.add(SyncCheckpoint(name=RECONCILE_CHECKPOINT, cursor={
+            'from': '2020-01-01', 'to': '2020-01-08', 'started': started.isoformat(), 'page': 5}))
+        db.session.commit()
+        summary = reconcile_recent(FakePayments([]))
+        self.assertEqual(summary['abandoned'], '2020-01-01..2020-01-08')
+        self.assertEqual(summary['first_page'], 1)
+
+    def test_window_reaches_back_to_the_last_completed_run(self):
+        self.app.config['PAY_ADVANTAGE_RECONCILE_DAYS'] = 7
+        db.session.add(SyncCheckpoint(name=RECONCILE_CHECKPOINT,
+                                      watermark=datetime.combine(TODAY - timedelta(days=10), datetime.min.time())))
+        db.session.commit()
+        ranges = []
+
+        class Recording(FakePayments):
+            def get_payments(self, date_from, date_to, page=1):
+                ranges.append((date_from, date_to))
+                return super().get_payments(date_from, date_to, page)
+
+        reconcile_recent(Recording([]))
+        self.assertEqual(ranges, [(TODAY - timedelta(days=10), TODAY)])
+
+        # Caught up: the usual window again
+        reconcile_recent(Recording([]))
+        self.assertEqual(ranges[-1], (TODAY - timedelta(days=7), TODAY))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Tests for the on-demand request profiler (?_profile=1 / X-Profile-Token).
+"""
+
+import shutil
+import tempfile
+import unittest
+
+from app import create_app, db
+from app.models import User, Role
+
+
+class RequestProfilerTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.profile_dir = tempfile.mkdtemp()
+        cls.app = create_app('testing')
+        cls.app.config['PROFILER_DIR'] = cls.profile_dir
+        # No app context is kept pushed so each test client request gets a fresh flask.g
+        with cls.app.app_context():
+            db.create_all()
+            for email, role in (('admin@test.com', Role.ADMIN), ('cust@test.com', Role.CUSTOMER)):
+                user = User(email=email, username=email.split('@')[0], first_name='Test', last_name='User', role=role)
+                user.set_password('password')
+                db.session.add(user)
+            db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.app.app_context():
+            db.drop_all()
+        shutil.rmtree(cls.profile_dir, ignore_errors=True)
+
+    def _client(self, email=None):
+        client = self.app.test_client()
+        if email:
+            client.post('/auth/login', data={'email': email, 'password': 'password'})
+        return client
+
+    def test_manager_request_is_profiled_and_listed(self):
+        client = self._client('admin@test.com')
+        resp = client.get('/admin/settings?_profile=1')
+        self.assertEqual(resp.status_code, 200)
+        profile_id = resp.headers.get('X-Profile-Id')
+        self.assertTrue(profile_id)
+        self.assertGreaterEqual(int(resp.headers['X-Profile-Queries']), 1)
+
+        index = client.get('/admin/settings/profiles')
+        self.assertIn(profile_id.encode(), index.data)
+        detail = client.get(f'/admin/settings/profiles/{profile_id}')
+        self.assertEqual(detail.status_code, 200)
+
+    def test_customer_and_anonymous_requests_are_not_profiled(self):
+        self.assertNotIn('X-Profile-Id', self._client().get('/?_profile=1').headers)
+        self.assertNotIn('X-Profile-Id', self._client('cust@test.com').get('/?_profile=1').headers)
+
+    def test_signed_header_enables_profiling(self):
+        from app.utils.profiler import generate_profile_token, PROFILE_HEADER
+        with self.app.test_request_context():
+            token = generate_profile_token(1)
+        resp = self._client().get('/api/health', headers={PROFILE_HEADER: token})
+        self.assertIn('X-Profile-Id', resp.headers)
+        resp = self._client().get('/api/health', headers={PROFILE_HEADER: token + 'x'})
+        self.assertNotIn('X-Profile-Id', resp.headers)
+
+    def test_signed_header_for_non_manager_is_rejected(self):
+        from app.utils.profiler import generate_profile_token, PROFILE_HEADER
+        with self.app.test_request_context():
+            customer_id = User.query.filter_by(email='cust@test.com').one().id
+            tokens = [generate_profile_token(customer_id), generate_profile_token(9999)]
+        for token in tokens:
+            resp = self._client().get('/api/health', headers={PROFILE_HEADER: token})
+            self.assertNotIn('X-Profile-Id', resp.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
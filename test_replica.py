@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Tests for read-replica routing (@use_replica) and its lag fallback.
+"""
+
+import os
+import tempfile
+import unittest
+
+from app import create_app, db
+from app.models import Car, CarCategory, User, Role
+from app.utils.replica import REPLICA_BIND, reset_replica_lag, use_replica
+from config import config
+
+
+def _car(plate):
+    return {'make': 'Replica', 'model': plate, 'year': 2024, 'license_plate': plate, 'vin': f'VIN{plate}',
+            'category': CarCategory.SEDAN, 'seats': 5, 'daily_rate': 90.0}
+
+
+@use_replica
+def _count_cars_on_replica():
+    return Car.query.count()
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.replica_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+
+        class ReplicaConfig(config['testing']):
+            SQLALCHEMY_REPLICA_URL = f'sqlite:///{self.replica_path}'
+
+        config['replica_test'] = ReplicaConfig
+        try:
+            self.app = create_app('replica_test')
+        finally:
+            del config['replica_test']
+        reset_replica_lag()
+
+        # The "replica" holds one car the primary doesn't have
+        with self.app.app_context():
+            replica = db.engines[REPLICA_BIND]
+            db.metadata.create_all(replica)
+            with replica.begin() as conn:
+                conn.execute(db.insert(Car), [_car('REP001')])
+            user = User(email='admin@test.com', username='admin', first_name='A', last_name='D', role=Role.ADMIN)
+            user.set_password('password')
+            db.session.add(user)
+            db.session.commit()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.engines[REPLICA_BIND].dispose()
+        # db is process-wide; drop the bind's metadata so later apps without a replica can create_all()
+        db.metadatas.pop(REPLICA_BIND, None)
+        os.remove(self.replica_path)
+        reset_replica_lag()
+
+    def test_decorated_reads_use_replica(self):
+        with self.app.test_request_context():
+            self.assertEqual(_count_cars_on_replica(), 1)
+            self.assertEqual(Car.query.count(), 0)
+
+    def test_lagging_replica_falls_back_to_primary(self):
+        self.app.config['REPLICA_MAX_LAG_SECONDS'] = -1
+        with self.app.test_request_context():
+            self.assertEqual(_count_cars_on_replica(), 0)
+
+    def test_writes_inside_replica_view_go_to_primary(self):
+        @use_replica
+        def add_car():
+            db.session.add(Car(**_car('PRI001')))
+            db.session.commit()
+
+        with self.app.test_request_context():
+            add_car()
+            self.assertEqual(Car.query.count(), 1)
+            self.assertEqual(_count_cars_on_replica(), 1)
+
+    def test_report_export_reads_from_replica(self):
+        client = self.app.test_client()
+        client.post('/auth/login', data={'email': 'admin@test.com', 'password': 'password'})
+        resp = client.get('/reports/export/fleet')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'REP001', resp.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Tests for the versioned schema sync behind `flask db-sync`.
+"""
+
+import unittest
+from unittest import mock
+
+from app import create_app, db
+from config import config
+from app.utils import schema
+from app.utils.db_pool import statement_timeout_is_disabled
+from app.utils.schema import (LATEST_SCHEMA_VERSION, WORKLOAD_INDEXES, current_schema_version, sync_schema,
+                              workload_index_ddl)
+
+
+class SchemaSyncTestCase(unittest.TestCase):
+    def test_testing_config_syncs_on_startup(self):
+        app = create_app('testing')
+        with app.app_context():
+            self.assertEqual(current_schema_version(), LATEST_SCHEMA_VERSION)
+            self.assertIn('bookings', db.inspect(db.engine).get_table_names())
+            # Already current: nothing to apply
+            self.assertEqual(sync_schema(), [])
+
+    def test_startup_without_auto_sync_runs_no_ddl(self):
+        class NoSyncConfig(config['testing']):
+            SCHEMA_AUTO_SYNC = False
+
+        config['no_sync'] = NoSyncConfig
+        try:
+            app = create_app('no_sync')
+        finally:
+            del config['no_sync']
+        with app.app_context():
+            self.assertEqual(db.inspect(db.engine).get_table_names(), [])
+            self.assertEqual(current_schema_version(), 0)
+
+    def test_workload_indexes_are_created(self):
+        app = create_app('testing')
+        with app.app_context():
+            inspector = db.inspect(db.engine)
+            index_names = {
+                index['name']
+                for table in ('bookings', 'payments', 'direct_debit_installments', 'direct_debit_schedules')
+                for index in inspector.get_indexes(table)
+            }
+            for name, *_ in WORKLOAD_INDEXES:
+                self.assertIn(name, index_names)
+
+    def test_db_sync_command(self):
+        app = create_app('testing')
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['db-sync', '--check'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn(f'latest {LATEST_SCHEMA_VERSION}', result.output)
+        result = runner.invoke(args=['db-sync', '--force'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Applied schema steps: create_tables', result.output)
+
+    def test_steps_run_without_the_statement_timeout(self):
+        app = create_app('testing')
+        seen = []
+        with app.app_context(), \
+                mock.patch.object(schema, 'SCHEMA_STEPS', [(1, 'probe', lambda: seen.append(statement_timeout_is_disabled()))]):
+            sync_schema(force=True)
+        self.assertEqual(seen, [True])
+        self.assertFalse(statement_timeout_is_disabled())
+
+    def test_postgres_indexes_are_built_concurrently(self):
+        self.assertEqual(workload_index_ddl('ix_a', 't', ['a', 'b'], "s = 'X'", concurrently=True),
+                         "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_a ON t (a, b) WHERE s = 'X'")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Tests for the post-fork worker warm-up and the /api/ready probe.
+"""
+
+import unittest
+
+from app import create_app
+from app.utils.warmup import init_warmup, warm_up
+
+
+class WorkerWarmupTestCase(unittest.TestCase):
+    def test_ready_without_gunicorn_hook(self):
+        app = create_app('testing')
+        resp = app.test_client().get('/api/ready')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['status'], 'ready')
+
+    def test_not_ready_until_warmed_up(self):
+        app = create_app('testing')
+        app.config['WARMUP_ON_FORK'] = True
+        init_warmup(app)
+        client = app.test_client()
+        self.assertEqual(client.get('/api/ready').status_code, 503)
+
+        state = warm_up(app)
+        self.assertTrue(all(step['ok'] for step in state['steps'].values()))
+        self.assertGreater(state['steps']['templates']['result'], 0)
+        resp = client.get('/api/ready')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.get_json()['steps']['templates'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Tests for the webhook inbox: stored PayAdvantage events and the processing worker.
+"""
+
+import hashlib
+import hmac
+import json
+import unittest
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+from sqlalchemy import event
+
+from app import create_app, db
+from app.models import (Booking, BookingStatus, Car, CarCategory, CarStatus, DirectDebitInstallment,
+                        DirectDebitSchedule, Payment, Role, User, WebhookEvent)
+from app.services import webhook_inbox
+from app.services.webhook_inbox import _claim, process_events, replay_events
+
+SECRET = 'test_secret'
+
+
+def _event(payment_id, schedule_id='SCH1', status='completed', **extra):
+    return {
+        'Code': payment_id, 'DateCreated': '2026-01-01T00:00:00Z', 'Event': 'payment', 'Status': status,
+        'ResourceUrl': f'https://api.payadvantage.com.au/v3/payments/{payment_id}',
+        'scheduleId': schedule_id, 'paymentId': payment_id, 'status': status,
+        'dueDate': date.today().isoformat(), 'dueAmount': 100.0, **extra,
+    }
+
+
+class WebhookInboxTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['PAY_ADVANTAGE_WEBHOOK_SECRET'] = SECRET
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        car = Car(
+            make='Kia', model='Rio', year=2023, category=CarCategory.SEDAN,
+            license_plate='HOOK1', vin='VINWEBHOOK1', seats=5, transmission='Automatic',
+            fuel_type='Gasoline', daily_rate=60, weekly_rate=350, status=CarStatus.AVAILABLE,
+        )
+        customer = User(email='hook@test.com', username='hook', first_name='W', last_name='H', role=Role.CUSTOMER)
+        customer.set_password('password')
+        db.session.add_all([car, customer])
+        db.session.flush()
+        self.booking = Booking(
+            booking_number='BK-HOOK', customer_id=customer.id, car_id=car.id,
+            pickup_date=datetime.utcnow(), return_date=datetime.utcnow() + timedelta(days=7),
+            pickup_location='HQ', return_location='HQ', daily_rate=60, total_days=7,
+            subtotal=420, total_amount=420, license_document_url='/uploads/license.pdf',
+            status=BookingStatus.PENDING,
+        )
+        db.session.add(self.booking)
+        db.session.flush()
+        db.session.add_all([
+            DirectDebitSchedule(booking_id=self.booking.id, schedule_id='SCH1'),
+            DirectDebitSchedule(booking_id=self.booking.id, schedule_id='SCH2'),
+        ])
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def _deliver(self, events):
+        body = json.dumps(events).encode()
+        signature = 'sha256=' + hmac.new(SECRET.encode(), body, hashlib.sha256).hexdigest()
+        return self.client.post('/webhooks/payadvantage', data=body, headers={
+            'Content-Type': 'application/json', 'X-PayAdvantage-Signature': signature})
+
+    def _make_due(self):
+        WebhookEvent.query.filter_by(status=WebhookEvent.PENDING).update(
+            {'next_attempt_at': datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+
+    def test_delivery_is_stored_and_acknowledged_without_processing(self):
+        response = self._deliver([_event('PAY1')])
+        self.assertEqual(response.status_code, 202)
+        event = WebhookEvent.query.one()
+        self.assertEqual(event.status, WebhookEvent.PENDING)
+        self.assertEqual(event.ordering_key, 'schedule:SCH1')
+        self.assertEqual(DirectDebitInstallment.query.count(), 0)
+
+        self.assertEqual(process_events()['processed'], 1)
+        self.assertEqual(db.session.get(WebhookEvent, event.id).status, WebhookEvent.PROCESSED)
+        payment = Payment.query.filter_by(gateway_transaction_id='PAY1').one()
+        self.assertEqual(payment.amount, 100.0)
+        self.assertEqual(db.session.get(Booking, self.booking.id).status, BookingStatus.CONFIRMED)
+
+    def test_redelivered_event_is_stored_once(self):
+        self._deliver([_event('PAY1')])
+        self.assertEqual(self._deliver([_event('PAY1'), _event('PAY2')]).status_code, 202)
+        self.assertEqual(WebhookEvent.query.count(), 2)
+
+    def test_invalid_signature_stores_nothing(self):
+        body = json.dumps([_event('PAY1')]).encode()
+        response = self.client.post('/webhooks/payadvantage', data=body,
+                                    headers={'X-PayAdvantage-Signature': 'sha256=bad'})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(WebhookEvent.query.count(), 0)
+
+    def test_events_of_a_schedule_wait_behind_a_retrying_event(self):
+        self._deliver([_event('PAY1'), _event('PAY2'), _event('PAY3', schedule_id='SCH2')])
+        calls = []
+        real = webhook_inbox.handle_payadvantage_event
+
+        def flaky(event):
+            calls.append(event['paymentId'])
+            if event['paymentId'] == 'PAY1' and calls.count('PAY1') == 1:
+                raise Exception('database busy')
+            real(event)
+
+        with mock.patch.object(webhook_inbox, 'handle_payadvantage_events', side_effect=Exception('batch failed')), \
+                mock.patch.object(webhook_inbox, 'handle_payadvantage_event', side_effect=flaky):
+            summary = process_events()
+            self.assertEqual(summary, {'processed': 1, 'retrying': 1, 'failed': 0, 'waiting': 1})
+            # PAY2 is not processed before PAY1 of the same schedule
+            self.assertEqual(calls, ['PAY1', 'PAY3'])
+            self.assertEqual(_claim(10), [])
+
+            self._make_due()
+            self.assertEqual(process_events()['processed'], 2)
+            self.assertEqual(calls, ['PAY1', 'PAY3', 'PAY1', 'PAY2'])
+        self.assertEqual(WebhookEvent.query.filter_by(status=WebhookEvent.PROCESSED).count(), 3)
+
+    def test_batch_of_events_is_applied_in_a_few_queries(self):
+        events = []
+        for i in range(200):
+            schedule_id = 'SCH1' if i % 2 else 'SCH2'
+            events.append(_event(f'PAY{i}', schedule_id=schedule_id, status='completed' if i % 4 else 'pending',
+                                 dueDate=(date.today() + timedelta(days=i)).isoformat()))
+        # A later event for the same payment wins, as it would one at a time
+        events.append(_event('PAY0', schedule_id='SCH2', status='completed', dueDate=date.today().isoformat()))
+        self.app.config['WEBHOOK_EVENTS_BATCH_SIZE'] = 500
+        self._deliver(events)
+
+        statements = []
+        listen = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listen)
+        try:
+            summary = process_events()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listen)
+        self.assertEqual(summary['processed'], 201)
+        self.assertLess(len(statements), 20)
+
+        self.assertEqual(DirectDebitInstallment.query.count(), 200)
+        self.assertEqual(DirectDebitInstallment.query.filter_by(external_payment_id='PAY0').one().status, 'completed')
+        self.assertEqual(Payment.query.count(), 151)
+        self.assertEqual(db.session.get(Booking, self.booking.id).status, BookingStatus.CONFIRMED)
+
+        # Delivered again: installments are updated in place and no payment is duplicated
+        WebhookEvent.query.delete()
+        db.session.commit()
+        self._deliver(events)
+        process_events()
+        self.assertEqual(DirectDebitInstallment.query.count(), 200)
+        self.assertEqual(Payment.query.count(), 151)
+
+    def test_batch_matches_a_scheduled_installment_by_due_date(self):
+        db.session.add(DirectDebitInstallment(schedule_id='SCH1', booking_id=self.booking.id,
+                                              due_date=date.today(), due_amount=80.0))
+        db.session.commit()
+        self._deliver([_event('PAY1', dueAmount=None), _event('PAY9', schedule_id='SCH2')])
+        process_events()
+        installment = DirectDebitInstallment.query.filter_by(schedule_id='SCH1').one()
+        self.assertEqual(installment.external_payment_id, 'PAY1')
+        self.assertEqual(installment.due_amount, 80.0)
+        self.assertEqual(Payment.query.filter_by(gateway_transaction_id='PAY1').one().amount, 80.0)
+
+    def test_failed_event_is_replayed(self):
+        self.app.config['WEBHOOK_EVENTS_MAX_ATTEMPTS'] = 1
+        self._deliver([_event('PAY1')])
+        with mock.patch.object(webhook_inbox, 'handle_payadvantage_events', side_effect=Exception('bad payload')), \
+                mock.patch.object(webhook_inbox, 'handle_payadvantage_event', side_effect=Exception('bad payload')):
+            self.assertEqual(process_events()['failed'], 1)
+        event = WebhookEvent.query.one()
+        self.assertEqual(event.status, WebhookEvent.FAILED)
+        self.assertEqual(event.last_error, 'bad payload')
+
+        self.assertEqual(replay_events(), 1)
+        self.assertEqual(process_events()['processed'], 1)
+        self.assertEqual(Payment.query.filter_by(gateway_transaction_id='PAY1').count(), 1)
+
+    def test_claimed_event_is_not_claimed_twice_until_its_lease_expires(self):
+        self._deliver([_event('PAY1')])
+        event = WebhookEvent.query.one()
+        self.assertEqual(_claim(10), [event.id])
+        self.assertEqual(_claim(10), [])
+
+        event.locked_at = datetime.utcnow() - timedelta(seconds=self.app.config['WEBHOOK_EVENTS_LEASE_SECONDS'] + 1)
+        db.session.commit()
+        self.assertEqual(_claim(10), [event.id])
+
+    def test_events_are_claimed_one_by_one_without_update_returning(self):
+        self._deliver([_event('PAY1'), _event('PAY2', schedule_id='SCH2')])
+        ids = [event.id for event in WebhookEvent.query.order_by(WebhookEvent.id)]
+        # As on MySQL, which has no UPDATE ... RETURNING
+        with mock.patch.object(db.engine.dialect, 'update_returning', False):
+            self.assertEqual(_claim(10), ids)
+            self.assertEqual(_claim(10), [])
+        self.assertEqual(WebhookEvent.query.filter_by(status=WebhookEvent.PROCESSING).count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Tests for the customer -> Xero contact mapping.
+"""
+
+import unittest
+from unittest import mock
+
+from app import create_app, db
+from app.models import Role, User, XeroContact
+from app.services.xero_contacts import contact_hash, contact_payload, ensure_contacts, sync_contacts
+
+
+def _xero_copy(payload, contact_id, **extra):
+    """A contact as Xero returns it: every phone and address type, blanks included."""
+    return {
+        'ContactID': contact_id,
+        'ContactStatus': 'ACTIVE',
+        'Name': payload['Name'],
+        'EmailAddress': payload['EmailAddress'],
+        'Phones': [{'PhoneType': 'DEFAULT', 'PhoneNumber': ''}] + payload['Phones'],
+        'Addresses': [{'AddressType': 'STREET', 'City': ''}] + payload['Addresses'],
+        **extra,
+    }
+
+
+class XeroContactsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.users = []
+        for n in range(3):
+            user = User(email=f'customer{n}@test.com', username=f'customer{n}', first_name='Cust', last_name=f'No{n}',
+                        phone=f'04000000{n}', role=Role.CUSTOMER)
+            user.set_password('password')
+            self.users.append(user)
+        db.session.add_all(self.users)
+        db.session.commit()
+        self.client = mock.Mock(CONTACTS_PAGE_SIZE=2)
+        self.client.get_contacts.return_value = []
+        self.client.save_contacts.side_effect = lambda contacts, idempotency_key=None: [
+            {'ContactID': contact.get('ContactID') or f"new-{contact['ContactNumber']}"} for contact in contacts]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_new_contacts_are_created_once(self):
+        contact_ids, errors = ensure_contacts(self.client, self.users[:2])
+        self.assertEqual(errors, {})
+        self.assertEqual(contact_ids[self.users[0].id], f'new-AURORA-{self.users[0].id}')
+        self.assertEqual(len(self.client.save_contacts.call_args.args[0]), 2)
+
+        self.client.reset_mock()
+        contact_ids, _ = ensure_contacts(self.client, self.users[:2])
+        self.assertEqual(len(contact_ids), 2)
+        self.client.save_contacts.assert_not_called()
+        self.client.get_contacts.assert_not_called()
+
+    def test_changed_contact_is_updated_by_id(self):
+        ensure_contacts(self.client, self.users)
+        self.users[1].phone = '0499999999'
+        db.session.commit()
+        self.client.reset_mock()
+
+        ensure_contacts(self.client, self.users)
+        sent = self.client.save_contacts.call_args.args[0]
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0]['ContactID'], f'new-AURORA-{self.users[1].id}')
+        self.assertEqual(sent[0]['Phones'][0]['PhoneNumber'], '0499999999')
+
+    def test_existing_contact_with_same_name_is_adopted(self):
+        payload = contact_payload(self.users[0])
+        self.client.get_contacts.return_value = [_xero_copy(payload, 'existing-0')]
+        contact_ids, _ = ensure_contacts(self.client, [self.users[0]])
+        self.assertEqual(contact_ids[self.users[0].id], 'existing-0')
+        self.client.save_contacts.assert_not_called()
+
+    def test_shared_name_in_one_batch_creates_distinct_contacts(self):
+        for user in self.users[:2]:
+            user.first_name, user.last_name = 'John', 'Smith'
+        db.session.commit()
+        payload = contact_payload(self.users[0])
+        self.client.get_contacts.return_value = [_xero_copy(payload, 'existing-0')]
+
+        contact_ids, errors = ensure_contacts(self.client, self.users[:2])
+        self.assertEqual(errors, {})
+        self.assertEqual(contact_ids, {user.id: f'new-AURORA-{user.id}' for user in self.users[:2]})
+        sent = self.client.save_contacts.call_args.args[0]
+        self.assertEqual([contact['Name'] for contact in sent],
+                         [f'John Smith (AURORA-{user.id})' for user in self.users[:2]])
+
+        # The distinct names are kept, so nothing is sent again
+        self.client.reset_mock()
+        ensure_contacts(self.client, self.users[:2])
+        self.client.save_contacts.assert_not_called()
+
+    def test_contact_mapped_to_another_customer_is_not_adopted(self):
+        payload = contact_payload(self.users[0])
+        self.client.get_contacts.return_value = [_xero_copy(payload, 'existing-0')]
+        ensure_contacts(self.client, [self.users[0]])
+
+        self.users[1].first_name, self.users[1].last_name = self.users[0].first_name, self.users[0].last_name
+        db.session.commit()
+        contact_ids, errors = ensure_contacts(self.client, [self.users[1]])
+        self.assertEqual(errors, {})
+        self.assertEqual(contact_ids[self.users[1].id], f'new-AURORA-{self.users[1].id}')
+        self.assertEqual(XeroContact.query.filter_by(contact_id='existing-0').one().user_id, self.users[0].id)
+
+    def test_rejected_contact_is_reported(self):
+        self.client.save_contacts.side_effect = None
+        self.client.save_contacts.return_value = [
+            {'StatusAttributeString': 'ERROR', 'ValidationErrors': [{'Message': 'Email address must be valid.'}]}]
+        contact_ids, errors = ensure_contacts(self.client, [self.users[0]])
+        self.assertEqual(contact_ids, {})
+        self.assertEqual(errors[self.users[0].id], ['Email address must be valid.'])
+        self.assertEqual(XeroContact.query.count(), 0)
+
+    def test_bulk_sync_pages_through_contacts(self):
+        payloads = [contact_payload(user) for user in self.users]
+        pages = {
+            1: [_xero_copy(payloads[0], 'c-0', ContactNumber=f'AURORA-{self.users[0].id}'),
+                _xero_copy(payloads[1], 'c-1')],
+            2: [{'ContactID': 'c-x', 'Name': 'Someone Else', 'EmailAddress': 'else@test.com'}],
+        }
+        self.client.get_contacts.side_effect = lambda page=1, names=None: pages[page]
+        summary = sync_contacts(self.client)
+        self.assertEqual(summary, {'pages': 2, 'mapped': 2, 'unmatched': 1})
+
+        # Synced contacts match their fingerprint, so invoicing sends nothing
+        self.client.get_contacts.side_effect = None
+        contact_ids, _ = ensure_contacts(self.client, self.users[:2])
+        self.assertEqual(contact_ids, {self.users[0].id: 'c-0', self.users[1].id: 'c-1'})
+        self.client.save_contacts.assert_not_called()
+
+    def test_hash_ignores_fields_we_do_not_sync(self):
+        payload = contact_payload(self.users[0])
+        self.assertEqual(contact_hash(payload), contact_hash(_xero_copy(payload, 'c-0', IsCustomer=True)))
+
+
+if __name__ == '__main__':
+    unittest.main()
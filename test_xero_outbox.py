@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Tests for the Xero outbox: queued send-invoice requests and the drain worker.
+"""
+
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from app import create_app, db
+from app.models import Booking, Car, CarCategory, CarStatus, Role, User, XeroOutbox, XeroToken
+from app.services.xero_outbox import _claim, drain_outbox, enqueue_invoice
+from app.utils.xero import XeroClient, XeroRateLimitExceeded
+
+INVOICE = {'InvoiceID': 'inv-1', 'InvoiceNumber': 'INV-0001'}
+
+
+class XeroOutboxTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        car = Car(
+            make='Kia', model='Rio', year=2023, category=CarCategory.SEDAN,
+            license_plate='OUTBOX1', vin='VINOUTBOX1', seats=5, transmission='Automatic',
+            fuel_type='Gasoline', daily_rate=60, weekly_rate=350, status=CarStatus.AVAILABLE,
+        )
+        self.admin = User(email='admin@test.com', username='admin', first_name='A', last_name='D', role=Role.ADMIN)
+        self.admin.set_password('password')
+        customer = User(email='outbox@test.com', username='outbox', first_name='O', last_name='C',
+                        role=Role.CUSTOMER)
+        customer.set_password('password')
+        db.session.add_all([car, self.admin, customer])
+        db.session.flush()
+        self.booking = Booking(
+            booking_number='BK-OUTBOX', customer_id=customer.id, car_id=car.id,
+            pickup_date=datetime.utcnow(), return_date=datetime.utcnow() + timedelta(days=7),
+            pickup_location='HQ', return_location='HQ', daily_rate=60, total_days=7,
+            subtotal=420, total_amount=420, license_document_url='/uploads/license.pdf',
+        )
+        db.session.add(self.booking)
+        db.session.add(XeroToken(access_token='a', refresh_token='r', tenant_id='tenant-1',
+                                 expires_at=datetime.utcnow() + timedelta(hours=1)))
+        db.session.commit()
+        self.due = datetime.utcnow() + timedelta(days=7)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def _enqueue(self, amount=420.0):
+        return enqueue_invoice(self.booking, {'booking_number': 'BK-OUTBOX'}, amount, self.due)
+
+    def _drain(self, create_error=None, email_error=None):
+        create = mock.patch.object(XeroClient, 'create_invoice', return_value=INVOICE, side_effect=create_error)
+        email = mock.patch.object(XeroClient, 'email_invoice', side_effect=email_error)
+        contacts = mock.patch.multiple(XeroClient, get_contacts=mock.DEFAULT,
+                                       save_contacts=mock.DEFAULT)
+        with create as create_invoice, email as email_invoice, contacts as contact_calls:
+            contact_calls['get_contacts'].return_value = []
+            contact_calls['save_contacts'].return_value = [{'ContactID': 'contact-1'}]
+            summary = drain_outbox()
+        return summary, create_invoice, email_invoice
+
+    def _make_due(self, entry):
+        entry.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+
+    def test_send_invoice_endpoint_queues_without_calling_xero(self):
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(self.admin.id)
+            session['_fresh'] = True
+        with mock.patch.object(XeroClient, 'create_invoice') as create_invoice:
+            response = client.post(f'/admin/api/booking/{self.booking.id}/send-invoice', json={})
+        create_invoice.assert_not_called()
+        self.assertEqual(response.status_code, 202)
+        body = response.get_json()
+        self.assertTrue(body['queued'])
+
+        status = client.get(body['status_url']).get_json()
+        self.assertEqual(status['status'], XeroOutbox.PENDING)
+
+        self._drain()
+        status = client.get(body['status_url']).get_json()
+        self.assertEqual(status['status'], XeroOutbox.SENT)
+        self.assertEqual(status['invoice_number'], 'INV-0001')
+
+    def test_repeated_request_returns_the_queued_entry(self):
+        first = self._enqueue()
+        self.assertEqual(self._enqueue().id, first.id)
+        self.assertNotEqual(self._enqueue(amount=100.0).id, first.id)
+
+    def test_drain_creates_and_emails_the_invoice(self):
+        entry = self._enqueue()
+        summary, create_invoice, email_invoice = self._drain()
+        self.assertEqual(summary['sent'], 1)
+        self.assertEqual(create_invoice.call_args.kwargs['idempotency_key'], f'aurora-outbox-{entry.id}')
+        self.assertEqual(create_invoice.call_args.kwargs['contact_id'], 'contact-1')
+        email_invoice.assert_called_once_with('inv-1')
+        entry = db.session.get(XeroOutbox, entry.id)
+        self.assertEqual(entry.status, XeroOutbox.SENT)
+        self.assertIn('INV-0001', db.session.get(Booking, self.booking.id).admin_notes)
+
+        # Nothing left to send
+        summary, create_invoice, _ = self._drain()
+        create_invoice.assert_not_called()
+
+    def test_failed_email_is_retried_without_creating_again(self):
+        entry = self._enqueue()
+        summary, _, _ = self._drain(email_error=Exception('Xero unavailable'))
+        self.assertEqual(summary['retrying'], 1)
+        entry = db.session.get(XeroOutbox, entry.id)
+        self.assertEqual(entry.status, XeroOutbox.PENDING)
+        self.assertEqual(entry.attempts, 1)
+        self.assertGreater(entry.next_attempt_at, datetime.utcnow())
+
+        # Not due yet
+        summary, _, _ = self._drain()
+        self.assertEqual(summary['sent'], 0)
+
+        self._make_due(entry)
+        summary, create_invoice, email_invoice = self._drain()
+        self.assertEqual(summary['sent'], 1)
+        create_invoice.assert_not_called()
+        email_invoice.assert_called_once_with('inv-1')
+
+    def test_entry_fails_after_max_attempts(self):
+        self.app.config['XERO_OUTBOX_MAX_ATTEMPTS'] = 2
+        entry = self._enqueue()
+        self._drain(create_error=Exception('Xero unavailable'))
+        self._make_due(entry)
+        summary, _, _ = self._drain(create_error=Exception('Xero unavailable'))
+        self.assertEqual(summary['failed'], 1)
+        entry = db.session.get(XeroOutbox, entry.id)
+        self.assertEqual(entry.status, XeroOutbox.FAILED)
+        self.assertEqual(entry.last_error, 'Xero unavailable')
+
+    def test_expired_authorization_fails_at_once(self):
+        entry = self._enqueue()
+        summary, _, _ = self._drain(create_error=Exception('Token refresh failed: invalid_grant'))
+        self.assertEqual(summary['failed'], 1)
+        self.assertEqual(db.session.get(XeroOutbox, entry.id).attempts, 1)
+
+    def test_rate_limited_entry_is_rescheduled_without_an_attempt(self):
+        entry = self._enqueue()
+        summary, _, _ = self._drain(create_error=XeroRateLimitExceeded('Xero minute limit reached', 30))
+        self.assertEqual(summary['deferred'], 1)
+        entry = db.session.get(XeroOutbox, entry.id)
+        self.assertEqual(entry.status, XeroOutbox.PENDING)
+        self.assertEqual(entry.attempts, 0)
+        self.assertGreater(entry.next_attempt_at, datetime.utcnow() + timedelta(seconds=25))
+
+    def test_claimed_entry_is_not_claimed_twice_until_its_lease_expires(self):
+        entry = self._enqueue()
+        self.assertEqual(_claim(10), [entry.id])
+        self.assertEqual(_claim(10), [])
+
+        entry = db.session.get(XeroOutbox, entry.id)
+        entry.locked_at = datetime.utcnow() - timedelta(seconds=self.app.config['XERO_OUTBOX_LEASE_SECONDS'] + 1)
+        db.session.commit()
+        self.assertEqual(_claim(10), [entry.id])
+
+    def test_status_endpoint_requires_admin(self):
+        entry = self._enqueue()
+        client = self.app.test_client()
+        self.assertNotEqual(client.get(f'/xero/outbox/{entry.id}').status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
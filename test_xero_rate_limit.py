@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Tests for the shared per-tenant Xero rate limiter.
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import requests
+
+from app import create_app
+from app.utils import xero_rate_limit
+from app.utils.xero import XeroClient, get_xero_session, xero_request
+from app.utils.xero_rate_limit import XeroRateLimitExceeded, xero_rate_limiter
+from config import config
+
+
+class FakeClock:
+    """Stands in for the ``time`` module so waits advance time instantly."""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def _response(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return response
+
+
+class XeroRateLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config.update(XERO_RATE_LIMIT_BURST=2, XERO_RATE_LIMIT_PER_MINUTE=62, XERO_RATE_LIMIT_PER_DAY=100,
+                               XERO_RATE_LIMIT_DAILY_RESERVE=10, XERO_RATE_LIMIT_CONCURRENT=5)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.clock = FakeClock()
+        patcher = mock.patch.object(xero_rate_limit, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def _call(self, tenant='tenant-1', urgent=False, response=None):
+        lease = xero_rate_limiter.acquire(tenant, urgent)
+        xero_rate_limiter.release(tenant, lease, response)
+
+    def test_burst_then_refill_rate(self):
+        self._call()
+        self._call()
+        self.assertEqual(self.clock.slept, [])
+        self._call()
+        # (62 - 2 burst) per minute = one token a second
+        self.assertAlmostEqual(sum(self.clock.slept), 1.0)
+
+    def test_tenants_have_separate_buckets(self):
+        for _ in range(2):
+            self._call('tenant-1')
+            self._call('tenant-2')
+        self.assertEqual(self.clock.slept, [])
+
+    def test_background_calls_leave_daily_reserve(self):
+        self.app.config['XERO_RATE_LIMIT_BURST'] = 62
+        self._call(response=_response(200, {'X-DayLimit-Remaining': '10'}))
+        with self.assertRaises(XeroRateLimitExceeded) as raised:
+            self._call()
+        self.assertGreater(raised.exception.retry_after, 0)
+        # Interactive calls may still use the reserve
+        self._call(urgent=True)
+
+    def test_minute_header_empties_bucket(self):
+        self._call(response=_response(200, {'X-MinLimit-Remaining': '0'}))
+        self._call()
+        self.assertAlmostEqual(sum(self.clock.slept), 1.0)
+
+    def test_throttled_response_blocks_until_retry_after(self):
+        self._call(response=_response(429, {'Retry-After': '20', 'X-Rate-Limit-Problem': 'minute'}))
+        with self.assertRaises(XeroRateLimitExceeded):
+            self._call(urgent=True)
+        self._call()
+        self.assertAlmostEqual(sum(self.clock.slept), 20.0)
+
+    def test_concurrent_calls_are_capped(self):
+        self.app.config.update(XERO_RATE_LIMIT_CONCURRENT=1, XERO_RATE_LIMIT_MAX_WAIT=1)
+        lease = xero_rate_limiter.acquire('tenant-1', True)
+        with self.assertRaises(XeroRateLimitExceeded):
+            xero_rate_limiter.acquire('tenant-1', True)
+        xero_rate_limiter.release('tenant-1', lease)
+        xero_rate_limiter.acquire('tenant-1', True)
+
+    def test_xero_request_takes_and_returns_a_permit(self):
+        session = get_xero_session()
+        with mock.patch.object(session, 'request', return_value=_response(200)) as send:
+            xero_request('GET', f'{XeroClient.XERO_API_URL}/Invoices', headers={'Xero-tenant-id': 'tenant-1'})
+            xero_request('GET', f'{XeroClient.XERO_API_URL}/Invoices', headers={'Xero-tenant-id': 'tenant-1'})
+            xero_request('GET', f'{XeroClient.XERO_API_URL}/Invoices', headers={'Xero-tenant-id': 'tenant-1'})
+        self.assertEqual(send.call_count, 3)
+        self.assertAlmostEqual(sum(self.clock.slept), 1.0)
+
+
+class SharedStateTestCase(unittest.TestCase):
+    def test_limit_state_is_shared_between_workers(self):
+        fd, path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        class SharedCacheConfig(config['testing']):
+            CACHE_TYPE = 'sqlite'
+            CACHE_SQLITE_PATH = path
+            XERO_RATE_LIMIT_BURST = 2
+
+        config['rate_limit_test'] = SharedCacheConfig
+        try:
+            workers = [create_app('rate_limit_test'), create_app('rate_limit_test')]
+        finally:
+            del config['rate_limit_test']
+
+        clock = FakeClock()
+        with mock.patch.object(xero_rate_limit, 'time', clock):
+            for app in workers:
+                with app.app_context():
+                    xero_rate_limiter.release('tenant-1', xero_rate_limiter.acquire('tenant-1'))
+            with workers[0].app_context():
+                xero_rate_limiter.release('tenant-1', xero_rate_limiter.acquire('tenant-1'))
+        self.assertEqual(len(clock.slept), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Tests for batched, idempotent Xero invoice creation in the daily scheduler.
+"""
+
+import unittest
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+from app import create_app, db
+from app.models import (Booking, Car, CarCategory, CarStatus, DirectDebitSchedule, Payment, PaymentStatus, Role,
+                        SyncCheckpoint, User, XeroContact)
+from app.services.pay_advantage import PayAdvantageService
+from app.services.xero_scheduler import (INVOICE_CLAIM_MAX_ATTEMPTS, INVOICE_CLAIM_RETRY_DAYS, INVOICE_SYNC_CHECKPOINT,
+                                         XeroInvoiceScheduler)
+from app.utils.xero import XeroClient, XeroRateLimitExceeded
+
+
+def _saved_contacts(contacts, idempotency_key=None):
+    return [{'ContactID': contact.get('ContactID') or f"contact-{contact['ContactNumber']}"} for contact in contacts]
+
+
+def _results(invoices, idempotency_key=None, fail_reference=None):
+    results = []
+    for invoice in invoices:
+        if invoice['Reference'] == fail_reference:
+            results.append({'StatusAttributeString': 'ERROR', 'HasErrors': True,
+                            'ValidationErrors': [{'Message': 'Contact name is invalid'}]})
+        else:
+            results.append({'StatusAttributeString': 'OK', 'InvoiceID': f"id-{invoice['Reference']}",
+                            'InvoiceNumber': f"INV-{invoice['Reference']}"})
+    return results
+
+
+class XeroSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        car = Car(
+            make='Kia', model='Rio', year=2023, category=CarCategory.SEDAN,
+            license_plate='XERO01', vin='VINXERO01', seats=5, transmission='Automatic',
+            fuel_type='Gasoline', daily_rate=60, weekly_rate=350, status=CarStatus.AVAILABLE,
+        )
+        customer = User(email='xero@test.com', username='xero', first_name='X', last_name='C', role=Role.CUSTOMER)
+        customer.set_password('password')
+        db.session.add_all([car, customer])
+        db.session.flush()
+        self.bookings = [
+            Booking(
+                booking_number=f'BK-XERO-{n}', customer_id=customer.id, car_id=car.id,
+                pickup_date=datetime.utcnow(), return_date=datetime.utcnow() + timedelta(days=7),
+                pickup_location='HQ', return_location='HQ', daily_rate=60, total_days=7,
+                subtotal=420, total_amount=420, license_document_url='/uploads/license.pdf',
+            )
+            for n in range(5)
+        ]
+        db.session.add_all(self.bookings)
+        db.session.commit()
+        self.due = date.today() + timedelta(days=1)
+        self.scheduler = XeroInvoiceScheduler()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def _items(self):
+        return [{'booking': booking, 'amount': 60.0, 'due_date': self.due} for booking in self.bookings]
+
+    def _run(self, fail_reference=None, items=None, create_error=None, email_error=None, in_xero=None):
+        create = mock.patch.object(XeroClient, 'create_invoices', autospec=True,
+                                   side_effect=create_error or (lambda client, invoices, idempotency_key=None:
+                                                                _results(invoices, idempotency_key, fail_reference)))
+        email = mock.patch.object(XeroClient, 'email_invoice', side_effect=email_error)
+        lookup = mock.patch.object(XeroClient, 'get_invoices_by_number', return_value=dict(in_xero or {}))
+        contacts = mock.patch.multiple(XeroClient, get_contacts=mock.DEFAULT, save_contacts=mock.DEFAULT)
+        with create as create_invoices, email as email_invoice, lookup, contacts as contact_calls:
+            contact_calls['get_contacts'].return_value = []
+            contact_calls['save_contacts'].side_effect = _saved_contacts
+            summary = self.scheduler.create_scheduled_invoices(self._items() if items is None else items)
+        return summary, create_invoices, email_invoice
+
+    @staticmethod
+    def _invoiced():
+        return Payment.query.filter(Payment.gateway_transaction_id.isnot(None)).count()
+
+    def test_invoices_are_created_in_one_batch_with_pending_payments(self):
+        summary, create_invoices, email_invoice = self._run()
+        self.assertEqual(create_invoices.call_count, 1)
+        self.assertEqual(summary['created'], 5)
+        self.assertEqual(email_invoice.call_count, 5)
+        payments = Payment.query.order_by(Payment.booking_id).all()
+        self.assertEqual(len(payments), 5)
+        self.assertEqual(payments[0].transaction_id, f"XINV-{self.bookings[0].id}-{self.due:%Y%m%d}")
+        self.assertEqual(payments[0].status, PaymentStatus.PENDING)
+        self.assertEqual(payments[0].gateway_transaction_id, 'id-BK-XERO-0')
+        self.assertIn('INV-BK-XERO-0', db.session.get(Booking, self.bookings[0].id).admin_notes)
+        # Invoices reference the customer's contact instead of embedding it
+        contact_id = f"contact-AURORA-{self.bookings[0].customer_id}"
+        self.assertTrue(all(invoice['Contact'] == {'ContactID': contact_id}
+                            for invoice in create_invoices.call_args.args[1]))
+
+    def test_rejected_invoices_are_reported_per_item(self):
+        summary, _, _ = self._run(fail_reference='BK-XERO-2')
+        self.assertEqual(summary['created'], 4)
+        self.assertEqual(len(summary['failed']), 1)
+        failure = summary['failed'][0]
+        self.assertEqual(failure['booking_number'], 'BK-XERO-2')
+        self.assertEqual(failure['errors'], ['Contact name is invalid'])
+        self.assertEqual(self._invoiced(), 4)
+        # The rejected item keeps its pending claim for the next run
+        self.assertEqual(Payment.query.count(), 5)
+
+    def test_rerun_skips_invoiced_items_and_retries_failures(self):
+        self._run(fail_reference='BK-XERO-2')
+        summary, create_invoices, _ = self._run()
+        self.assertEqual(summary['skipped'], 4)
+        self.assertEqual(summary['created'], 1)
+        sent = create_invoices.call_args.args[1]
+        self.assertEqual([invoice['Reference'] for invoice in sent], ['BK-XERO-2'])
+        self.assertEqual(Payment.query.count(), 5)
+        self.assertEqual(self._invoiced(), 5)
+
+    def test_invoices_created_by_a_lost_request_are_adopted(self):
+        summary, create_invoices, _ = self._run(create_error=TimeoutError('read timed out'))
+        self.assertEqual(len(summary['failed']), 5)
+        sent = create_invoices.call_args.args[1]
+        keys = [invoice['InvoiceNumber'] for invoice in sent]
+        self.assertEqual(keys[0], f"XINV-{self.bookings[0].id}-{self.due:%Y%m%d}")
+
+        # Xero did create them; the next run finds them by number instead of creating duplicates
+        in_xero = {key: {'InvoiceID': f'id-{key}', 'InvoiceNumber': key, 'Status': 'AUTHORISED'} for key in keys}
+        summary, create_invoices, _ = self._run(items=[], in_xero=in_xero)
+        create_invoices.assert_not_called()
+        self.assertEqual(summary['created'], 5)
+        self.assertEqual(self._invoiced(), 5)
+
+    def test_rate_limited_items_are_sent_by_a_later_run(self):
+        summary, _, _ = self._run(create_error=XeroRateLimitExceeded('Xero day limit reached', 3600))
+        self.assertEqual(summary['deferred'], 5)
+        self.assertEqual(summary['failed'], [])
+        self.assertEqual(Payment.query.count(), 5)
+        self.assertEqual(self._invoiced(), 0)
+
+        # The next run has nothing new due, but still sends the deferred claims
+        summary, create_invoices, _ = self._run(items=[])
+        self.assertEqual(summary['created'], 5)
+        self.assertEqual(len(create_invoices.call_args.args[1]), 5)
+        self.assertEqual(self._invoiced(), 5)
+
+    def test_unsent_invoices_are_emailed_by_a_later_run(self):
+        summary, _, _ = self._run(email_error=XeroRateLimitExceeded('Xero day limit reached', 3600))
+        self.assertEqual(summary['created'], 5)
+        self.assertEqual(len(summary['unsent']), 5)
+
+        summary, create_invoices, email_invoice = self._run(items=[])
+        create_invoices.assert_not_called()
+        self.assertEqual(email_invoice.call_count, 5)
+        self.assertEqual(summary['unsent'], [])
+        self.assertTrue(all(payment.gateway_response['emailed'] for payment in Payment.query.all()))
+
+    def test_batches_respect_configured_size_with_stable_keys(self):
+        self.app.config['XERO_INVOICE_BATCH_SIZE'] = 2
+        _, create_invoices, _ = self._run()
+        self.assertEqual([len(call.args[1]) for call in create_invoices.call_args_list], [2, 2, 1])
+        keys = [call.kwargs['idempotency_key'] for call in create_invoices.call_args_list]
+        self.assertEqual(len(set(keys)), 3)
+
+        db.session.execute(db.delete(Payment))
+        db.session.commit()
+        _, create_invoices, _ = self._run()
+        self.assertEqual([call.kwargs['idempotency_key'] for call in create_invoices.call_args_list], keys)
+
+    def test_claim_rejected_on_every_run_is_given_up(self):
+        for run in range(INVOICE_CLAIM_MAX_ATTEMPTS):
+            summary, _, _ = self._run(fail_reference='BK-XERO-2', items=[] if run else None)
+            self.assertEqual(summary['abandoned'], [])
+        payment = Payment.query.filter(Payment.gateway_transaction_id.is_(None)).one()
+        self.assertEqual(payment.gateway_response['attempts'], INVOICE_CLAIM_MAX_ATTEMPTS)
+        self.assertEqual(payment.gateway_response['last_error'], 'Contact name is invalid')
+
+        summary, create_invoices, _ = self._run(fail_reference='BK-XERO-2', items=[])
+        create_invoices.assert_not_called()
+        self.assertEqual([failure['booking_number'] for failure in summary['abandoned']], ['BK-XERO-2'])
+        self.assertEqual(summary['abandoned'][0]['errors'], ['Contact name is invalid'])
+        self.assertEqual(db.session.get(Payment, payment.id).status, PaymentStatus.FAILED)
+
+        # Not reported again, and a re-claim of the same key is skipped
+        summary, _, _ = self._run()
+        self.assertEqual(summary['abandoned'], [])
+        self.assertEqual(Payment.query.count(), 5)
+
+    def test_old_claims_are_given_up(self):
+        self._run(create_error=TimeoutError('read timed out'))
+        self.assertEqual({payment.gateway_response['attempts'] for payment in Payment.query}, {1})
+        Payment.query.update({'created_at': datetime.utcnow() - timedelta(days=INVOICE_CLAIM_RETRY_DAYS + 1)})
+        db.session.commit()
+        summary, create_invoices, _ = self._run(items=[])
+        create_invoices.assert_not_called()
+        self.assertEqual(len(summary['abandoned']), 5)
+        self.assertEqual(summary['abandoned'][0]['errors'], ['read timed out'])
+
+    def test_failed_flush_in_one_batch_does_not_break_the_next(self):
+        self.app.config['XERO_INVOICE_BATCH_SIZE'] = 2
+        calls = []
+
+        def create(client, invoices, idempotency_key=None):
+            calls.append(len(invoices))
+            if len(calls) == 1:
+                # A ContactID already mapped to this customer: the flush violates the unique constraint
+                db.session.add(XeroContact(user_id=self.bookings[0].customer_id + 1000,
+                                           contact_id=f"contact-AURORA-{self.bookings[0].customer_id}"))
+                db.session.flush()
+            return _results(invoices)
+
+        summary, _, email_invoice = self._run(create_error=create)
+        self.assertEqual(calls, [2, 2, 1])
+        self.assertEqual(len(summary['failed']), 2)
+        self.assertEqual(summary['created'], 3)
+        self.assertEqual(email_invoice.call_count, 3)
+        self.assertEqual(self._invoiced(), 3)
+
+    def test_invoice_status_sync_pages_from_the_watermark(self):
+        self._run()
+        keys = [payment.transaction_id for payment in Payment.query.order_by(Payment.id)]
+        pages = {
+            1: [{'InvoiceNumber': keys[0], 'Status': 'PAID', 'FullyPaidOnDate': '/Date(1760000000000+0000)/',
+                 'UpdatedDateUTC': '/Date(1760000000000+0000)/'},
+                {'InvoiceNumber': 'INV-OTHER', 'Status': 'PAID', 'UpdatedDateUTC': '/Date(1760000100000+0000)/'}],
+            2: [{'InvoiceNumber': keys[1], 'Status': 'VOIDED', 'UpdatedDateUTC': '/Date(1760000200000+0000)/'},
+                {'InvoiceNumber': keys[2], 'Status': 'AUTHORISED', 'UpdatedDateUTC': '/Date(1760000300000+0000)/'}],
+            3: [],
+        }
+        with mock.patch.object(XeroClient, 'INVOICES_PAGE_SIZE', 2), \
+                mock.patch.object(XeroClient, 'get_modified_invoices',
+                                  side_effect=lambda page, modified_since=None: pages[page]) as get_page:
+            summary = self.scheduler.sync_invoice_statuses()
+        self.assertEqual(summary, {'pages': 3, 'seen': 4, 'matched': 2, 'updated': 2})
+        self.assertIsNone(get_page.call_args_list[0].kwargs['modified_since'])
+        statuses = {payment.transaction_id: payment.status for payment in Payment.query.all()}
+        self.assertEqual(statuses[keys[0]], PaymentStatus.COMPLETED)
+        self.assertEqual(statuses[keys[1]], PaymentStatus.CANCELLED)
+        self.assertEqual(statuses[keys[2]], PaymentStatus.PENDING)
+        watermark = db.session.get(SyncCheckpoint, INVOICE_SYNC_CHECKPOINT).watermark
+        self.assertEqual(watermark, datetime.utcfromtimestamp(1760000300))
+
+        # The next run asks only for invoices changed since then
+        with mock.patch.object(XeroClient, 'get_modified_invoices', return_value=[]) as get_page:
+            self.scheduler.sync_invoice_statuses()
+        self.assertEqual(get_page.call_args.kwargs['modified_since'], watermark - timedelta(seconds=1))
+
+    def _schedule(self, n, frequency, start, status='active'):
+        schedule = DirectDebitSchedule(booking_id=self.bookings[n].id, schedule_id=f'SCH{n}', description='Rent',
+                                       recurring_amount=60.0, recurring_start_date=start, frequency=frequency,
+                                       status=status)
+        db.session.add(schedule)
+        return schedule
+
+    def test_daily_job_invoices_only_schedules_due_tomorrow(self):
+        self._schedule(0, 'weekly', self.due)
+        self._schedule(1, 'weekly', self.due - timedelta(days=3))
+        # Started years ago, so its stored next_due_date is long past
+        self._schedule(2, 'monthly', self.due.replace(year=self.due.year - 4))
+        self._schedule(3, 'fortnightly', self.due, status='cancelled')
+        db.session.commit()
+
+        with mock.patch.object(XeroInvoiceScheduler, 'create_scheduled_invoices',
+                               return_value={'created': 2}) as create:
+            self.scheduler.check_and_create_due_invoices()
+        items = create.call_args.args[0]
+        self.assertEqual(sorted(item['schedule_id'] for item in items), ['SCH0', 'SCH2'])
+        self.assertEqual({item['due_date'] for item in items}, {self.due})
+
+        schedules = {schedule.schedule_id: schedule for schedule in DirectDebitSchedule.query}
+        self.assertEqual(schedules['SCH0'].next_due_date, self.due + timedelta(days=7))
+        self.assertEqual(schedules['SCH1'].next_due_date, self.due + timedelta(days=4))
+        self.assertGreater(schedules['SCH2'].next_due_date, self.due)
+        self.assertEqual(schedules['SCH2'].next_due_date.day, self.due.day)
+
+        # Nothing is due again tomorrow
+        with mock.patch.object(XeroInvoiceScheduler, 'create_scheduled_invoices', return_value={}) as create:
+            self.scheduler.check_and_create_due_invoices()
+        self.assertEqual(create.call_args.args[0], [])
+
+    def test_due_schedules_are_read_through_the_index(self):
+        statement = DirectDebitSchedule.query.filter(
+            DirectDebitSchedule.status == 'active', DirectDebitSchedule.next_due_date <= self.due).statement
+        sql = str(statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        plan = ' '.join(str(row) for row in db.session.execute(db.text(f'EXPLAIN QUERY PLAN {sql}')))
+        self.assertIn('ix_dd_schedules_status_next_due', plan)
+
+    def test_monthly_payments_skip_months_without_the_start_day(self):
+        schedule = DirectDebitSchedule(recurring_amount=60.0, recurring_start_date=date(2025, 1, 31),
+                                       frequency='monthly')
+        self.assertEqual(schedule.due_date_on_or_after(date(2025, 2, 1)), date(2025, 3, 31))
+        self.assertEqual(schedule.due_date_on_or_after(date(2024, 6, 1)), date(2025, 1, 31))
+        schedule.frequency = 'yearly'
+        self.assertIsNone(schedule.due_date_on_or_after(date(2025, 2, 1)))
+
+    def test_payment_made_before_invoicing_advances_the_schedule(self):
+        schedule = self._schedule(0, 'weekly', self.due)
+        db.session.commit()
+        PayAdvantageService().upsert_installment_from_webhook({
+            'scheduleId': 'SCH0', 'paymentId': 'PAY1', 'dueDate': self.due.isoformat(), 'dueAmount': 60.0,
+            'paidDate': self.due.isoformat(), 'paidAmount': 60.0, 'status': 'completed'})
+        self.assertEqual(db.session.get(DirectDebitSchedule, schedule.id).next_due_date, self.due + timedelta(days=7))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Tests for the pooled Xero HTTP session: timeouts, retries and Retry-After.
+"""
+
+import unittest
+from unittest import mock
+
+import requests
+from urllib3.exceptions import ProtocolError
+
+from app import create_app
+from app.utils import xero
+from app.utils.xero import XeroClient, get_xero_session, xero_request
+
+API_URL = f'{XeroClient.XERO_API_URL}/Invoices'
+
+
+def _response(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return response
+
+
+class XeroSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.session = get_xero_session()
+        sleep_patch = mock.patch.object(xero.time, 'sleep')
+        self.sleep = sleep_patch.start()
+        self.addCleanup(sleep_patch.stop)
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def _send(self, *responses):
+        patcher = mock.patch.object(self.session, 'request', side_effect=list(responses))
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_session_is_reused_and_timeouts_applied(self):
+        self.assertIs(get_xero_session(), self.session)
+        send = self._send(_response(200))
+        xero_request('GET', API_URL)
+        self.assertEqual(send.call_args.kwargs['timeout'], (3.05, 20.0))
+
+    def test_throttled_request_waits_for_retry_after(self):
+        send = self._send(_response(429, {'Retry-After': '2'}), _response(200))
+        self.assertEqual(xero_request('GET', API_URL).status_code, 200)
+        self.assertEqual(send.call_count, 2)
+        self.sleep.assert_called_once_with(2.0)
+
+    def test_api_post_is_retried_with_one_idempotency_key(self):
+        send = self._send(_response(503), _response(200))
+        self.assertEqual(xero_request('POST', API_URL, json={}).status_code, 200)
+        keys = {call.kwargs['headers']['Idempotency-Key'] for call in send.call_args_list}
+        self.assertEqual(len(keys), 1)
+
+    def test_token_post_is_not_retried_on_server_error(self):
+        send = self._send(_response(500), _response(200))
+        self.assertEqual(xero_request('POST', XeroClient.XERO_TOKEN_URL, data={}).status_code, 500)
+        self.assertEqual(send.call_count, 1)
+
+    def test_token_post_is_not_retried_after_a_dropped_connection(self):
+        dropped = requests.exceptions.ConnectionError(
+            ProtocolError('Connection aborted.', ConnectionResetError('reset by peer')))
+        send = self._send(dropped, _response(200))
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            xero_request('POST', XeroClient.XERO_TOKEN_URL, data={})
+        self.assertEqual(send.call_count, 1)
+
+    def test_token_post_is_retried_when_connect_fails(self):
+        send = self._send(requests.exceptions.ConnectTimeout('connect timed out'), _response(200))
+        self.assertEqual(xero_request('POST', XeroClient.XERO_TOKEN_URL, data={}).status_code, 200)
+        self.assertEqual(send.call_count, 2)
+
+    def test_gives_up_when_retry_after_exceeds_budget(self):
+        send = self._send(_response(429, {'Retry-After': '3600'}), _response(200))
+        self.assertEqual(xero_request('GET', API_URL).status_code, 429)
+        self.assertEqual(send.call_count, 1)
+        self.sleep.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
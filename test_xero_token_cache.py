@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Tests for the in-process Xero token cache and single-flight refresh.
+"""
+
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from sqlalchemy import event
+
+from app import create_app, db
+from app.models import XeroToken
+from app.utils.xero import XeroClient, invalidate_xero_token_cache
+
+
+class XeroTokenCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        with self.app.app_context():
+            token = XeroToken(access_token='access-1', refresh_token='refresh-1', tenant_id='tenant-1',
+                              expires_at=datetime.utcnow() + timedelta(minutes=30))
+            db.session.add(token)
+            db.session.commit()
+        invalidate_xero_token_cache()
+        self.addCleanup(invalidate_xero_token_cache)
+
+    def _expire_token(self):
+        with self.app.app_context():
+            XeroToken.query.update({'expires_at': datetime.utcnow() + timedelta(minutes=1)})
+            db.session.commit()
+
+    def test_valid_token_is_served_from_cache(self):
+        with self.app.app_context():
+            selects = []
+
+            def listener(conn, cursor, statement, *args):
+                if 'xero_tokens' in statement:
+                    selects.append(statement)
+
+            event.listen(db.engine, 'before_cursor_execute', listener)
+            try:
+                client = XeroClient()
+                first = client.get_valid_token()
+                second = client.get_valid_token()
+                by_tenant = client.get_valid_token('tenant-1')
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(first.access_token, 'access-1')
+        self.assertIs(first, second)
+        self.assertEqual(by_tenant.tenant_id, 'tenant-1')
+        # One load for the default key, one for the tenant key
+        self.assertEqual(len(selects), 2)
+
+    def test_concurrent_refresh_is_single_flight(self):
+        self._expire_token()
+        calls = []
+
+        def fake_refresh(client, refresh_token):
+            calls.append(refresh_token)
+            return {'access_token': 'access-2', 'refresh_token': 'refresh-2', 'expires_in': 1800}
+
+        results = []
+
+        def worker():
+            with self.app.app_context():
+                results.append(XeroClient().get_valid_token().access_token)
+
+        with mock.patch.object(XeroClient, 'refresh_access_token', fake_refresh):
+            threads = [threading.Thread(target=worker) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(calls, ['refresh-1'])
+        self.assertEqual(results, ['access-2'] * 5)
+        with self.app.app_context():
+            self.assertEqual(XeroToken.query.one().refresh_token, 'refresh-2')
+
+    def test_refresh_is_skipped_when_another_worker_already_refreshed(self):
+        with self.app.app_context():
+            token_id = XeroToken.query.one().id
+            with mock.patch.object(XeroClient, 'refresh_access_token') as refresh:
+                token = XeroClient()._refresh_token_locked(token_id)
+        refresh.assert_not_called()
+        self.assertEqual(token.access_token, 'access-1')
+
+
+if __name__ == '__main__':
+    unittest.main()